@@ -25,6 +25,7 @@ from .eval.evaluator import run_eval
 from .extras import logging
 from .extras.env import VERSION, print_env
 from .extras.misc import get_device_count
+from .train.sail import run_sail_bench
 from .train.tuner import export_model, run_exp
 from .webui.interface import run_web_demo, run_web_ui
 
@@ -34,6 +35,7 @@ USAGE = (
     + "\n"
     + "| Usage:                                                             |\n"
     + "|   llamafactory-cli api -h: launch an OpenAI-style API server       |\n"
+    + "|   llamafactory-cli bench sail -h: benchmark a SAIL training step   |\n"
     + "|   llamafactory-cli chat -h: launch a chat interface in CLI         |\n"
     + "|   llamafactory-cli eval -h: evaluate models                        |\n"
     + "|   llamafactory-cli export -h: merge LoRA adapters and export model |\n"
@@ -62,6 +64,7 @@ logger = logging.get_logger(__name__)
 @unique
 class Command(str, Enum):
     API = "api"
+    BENCH = "bench"
     CHAT = "chat"
     ENV = "env"
     EVAL = "eval"
@@ -77,6 +80,12 @@ def main():
     command = sys.argv.pop(1) if len(sys.argv) != 1 else Command.HELP
     if command == Command.API:
         run_api()
+    elif command == Command.BENCH:
+        target = sys.argv.pop(1) if len(sys.argv) != 1 else None
+        if target == "sail":
+            run_sail_bench()
+        else:
+            raise NotImplementedError(f"Unknown benchmark: {target}.")
     elif command == Command.CHAT:
         run_chat()
     elif command == Command.ENV:
@@ -15,22 +15,45 @@
 from .collator import (
     KTODataCollatorWithPadding,
     MultiModalDataCollatorForSeq2Seq,
+    PairwiseDataCollatorWithFlattening,
+    PairwiseDataCollatorWithPacking,
     PairwiseDataCollatorWithPadding,
     SFTDataCollatorWith4DAttentionMask,
 )
 from .data_utils import Role, split_dataset
 from .loader import get_dataset
+from .processors.pairwise import is_compact_pairwise_dataset, iter_pairwise_examples
+from .samplers import (
+    PromptGroupedBatchSampler,
+    ResumableIterableDataset,
+    ResumableSampler,
+    TokenBudgetBatchSampler,
+    get_pairwise_lengths,
+    get_prompt_groups,
+)
+from .streaming import ShardedJsonlDataset
 from .template import TEMPLATES, Template, get_template_and_fix_tokenizer
 
 
 __all__ = [
     "KTODataCollatorWithPadding",
     "MultiModalDataCollatorForSeq2Seq",
+    "PairwiseDataCollatorWithFlattening",
+    "PairwiseDataCollatorWithPacking",
     "PairwiseDataCollatorWithPadding",
     "SFTDataCollatorWith4DAttentionMask",
     "Role",
     "split_dataset",
     "get_dataset",
+    "PromptGroupedBatchSampler",
+    "ResumableIterableDataset",
+    "ResumableSampler",
+    "TokenBudgetBatchSampler",
+    "get_pairwise_lengths",
+    "get_prompt_groups",
+    "ShardedJsonlDataset",
+    "is_compact_pairwise_dataset",
+    "iter_pairwise_examples",
     "TEMPLATES",
     "Template",
     "get_template_and_fix_tokenizer",
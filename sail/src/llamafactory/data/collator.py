@@ -24,6 +24,7 @@ from transformers import DataCollatorForSeq2Seq
 
 from ..extras.constants import IGNORE_INDEX, IMAGE_PLACEHOLDER
 from ..extras.packages import is_pillow_available
+from .processors.pairwise import expand_compact_pairwise_example
 
 
 if is_pillow_available():
@@ -152,12 +153,92 @@ class SFTDataCollatorWith4DAttentionMask(MultiModalDataCollatorForSeq2Seq):
         return features
 
 
+def _get_shared_prompt_length(feature: Dict[str, Any], label_pad_token_id: int) -> int:
+    r"""
+    Returns the length of the longest masked prefix shared by the chosen and rejected sequences.
+    """
+    prompt_len = 0
+    for chosen_id, rejected_id, chosen_label, rejected_label in zip(
+        feature["chosen_input_ids"],
+        feature["rejected_input_ids"],
+        feature["chosen_labels"],
+        feature["rejected_labels"],
+    ):
+        if chosen_id != rejected_id or chosen_label != label_pad_token_id or rejected_label != label_pad_token_id:
+            break
+
+        prompt_len += 1
+
+    return prompt_len
+
+
+def _pad_sequences(
+    sequences: Sequence[Sequence[int]], padding_value: int, padding_side: Literal["left", "right"], multiple_of: int
+) -> "torch.Tensor":
+    max_len = max(len(sequence) for sequence in sequences)
+    max_len = (max_len + multiple_of - 1) // multiple_of * multiple_of
+    padded = torch.full((len(sequences), max_len), padding_value, dtype=torch.long)
+    for i, sequence in enumerate(sequences):
+        if len(sequence) == 0:
+            continue
+
+        if padding_side == "left":
+            padded[i, max_len - len(sequence) :] = torch.tensor(sequence, dtype=torch.long)
+        else:
+            padded[i, : len(sequence)] = torch.tensor(sequence, dtype=torch.long)
+
+    return padded
+
+
 @dataclass
 class PairwiseDataCollatorWithPadding(MultiModalDataCollatorForSeq2Seq):
     r"""
     Data collator for pairwise data.
     """
 
+    shared_prompt: bool = False
+
+    def _shared_prompt_call(self, features: Sequence[Dict[str, Any]]) -> Dict[str, "torch.Tensor"]:
+        r"""
+        Splits each pair into the shared prompt and the two responses.
+
+        The distinct prompts are left-padded to (m, prompt_len) in `prompt_input_ids` and `prompt_attention_mask`,
+        the pairs sharing a prompt (e.g. listwise data) run it once.
+        The responses are right-padded to (2 * n, response_len), the first n being the chosen ones.
+        The `prompt_index` of shape (2 * n,) maps each response to its prompt.
+        The last prompt token is kept in the responses to predict the first response token.
+        """
+        prompt_ids, prompt_index, prompt_ids_to_index = [], [], {}
+        response_ids, response_labels = {"chosen": [], "rejected": []}, {"chosen": [], "rejected": []}
+        for feature in features:
+            if feature["images"] or feature["videos"]:
+                raise ValueError("Shared prompt does not support multimodal inputs.")
+
+            prompt_len = max(_get_shared_prompt_length(feature, self.label_pad_token_id), 1)
+            prompt = tuple(feature["chosen_input_ids"][: prompt_len - 1])
+            if prompt not in prompt_ids_to_index:
+                prompt_ids_to_index[prompt] = len(prompt_ids)
+                prompt_ids.append(prompt)
+
+            prompt_index.append(prompt_ids_to_index[prompt])
+            for key in ("chosen", "rejected"):
+                response_ids[key].append(feature[f"{key}_input_ids"][prompt_len - 1 :])
+                response_labels[key].append(feature[f"{key}_labels"][prompt_len - 1 :])
+
+        input_ids = response_ids["chosen"] + response_ids["rejected"]
+        labels = response_labels["chosen"] + response_labels["rejected"]
+        multiple_of = self.pad_to_multiple_of or 1
+        pad_token_id = self.tokenizer.pad_token_id
+        batch = {
+            "input_ids": _pad_sequences(input_ids, pad_token_id, "right", multiple_of),
+            "attention_mask": _pad_sequences([[1] * len(ids) for ids in input_ids], 0, "right", multiple_of),
+            "labels": _pad_sequences(labels, self.label_pad_token_id, "right", multiple_of),
+            "prompt_input_ids": _pad_sequences(prompt_ids, pad_token_id, "left", multiple_of),
+            "prompt_attention_mask": _pad_sequences([[1] * len(ids) for ids in prompt_ids], 0, "left", multiple_of),
+            "prompt_index": torch.tensor(prompt_index * 2, dtype=torch.long),
+        }
+        return batch
+
     def __call__(self, features: Sequence[Dict[str, Any]]) -> Dict[str, "torch.Tensor"]:
         r"""
         Pads batched data to the longest sequence in the batch.
@@ -165,19 +246,95 @@ class PairwiseDataCollatorWithPadding(MultiModalDataCollatorForSeq2Seq):
         We generate 2 * n examples where the first n examples represent chosen examples and
         the last n examples represent rejected examples.
         """
-        concatenated_features = []
-        for key in ("chosen", "rejected"):
-            for feature in features:
-                target_feature = {
-                    "input_ids": feature[f"{key}_input_ids"],
-                    "attention_mask": feature[f"{key}_attention_mask"],
-                    "labels": feature[f"{key}_labels"],
-                    "images": feature["images"],
-                    "videos": feature["videos"],
-                }
-                concatenated_features.append(target_feature)
-
-        return super().__call__(concatenated_features)
+        if "prompt_length" in features[0]:  # compact pairwise data
+            features = [expand_compact_pairwise_example(feature) for feature in features]
+
+        if self.shared_prompt:
+            batch = self._shared_prompt_call(features)
+        else:
+            concatenated_features = []
+            for key in ("chosen", "rejected"):
+                for feature in features:
+                    target_feature = {
+                        "input_ids": feature[f"{key}_input_ids"],
+                        "attention_mask": feature[f"{key}_attention_mask"],
+                        "labels": feature[f"{key}_labels"],
+                        "images": feature["images"],
+                        "videos": feature["videos"],
+                    }
+                    concatenated_features.append(target_feature)
+
+            batch = super().__call__(concatenated_features)
+
+        if "sample_index" in features[0]:  # used to look up the precomputed log probabilities
+            batch["sample_index"] = torch.tensor([feature["sample_index"] for feature in features])
+
+        return batch
+
+
+@dataclass
+class PairwiseDataCollatorWithPacking(SFTDataCollatorWith4DAttentionMask):
+    r"""
+    Data collator for packed pairwise data.
+
+    The attention mask with indices is kept in `segment_ids` to unpack the pairs, and the positions restart
+    from zero in each segment so that the packed sequences are encoded as if they were in separate rows.
+    """
+
+    def __call__(self, features: Sequence[Dict[str, Any]]) -> Dict[str, "torch.Tensor"]:
+        batch = MultiModalDataCollatorForSeq2Seq.__call__(self, features)
+        segment_ids = batch["attention_mask"]
+        indices = torch.arange(segment_ids.size(1), device=segment_ids.device).expand_as(segment_ids)
+        is_start = torch.ones_like(segment_ids, dtype=torch.bool)
+        is_start[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+        segment_starts = torch.where(is_start, indices, 0).cummax(dim=-1).values
+        batch["segment_ids"] = segment_ids
+        batch["position_ids"] = indices - segment_starts
+        if self.block_diag_attn and self.attn_implementation != "flash_attention_2":
+            batch["attention_mask"] = prepare_4d_attention_mask(segment_ids, self.compute_dtype)
+
+        return batch
+
+
+@dataclass
+class PairwiseDataCollatorWithFlattening(MultiModalDataCollatorForSeq2Seq):
+    r"""
+    Data collator for pairwise data without padding.
+
+    All the chosen and rejected sequences are concatenated into one row, the ones of the j-th pair are marked as
+    the segments 2j+1 and 2j+2 in `segment_ids`, and the positions restart from zero in each sequence.
+    FlashAttention-2 reads the sequence boundaries from the positions, other implementations use a 4d mask.
+    """
+
+    attn_implementation: Literal["eager", "sdpa", "flash_attention_2"] = "eager"
+    compute_dtype: "torch.dtype" = torch.float32
+
+    def __call__(self, features: Sequence[Dict[str, Any]]) -> Dict[str, "torch.Tensor"]:
+        if "prompt_length" in features[0]:  # compact pairwise data
+            features = [expand_compact_pairwise_example(feature) for feature in features]
+
+        input_ids, labels, segment_ids, position_ids = [], [], [], []
+        for j, feature in enumerate(features):
+            if feature["images"] or feature["videos"]:
+                raise ValueError("Padding-free pairwise data collator does not support multimodal inputs.")
+
+            for k, key in enumerate(("chosen", "rejected")):
+                seq_len = len(feature[f"{key}_input_ids"])
+                input_ids += feature[f"{key}_input_ids"]
+                labels += [self.label_pad_token_id] + feature[f"{key}_labels"][1:]  # not predicted across sequences
+                segment_ids += [2 * j + k + 1] * seq_len
+                position_ids += list(range(seq_len))
+
+        batch = {
+            "input_ids": torch.tensor([input_ids], dtype=torch.long),
+            "labels": torch.tensor([labels], dtype=torch.long),
+            "segment_ids": torch.tensor([segment_ids], dtype=torch.long),
+            "position_ids": torch.tensor([position_ids], dtype=torch.long),
+        }
+        if self.attn_implementation != "flash_attention_2":
+            batch["attention_mask"] = prepare_4d_attention_mask(batch["segment_ids"], self.compute_dtype)
+
+        return batch
 
 
 @dataclass
@@ -12,21 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import dataclasses
+import hashlib
+import json
 import os
+import shutil
 import sys
-from typing import TYPE_CHECKING, Dict, Literal, Optional, Sequence, Union
+from typing import TYPE_CHECKING, Any, Dict, Literal, Optional, Sequence, Union
 
 import numpy as np
+import torch
 from datasets import DatasetDict, load_dataset, load_from_disk
+from datasets.fingerprint import Hasher
 from transformers.utils.versions import require_version
 
 from ..extras import logging
 from ..extras.constants import FILEEXT2TYPE
+from ..extras.env import VERSION
 from ..extras.misc import has_tokenized_data
 from .aligner import align_dataset
 from .data_utils import merge_dataset, split_dataset
 from .parser import get_dataset_list
 from .preprocess import get_preprocess_and_print_func
+from .streaming import get_sharded_stream_dataset
 
 
 if TYPE_CHECKING:
@@ -42,6 +50,28 @@ if TYPE_CHECKING:
 logger = logging.get_logger(__name__)
 
 
+CACHE_VERSION = 1
+CACHE_INFO_NAME = "cache_info.json"
+CACHE_DATA_KEYS = (
+    "dataset",
+    "eval_dataset",
+    "image_dir",
+    "template",
+    "cutoff_len",
+    "train_on_prompt",
+    "mask_history",
+    "mix_strategy",
+    "interleave_probs",
+    "max_samples",
+    "val_size",
+    "packing",
+    "neat_packing",
+    "compact_pairwise",
+    "tool_format",
+    "single_pass_tokenization",
+)
+
+
 def _load_single_dataset(
     dataset_attr: "DatasetAttr",
     model_args: "ModelArguments",
@@ -223,6 +253,173 @@ def _get_preprocessed_dataset(
     return dataset
 
 
+def _hash_dataset_files(dataset_attr: "DatasetAttr", dataset_dir: str) -> Optional[str]:
+    r"""
+    Hashes the contents of the local files of the dataset, returns None for remote datasets.
+    """
+    local_path = os.path.join(dataset_dir, dataset_attr.dataset_name)
+    if os.path.isdir(local_path):
+        file_paths = []
+        for root, _, file_names in os.walk(local_path):
+            file_paths += [os.path.join(root, file_name) for file_name in file_names]
+    elif os.path.isfile(local_path):
+        file_paths = [local_path]
+    else:
+        return None
+
+    hasher = hashlib.sha256()
+    for file_path in sorted(file_paths):
+        hasher.update(os.path.relpath(file_path, local_path).encode("utf-8"))
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def _get_dataset_cache_info(
+    template: "Template",
+    data_args: "DataArguments",
+    training_args: "Seq2SeqTrainingArguments",
+    stage: Literal["pt", "sft", "rm", "ppo", "kto"],
+    tokenizer: "PreTrainedTokenizer",
+    processor: Optional["ProcessorMixin"],
+) -> Dict[str, Any]:
+    r"""
+    Collects everything the tokenized dataset depends on, the remote datasets are identified by their attributes.
+    """
+    datasets = {}
+    for dataset_names in (data_args.dataset, data_args.eval_dataset):
+        for dataset_attr in get_dataset_list(dataset_names, data_args.dataset_dir):
+            datasets[dataset_attr.dataset_name] = {
+                "attr": dataclasses.asdict(dataset_attr),
+                "files": _hash_dataset_files(dataset_attr, data_args.dataset_dir),
+            }
+
+    template_info = {
+        field.name: repr(getattr(template, field.name))
+        for field in dataclasses.fields(template)
+        if field.name != "mm_plugin"
+    }
+    template_info["mm_plugin"] = [type(template.mm_plugin).__name__, vars(template.mm_plugin)]
+    return {
+        "version": [VERSION, CACHE_VERSION],
+        "datasets": datasets,
+        "template": template_info,
+        "tokenizer": Hasher.hash(tokenizer),
+        "processor": Hasher.hash(processor) if processor is not None else None,
+        "data_args": {key: getattr(data_args, key) for key in CACHE_DATA_KEYS},
+        "stage": stage,
+        "seed": training_args.seed,
+        "predict_with_generate": training_args.predict_with_generate,
+    }
+
+
+def _get_shared_cache_info(
+    template: "Template",
+    data_args: "DataArguments",
+    training_args: "Seq2SeqTrainingArguments",
+    stage: Literal["pt", "sft", "rm", "ppo", "kto"],
+    tokenizer: "PreTrainedTokenizer",
+    processor: Optional["ProcessorMixin"],
+) -> Dict[str, Any]:
+    r"""
+    Collects the cache info on the first process and broadcasts it, so that the raw files are hashed only once.
+    """
+    is_distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    cache_info = None
+    if not is_distributed or training_args.process_index == 0:
+        cache_info = _get_dataset_cache_info(template, data_args, training_args, stage, tokenizer, processor)
+
+    if is_distributed:
+        objects = [cache_info]
+        torch.distributed.broadcast_object_list(objects, src=0)
+        cache_info = objects[0]
+
+    return cache_info
+
+
+def _save_dataset_cache(dataset_dict: "DatasetDict", cache_path: str, cache_info: Dict[str, Any]) -> None:
+    r"""
+    Saves the tokenized dataset to a temporary directory and renames it, so that a partial save is never loaded.
+    """
+    tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    dataset_dict.save_to_disk(tmp_path)
+    with open(os.path.join(tmp_path, CACHE_INFO_NAME), "w", encoding="utf-8") as f:
+        json.dump(cache_info, f, indent=2, default=str)
+
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:  # saved by another node sharing the cache directory
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _load_tokenized_dataset(path: str, data_args: "DataArguments") -> "DatasetModule":
+    r"""
+    Loads the tokenized dataset saved by `save_to_disk`, the arrow files are memory-mapped.
+    """
+    tokenized_data: Union["Dataset", "DatasetDict"] = load_from_disk(path)
+    dataset_module: Dict[str, "Dataset"] = {}
+    if isinstance(tokenized_data, DatasetDict):
+        if "train" in tokenized_data:
+            dataset_module["train_dataset"] = tokenized_data["train"]
+
+        if "validation" in tokenized_data:
+            dataset_module["eval_dataset"] = tokenized_data["validation"]
+
+    else:  # Dataset
+        dataset_module["train_dataset"] = tokenized_data
+
+    if data_args.streaming:
+        dataset_module = {k: v.to_iterable_dataset() for k, v in dataset_module.items()}
+
+    return dataset_module
+
+
+def _get_dataset_dict(
+    template: "Template",
+    model_args: "ModelArguments",
+    data_args: "DataArguments",
+    training_args: "Seq2SeqTrainingArguments",
+    stage: Literal["pt", "sft", "rm", "ppo", "kto"],
+    tokenizer: "PreTrainedTokenizer",
+    processor: Optional["ProcessorMixin"] = None,
+) -> "DatasetDict":
+    r"""
+    Loads, preprocesses and splits the datasets, should be called in `main_process_first`.
+    """
+    dataset = None
+    if not data_args.sharded_streaming:  # the train dataset is read by each process
+        dataset = _get_merged_dataset(data_args.dataset, model_args, data_args, training_args, stage)
+
+    eval_dataset = _get_merged_dataset(data_args.eval_dataset, model_args, data_args, training_args, stage)
+    dataset = _get_preprocessed_dataset(
+        dataset, data_args, training_args, stage, template, tokenizer, processor, is_eval=False
+    )
+    eval_dataset = _get_preprocessed_dataset(
+        eval_dataset, data_args, training_args, stage, template, tokenizer, processor, is_eval=True
+    )
+
+    if data_args.val_size > 1e-6:
+        return split_dataset(dataset, data_args, seed=training_args.seed)
+
+    dataset_dict = {}
+    if dataset is not None:
+        if data_args.streaming:
+            dataset = dataset.shuffle(buffer_size=data_args.buffer_size, seed=training_args.seed)
+
+        dataset_dict["train"] = dataset
+
+    if eval_dataset is not None:
+        if data_args.streaming:
+            eval_dataset = eval_dataset.shuffle(buffer_size=data_args.buffer_size, seed=training_args.seed)
+
+        dataset_dict["validation"] = eval_dataset
+
+    return DatasetDict(dataset_dict)
+
+
 def get_dataset(
     template: "Template",
     model_args: "ModelArguments",
@@ -239,59 +436,34 @@ def get_dataset(
     if data_args.tokenized_path is not None:
         if has_tokenized_data(data_args.tokenized_path):
             logger.warning_rank0("Loading dataset from disk will ignore other data arguments.")
-            tokenized_data: Union["Dataset", "DatasetDict"] = load_from_disk(data_args.tokenized_path)
+            dataset_module = _load_tokenized_dataset(data_args.tokenized_path, data_args)
             logger.info_rank0(f"Loaded tokenized dataset from {data_args.tokenized_path}.")
-
-            dataset_module: Dict[str, "Dataset"] = {}
-            if isinstance(tokenized_data, DatasetDict):
-                if "train" in tokenized_data:
-                    dataset_module["train_dataset"] = tokenized_data["train"]
-
-                if "validation" in tokenized_data:
-                    dataset_module["eval_dataset"] = tokenized_data["validation"]
-
-            else:  # Dataset
-                dataset_module["train_dataset"] = tokenized_data
-
-            if data_args.streaming:
-                dataset_module = {k: v.to_iterable_dataset() for k, v in dataset_module.items()}
-
             return dataset_module
 
         if data_args.streaming:
             raise ValueError("Turn off `streaming` when saving dataset to disk.")
 
-    # Load and preprocess dataset
-    with training_args.main_process_first(desc="load dataset"):
-        dataset = _get_merged_dataset(data_args.dataset, model_args, data_args, training_args, stage)
-        eval_dataset = _get_merged_dataset(data_args.eval_dataset, model_args, data_args, training_args, stage)
+    # Load or build the cached dataset
+    if data_args.preprocessing_cache_dir is not None:
+        cache_info = _get_shared_cache_info(template, data_args, training_args, stage, tokenizer, processor)
+        cache_key = hashlib.sha256(json.dumps(cache_info, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        cache_path = os.path.join(data_args.preprocessing_cache_dir, cache_key[:32])
+        with training_args.main_process_first(desc="pre-process dataset"):
+            if has_tokenized_data(cache_path):
+                logger.info_rank0(f"Loading tokenized dataset from cache {cache_path}.")
+            elif training_args.local_process_index == 0:
+                dataset_dict = _get_dataset_dict(
+                    template, model_args, data_args, training_args, stage, tokenizer, processor
+                )
+                os.makedirs(data_args.preprocessing_cache_dir, exist_ok=True)
+                _save_dataset_cache(dataset_dict, cache_path, cache_info)
+                logger.info_rank0(f"Tokenized dataset cached at {cache_path}.")
+
+        return _load_tokenized_dataset(cache_path, data_args)
 
+    # Load and preprocess dataset
     with training_args.main_process_first(desc="pre-process dataset"):
-        dataset = _get_preprocessed_dataset(
-            dataset, data_args, training_args, stage, template, tokenizer, processor, is_eval=False
-        )
-        eval_dataset = _get_preprocessed_dataset(
-            eval_dataset, data_args, training_args, stage, template, tokenizer, processor, is_eval=True
-        )
-
-        if data_args.val_size > 1e-6:
-            dataset_dict = split_dataset(dataset, data_args, seed=training_args.seed)
-        else:
-            dataset_dict = {}
-            if dataset is not None:
-                if data_args.streaming:
-                    dataset = dataset.shuffle(buffer_size=data_args.buffer_size, seed=training_args.seed)
-
-                dataset_dict["train"] = dataset
-
-            if eval_dataset is not None:
-                if data_args.streaming:
-                    eval_dataset = eval_dataset.shuffle(buffer_size=data_args.buffer_size, seed=training_args.seed)
-
-                dataset_dict["validation"] = eval_dataset
-
-            dataset_dict = DatasetDict(dataset_dict)
-
+        dataset_dict = _get_dataset_dict(template, model_args, data_args, training_args, stage, tokenizer, processor)
         if data_args.tokenized_path is not None:
             if training_args.should_save:
                 dataset_dict.save_to_disk(data_args.tokenized_path)
@@ -304,6 +476,11 @@ def get_dataset(
         if "train" in dataset_dict:
             dataset_module["train_dataset"] = dataset_dict["train"]
 
+        if data_args.sharded_streaming:
+            dataset_module["train_dataset"] = get_sharded_stream_dataset(
+                template, data_args, training_args, stage, tokenizer, processor
+            )
+
         if "validation" in dataset_dict:
             dataset_module["eval_dataset"] = dataset_dict["validation"]
 
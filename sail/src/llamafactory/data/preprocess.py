@@ -16,7 +16,12 @@ from functools import partial
 from typing import TYPE_CHECKING, Callable, Literal, Optional, Tuple
 
 from .processors.feedback import preprocess_feedback_dataset
-from .processors.pairwise import preprocess_pairwise_dataset, print_pairwise_dataset_example
+from .processors.pairwise import (
+    preprocess_compact_pairwise_dataset,
+    preprocess_packed_pairwise_dataset,
+    preprocess_pairwise_dataset,
+    print_pairwise_dataset_example,
+)
 
 from .processors.pretrain import preprocess_pretrain_dataset
 from .processors.supervised import (
@@ -34,6 +39,24 @@ if TYPE_CHECKING:
     from .template import Template
 
 
+def _enable_int32_attention_mask() -> None:
+    r"""
+    Hacks datasets to keep the attention mask with indices in int32 rather than downcasting it.
+    """
+    from datasets.arrow_writer import OptimizedTypedSequence, TypedSequence
+
+    def __init__(self, data, **kwargs):
+        return TypedSequence.__init__(
+            self,
+            data,
+            type=kwargs.pop("type", None),
+            try_type=kwargs.pop("try_type", None),
+            optimized_int_type=kwargs.pop("optimized_int_type", None),
+        )
+
+    OptimizedTypedSequence.__init__ = __init__
+
+
 def get_preprocess_and_print_func(
     data_args: "DataArguments",
     stage: Literal["pt", "sft", "rm", "ppo", "kto"],
@@ -52,18 +75,7 @@ def get_preprocess_and_print_func(
     elif stage == "sft" and not do_generate:
         if data_args.packing:
             if data_args.neat_packing:  # hack datasets to have int32 attention mask
-                from datasets.arrow_writer import OptimizedTypedSequence, TypedSequence
-
-                def __init__(self, data, **kwargs):
-                    return TypedSequence.__init__(
-                        self,
-                        data,
-                        type=kwargs.pop("type", None),
-                        try_type=kwargs.pop("try_type", None),
-                        optimized_int_type=kwargs.pop("optimized_int_type", None),
-                    )
-
-                OptimizedTypedSequence.__init__ = __init__
+                _enable_int32_attention_mask()
             preprocess_func = partial(
                 preprocess_packed_supervised_dataset,
                 template=template,
@@ -82,14 +94,34 @@ def get_preprocess_and_print_func(
 
         print_function = partial(print_supervised_dataset_example, tokenizer=tokenizer)
     elif stage == "rm":
-        preprocess_func = partial(
-            preprocess_pairwise_dataset,
-            template=template,
-            tokenizer=tokenizer,
-            processor=processor,
-            data_args=data_args,
-        )
-        print_function = partial(print_pairwise_dataset_example, tokenizer=tokenizer)
+        if data_args.packing:
+            _enable_int32_attention_mask()  # packed pairs always have int32 attention mask
+            preprocess_func = partial(
+                preprocess_packed_pairwise_dataset,
+                template=template,
+                tokenizer=tokenizer,
+                processor=processor,
+                data_args=data_args,
+            )
+            print_function = partial(print_supervised_dataset_example, tokenizer=tokenizer)
+        elif data_args.compact_pairwise:
+            preprocess_func = partial(
+                preprocess_compact_pairwise_dataset,
+                template=template,
+                tokenizer=tokenizer,
+                processor=processor,
+                data_args=data_args,
+            )
+            print_function = partial(print_pairwise_dataset_example, tokenizer=tokenizer)
+        else:
+            preprocess_func = partial(
+                preprocess_pairwise_dataset,
+                template=template,
+                tokenizer=tokenizer,
+                processor=processor,
+                data_args=data_args,
+            )
+            print_function = partial(print_pairwise_dataset_example, tokenizer=tokenizer)
     elif stage == "kto":
         preprocess_func = partial(
             preprocess_feedback_dataset,
@@ -13,14 +13,15 @@
 # limitations under the License.
 
 from collections import defaultdict
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Sequence, Tuple
 
 from ...extras import logging
-from ...extras.constants import IGNORE_INDEX
-from .processor_utils import infer_seqlen
+from ...extras.constants import IGNORE_INDEX, IMAGE_PLACEHOLDER, VIDEO_PLACEHOLDER
+from .processor_utils import greedy_knapsack, infer_seqlen
 
 
 if TYPE_CHECKING:
+    from datasets import Dataset
     from transformers import PreTrainedTokenizer, ProcessorMixin
 
     from ...hparams import DataArguments
@@ -31,7 +32,12 @@ if TYPE_CHECKING:
 logger = logging.get_logger(__name__)
 
 
-def _encode_pairwise_example(
+MM_PLACEHOLDERS = (IMAGE_PLACEHOLDER, VIDEO_PLACEHOLDER)
+PAIRWISE_COLUMNS = ("chosen_input_ids", "chosen_labels", "rejected_input_ids", "rejected_labels")
+COMPACT_PAIRWISE_COLUMNS = ("input_ids", "prompt_length", "chosen_length", "rejected_length")
+
+
+def _encode_pairwise_segments(
     prompt: Sequence[Dict[str, str]],
     response: Sequence[Dict[str, str]],
     system: Optional[str],
@@ -42,11 +48,20 @@ def _encode_pairwise_example(
     tokenizer: "PreTrainedTokenizer",
     processor: Optional["ProcessorMixin"],
     cutoff_len: int,
-) -> Tuple[List[int], List[int], List[int], List[int]]:
-    chosen_messages = template.mm_plugin.process_messages(prompt + [response[0]], images, videos, processor)
-    rejected_messages = template.mm_plugin.process_messages(prompt + [response[1]], images, videos, processor)
-    prompt_ids, chosen_ids = template.encode_oneturn(tokenizer, chosen_messages, system, tools)
-    _, rejected_ids = template.encode_oneturn(tokenizer, rejected_messages, system, tools)
+) -> Tuple[List[int], List[int], List[int]]:
+    responses = response[:2]
+    if any(placeholder in message["content"] for message in responses for placeholder in MM_PLACEHOLDERS):
+        # the placeholders are counted per conversation
+        chosen_messages = template.mm_plugin.process_messages(prompt + [response[0]], images, videos, processor)
+        rejected_messages = template.mm_plugin.process_messages(prompt + [response[1]], images, videos, processor)
+        messages = chosen_messages + rejected_messages[-1:]
+    else:
+        messages = template.mm_plugin.process_messages(prompt + responses, images, videos, processor)
+
+    # the prompt is encoded once for both responses
+    prompt_ids, (chosen_ids, rejected_ids) = template.encode_pairwise(
+        tokenizer, messages[:-2], messages[-2:], system, tools
+    )
 
     if template.efficient_eos:
         chosen_ids += [tokenizer.eos_token_id]
@@ -55,17 +70,68 @@ def _encode_pairwise_example(
     prompt_ids, _ = template.mm_plugin.process_token_ids(prompt_ids, None, images, videos, tokenizer, processor)
     # consider the response is more important
     source_len, target_len = infer_seqlen(len(prompt_ids), max(len(chosen_ids), len(rejected_ids)), cutoff_len)
-    prompt_ids = prompt_ids[:source_len]
-    chosen_ids = chosen_ids[:target_len]
-    rejected_ids = rejected_ids[:target_len]
+    return prompt_ids[:source_len], chosen_ids[:target_len], rejected_ids[:target_len]
+
 
+def _encode_pairwise_example(
+    prompt: Sequence[Dict[str, str]],
+    response: Sequence[Dict[str, str]],
+    system: Optional[str],
+    tools: Optional[str],
+    images: Sequence["ImageInput"],
+    videos: Sequence["VideoInput"],
+    template: "Template",
+    tokenizer: "PreTrainedTokenizer",
+    processor: Optional["ProcessorMixin"],
+    cutoff_len: int,
+) -> Tuple[List[int], List[int], List[int], List[int]]:
+    prompt_ids, chosen_ids, rejected_ids = _encode_pairwise_segments(
+        prompt, response, system, tools, images, videos, template, tokenizer, processor, cutoff_len
+    )
     chosen_input_ids = prompt_ids + chosen_ids
-    chosen_labels = [IGNORE_INDEX] * source_len + chosen_ids
+    chosen_labels = [IGNORE_INDEX] * len(prompt_ids) + chosen_ids
     rejected_input_ids = prompt_ids + rejected_ids
-    rejected_labels = [IGNORE_INDEX] * source_len + rejected_ids
+    rejected_labels = [IGNORE_INDEX] * len(prompt_ids) + rejected_ids
     return chosen_input_ids, chosen_labels, rejected_input_ids, rejected_labels
 
 
+def expand_compact_pairwise_example(example: Dict[str, Any]) -> Dict[str, Any]:
+    r"""
+    Synthesizes the pairwise columns from a compact example, the attention masks are all ones and the labels
+    are the responses behind the masked prompt. The other columns are kept as is.
+    """
+    input_ids, prompt_len = list(example["input_ids"]), example["prompt_length"]
+    chosen_end = prompt_len + example["chosen_length"]
+    prompt_ids, chosen_ids, rejected_ids = (
+        input_ids[:prompt_len],
+        input_ids[prompt_len:chosen_end],
+        input_ids[chosen_end:],
+    )
+    expanded = {key: value for key, value in example.items() if key not in COMPACT_PAIRWISE_COLUMNS}
+    for key, response_ids in (("chosen", chosen_ids), ("rejected", rejected_ids)):
+        expanded[f"{key}_input_ids"] = prompt_ids + response_ids
+        expanded[f"{key}_attention_mask"] = [1] * (prompt_len + len(response_ids))
+        expanded[f"{key}_labels"] = [IGNORE_INDEX] * prompt_len + response_ids
+
+    return expanded
+
+
+def is_compact_pairwise_dataset(dataset: "Dataset") -> bool:
+    return "prompt_length" in dataset.column_names
+
+
+def iter_pairwise_examples(dataset: "Dataset", batch_size: int = 1024) -> Iterator[Dict[str, List[int]]]:
+    r"""
+    Iterates over the input ids and labels of the chosen and rejected sequences, in either storage format.
+    """
+    compact = is_compact_pairwise_dataset(dataset)
+    columns = list(COMPACT_PAIRWISE_COLUMNS if compact else PAIRWISE_COLUMNS)
+    for batch in dataset.select_columns(columns).iter(batch_size=batch_size):
+        for values in zip(*(batch[column] for column in columns)):
+            example = dict(zip(columns, values))
+            yield expand_compact_pairwise_example(example) if compact else example
+
+
 def preprocess_pairwise_dataset(
     examples: Dict[str, List[Any]],
     template: "Template",
@@ -106,7 +172,118 @@ def preprocess_pairwise_dataset(
     return model_inputs
 
 
+def preprocess_compact_pairwise_dataset(
+    examples: Dict[str, List[Any]],
+    template: "Template",
+    tokenizer: "PreTrainedTokenizer",
+    processor: Optional["ProcessorMixin"],
+    data_args: "DataArguments",
+) -> Dict[str, List[Any]]:
+    # build flat rows with format `<bos> X Y1 <eos> Y2 <eos>` and the lengths of the three segments
+    # the `input_ids` column is stored in int32 by datasets, the masks and labels are synthesized in the collator
+    model_inputs = defaultdict(list)
+    for i in range(len(examples["_prompt"])):
+        if len(examples["_prompt"][i]) % 2 != 1 or len(examples["_response"][i]) < 2:
+            logger.warning_rank0(
+                "Dropped invalid example: {}".format(examples["_prompt"][i] + examples["_response"][i])
+            )
+            continue
+
+        prompt_ids, chosen_ids, rejected_ids = _encode_pairwise_segments(
+            prompt=examples["_prompt"][i],
+            response=examples["_response"][i],
+            system=examples["_system"][i],
+            tools=examples["_tools"][i],
+            images=examples["_images"][i] or [],
+            videos=examples["_videos"][i] or [],
+            template=template,
+            tokenizer=tokenizer,
+            processor=processor,
+            cutoff_len=data_args.cutoff_len,
+        )
+        model_inputs["input_ids"].append(prompt_ids + chosen_ids + rejected_ids)
+        model_inputs["prompt_length"].append(len(prompt_ids))
+        model_inputs["chosen_length"].append(len(chosen_ids))
+        model_inputs["rejected_length"].append(len(rejected_ids))
+        model_inputs["images"].append(examples["_images"][i])
+        model_inputs["videos"].append(examples["_videos"][i])
+
+    return model_inputs
+
+
+def preprocess_packed_pairwise_dataset(
+    examples: Dict[str, List[Any]],
+    template: "Template",
+    tokenizer: "PreTrainedTokenizer",
+    processor: Optional["ProcessorMixin"],
+    data_args: "DataArguments",
+) -> Dict[str, List[Any]]:
+    # build packed rows with format `X1 Y1+ X1 Y1- X2 Y2+ X2 Y2-`, each row holds at most 2 * cutoff_len tokens
+    # the chosen and rejected sequences of the j-th pair in a row are marked as 2j+1 and 2j+2 in the attention mask
+    valid_num = 0
+    batch_pairs, batch_images, batch_videos = [], [], []
+    lengths = []
+    length2indexes = defaultdict(list)
+    for i in range(len(examples["_prompt"])):
+        if len(examples["_prompt"][i]) % 2 != 1 or len(examples["_response"][i]) < 2:
+            logger.warning_rank0(
+                "Dropped invalid example: {}".format(examples["_prompt"][i] + examples["_response"][i])
+            )
+            continue
+
+        chosen_input_ids, chosen_labels, rejected_input_ids, rejected_labels = _encode_pairwise_example(
+            prompt=examples["_prompt"][i],
+            response=examples["_response"][i],
+            system=examples["_system"][i],
+            tools=examples["_tools"][i],
+            images=examples["_images"][i] or [],
+            videos=examples["_videos"][i] or [],
+            template=template,
+            tokenizer=tokenizer,
+            processor=processor,
+            cutoff_len=data_args.cutoff_len - 1,  # reserved for the padding token
+        )
+        chosen_labels[0] = rejected_labels[0] = IGNORE_INDEX  # never predicted from the previous sequence
+        lengths.append(len(chosen_input_ids) + len(rejected_input_ids))
+        length2indexes[lengths[-1]].append(valid_num)
+        batch_pairs.append((chosen_input_ids, chosen_labels, rejected_input_ids, rejected_labels))
+        batch_images.append(examples["_images"][i] or [])
+        batch_videos.append(examples["_videos"][i] or [])
+        valid_num += 1
+
+    model_inputs = defaultdict(list)
+    row_len = 2 * data_args.cutoff_len
+    knapsacks = greedy_knapsack(lengths, row_len - 1)  # reserved for the padding token
+    for knapsack in knapsacks:
+        packed_input_ids, packed_attention_masks, packed_labels = [], [], []
+        packed_images, packed_videos = [], []
+        for j, length in enumerate(knapsack):
+            index = length2indexes[length].pop()
+            chosen_input_ids, chosen_labels, rejected_input_ids, rejected_labels = batch_pairs[index]
+            packed_input_ids += chosen_input_ids + rejected_input_ids
+            packed_labels += chosen_labels + rejected_labels
+            packed_attention_masks += [2 * j + 1] * len(chosen_input_ids) + [2 * j + 2] * len(rejected_input_ids)
+            packed_images += batch_images[index] * 2  # both sequences contain the multimodal tokens
+            packed_videos += batch_videos[index] * 2
+
+        pad_length = row_len - len(packed_input_ids)
+        packed_input_ids += [tokenizer.pad_token_id] * pad_length
+        packed_labels += [IGNORE_INDEX] * pad_length
+        packed_attention_masks += [0] * pad_length
+
+        model_inputs["input_ids"].append(packed_input_ids)
+        model_inputs["attention_mask"].append(packed_attention_masks)
+        model_inputs["labels"].append(packed_labels)
+        model_inputs["images"].append(packed_images or None)
+        model_inputs["videos"].append(packed_videos or None)
+
+    return model_inputs
+
+
 def print_pairwise_dataset_example(example: Dict[str, List[int]], tokenizer: "PreTrainedTokenizer") -> None:
+    if "prompt_length" in example:
+        example = expand_compact_pairwise_example(example)
+
     valid_chosen_labels = list(filter(lambda x: x != IGNORE_INDEX, example["chosen_labels"]))
     valid_rejected_labels = list(filter(lambda x: x != IGNORE_INDEX, example["rejected_labels"]))
     print("chosen_input_ids:\n{}".format(example["chosen_input_ids"]))
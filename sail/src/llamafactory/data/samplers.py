@@ -0,0 +1,387 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import torch
+from torch.utils.data import IterableDataset, Sampler
+
+from ..extras import logging
+from ..extras.constants import IGNORE_INDEX
+from .collator import _get_shared_prompt_length
+from .processors.pairwise import is_compact_pairwise_dataset, iter_pairwise_examples
+
+
+if TYPE_CHECKING:
+    from datasets import Dataset
+    from datasets import IterableDataset as HFIterableDataset
+
+
+logger = logging.get_logger(__name__)
+
+
+def get_pairwise_lengths(dataset: "Dataset") -> List[int]:
+    r"""
+    Returns the padded length of each pair, i.e., the longer one of the chosen and rejected sequences.
+    """
+    lengths = []
+    if is_compact_pairwise_dataset(dataset):  # read the lengths only
+        columns = ["prompt_length", "chosen_length", "rejected_length"]
+        for batch in dataset.select_columns(columns).iter(batch_size=1024):
+            for prompt_len, chosen_len, rejected_len in zip(*(batch[column] for column in columns)):
+                lengths.append(prompt_len + max(chosen_len, rejected_len))
+
+        return lengths
+
+    for batch in dataset.select_columns(["chosen_input_ids", "rejected_input_ids"]).iter(batch_size=1024):
+        for chosen_ids, rejected_ids in zip(batch["chosen_input_ids"], batch["rejected_input_ids"]):
+            lengths.append(max(len(chosen_ids), len(rejected_ids)))
+
+    return lengths
+
+
+def get_prompt_groups(dataset: "Dataset", label_pad_token_id: int = IGNORE_INDEX) -> List[List[int]]:
+    r"""
+    Groups the indices of the pairs sharing the same prompt, i.e., the masked prefix of the chosen and rejected.
+    """
+    groups: Dict[Tuple[int, ...], List[int]] = {}
+    for index, feature in enumerate(iter_pairwise_examples(dataset)):
+        prompt_len = _get_shared_prompt_length(feature, label_pad_token_id)
+        groups.setdefault(tuple(feature["chosen_input_ids"][:prompt_len]), []).append(index)
+
+    return list(groups.values())
+
+
+class _ResumableSampler:
+    r"""
+    Tracks the position in an epoch in units of a global order, which is the same for any number of processes.
+
+    The trainer counts the consumed batches of the current process, each of which advances the global position by
+    `_get_global_batch_size()` units. After `load_state_dict`, the next `set_epoch` keeps the saved epoch and the
+    iteration starts from the saved position instead of skipping the consumed batches one by one.
+    """
+
+    seed: int
+    rank: int
+    num_replicas: int
+
+    def _init_resumable_state(self) -> None:
+        self.epoch = 0
+        self.start_index = 0
+        self.num_consumed_batches = 0
+        self._epoch_offset = 0
+        self._resume_epoch: Optional[int] = None
+
+    def set_epoch(self, epoch: int) -> None:
+        if self._resume_epoch is not None:  # the first epoch after resuming starts from the saved position
+            self._epoch_offset = self._resume_epoch - epoch
+            self._resume_epoch = None
+        else:
+            self.start_index = 0
+
+        if epoch + self._epoch_offset != self.epoch:
+            self.epoch = epoch + self._epoch_offset
+            self._reset_epoch()
+
+    def _reset_epoch(self) -> None:
+        r"""
+        Clears the cached order of the previous epoch.
+        """
+
+    def _get_epoch_size(self) -> int:
+        raise NotImplementedError
+
+    def _get_global_batch_size(self) -> int:
+        raise NotImplementedError
+
+    def _get_start_index(self) -> int:
+        start_index = self.start_index - self.start_index % self._get_global_batch_size()
+        if start_index != self.start_index:
+            logger.warning_rank0(
+                f"Resuming position {self.start_index} is not aligned to the global batch size, "
+                f"start from {start_index} instead."
+            )
+
+        return start_index
+
+    def state_dict(self) -> Dict[str, Any]:
+        consumed = self._get_start_index() + self.num_consumed_batches * self._get_global_batch_size()
+        return {"seed": self.seed, "epoch": self.epoch, "consumed": min(consumed, self._get_epoch_size())}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        if state_dict["seed"] != self.seed:
+            logger.warning_rank0("The seed differs from the checkpoint, the data order will not be reproduced.")
+
+        self.epoch, self.start_index = state_dict["epoch"], state_dict["consumed"]
+        self._reset_epoch()
+        if self.start_index >= self._get_epoch_size():
+            self.epoch, self.start_index = self.epoch + 1, 0
+            self._reset_epoch()
+
+        self._resume_epoch = self.epoch
+
+
+class _GlobalBatchSampler(_ResumableSampler, Sampler[List[int]]):
+    r"""
+    Builds the batches of all processes in a global order and shards them across processes, all of which yield
+    the same number of batches. The position is counted in global batches.
+    """
+
+    _batches: Optional[List[List[int]]] = None
+
+    def _build_global_batches(self) -> List[List[int]]:
+        raise NotImplementedError
+
+    def _reset_epoch(self) -> None:
+        self._batches = None
+
+    def _get_batches(self) -> List[List[int]]:
+        if self._batches is None:
+            self._batches = self._build_global_batches()
+
+        return self._batches
+
+    def _get_epoch_size(self) -> int:
+        return len(self._get_batches())
+
+    def _get_global_batch_size(self) -> int:
+        return self.num_replicas
+
+    def __iter__(self) -> Iterator[List[int]]:
+        self.num_consumed_batches = 0
+        batches = self._get_batches()[self._get_start_index() :]
+        num_padding = -len(batches) % self.num_replicas  # keep the processes in step
+        batches = batches + [batches[i % len(batches)] for i in range(num_padding)]
+        yield from batches[self.rank :: self.num_replicas]
+
+    def __len__(self) -> int:
+        return -(-len(self._get_batches()) // self.num_replicas)
+
+
+class TokenBudgetBatchSampler(_GlobalBatchSampler):
+    r"""
+    Groups examples of similar lengths into batches whose padded size does not exceed the token budget.
+
+    The examples are shuffled, split into buckets of `bucket_size` and sorted by length within each bucket.
+    The batches are then shuffled and sharded across processes, all of which yield the same number of batches.
+    The padded size of a batch is `num_rows_per_example * batch_size * max_length`, e.g. two rows for pairs.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        max_tokens: int,
+        num_rows_per_example: int = 2,
+        bucket_size: int = 4096,
+        num_replicas: int = 1,
+        rank: int = 0,
+        shuffle: bool = True,
+        seed: int = 0,
+    ) -> None:
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.num_rows_per_example = num_rows_per_example
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self._init_resumable_state()
+
+    def _build_global_batches(self) -> List[List[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+        else:
+            indices = list(range(len(self.lengths)))
+
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(indices[start : start + self.bucket_size], key=lambda i: self.lengths[i], reverse=True)
+            batch, max_length = [], 0
+            for index in bucket:
+                new_max_length = max(max_length, self.lengths[index])
+                if len(batch) != 0 and new_max_length * (len(batch) + 1) * self.num_rows_per_example > self.max_tokens:
+                    batches.append(batch)
+                    batch, new_max_length = [], self.lengths[index]
+
+                batch.append(index)
+                max_length = new_max_length
+
+            if len(batch) != 0:
+                batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+        return batches
+
+
+class PromptGroupedBatchSampler(_GlobalBatchSampler):
+    r"""
+    Puts the pairs sharing a prompt into the same batch of at most `batch_size` pairs, so that the collator runs
+    each prompt once per batch.
+
+    The groups are shuffled and packed greedily into batches, the groups larger than `batch_size` are split.
+    """
+
+    def __init__(
+        self,
+        groups: Sequence[Sequence[int]],
+        batch_size: int,
+        num_replicas: int = 1,
+        rank: int = 0,
+        shuffle: bool = True,
+        seed: int = 0,
+    ) -> None:
+        self.groups = groups
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self._init_resumable_state()
+
+    def _build_global_batches(self) -> List[List[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            order = torch.randperm(len(self.groups), generator=generator).tolist()
+        else:
+            order = list(range(len(self.groups)))
+
+        batches, batch = [], []
+        for group_index in order:
+            group = list(self.groups[group_index])
+            for start in range(0, len(group), self.batch_size):
+                chunk = group[start : start + self.batch_size]
+                if len(batch) + len(chunk) > self.batch_size:
+                    batches.append(batch)
+                    batch = []
+
+                batch += chunk
+
+        if len(batch) != 0:
+            batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+        return batches
+
+
+class ResumableSampler(_ResumableSampler, Sampler[int]):
+    r"""
+    Shuffles the examples in a global order and splits each global batch of `batch_size * num_replicas` examples
+    into contiguous slices, one per process.
+
+    The position is counted in examples, so the data order does not depend on the number of processes as long as
+    the global batch size is unchanged. The last global batch is completed with the first examples.
+    """
+
+    def __init__(
+        self,
+        num_samples: int,
+        batch_size: int,
+        num_replicas: int = 1,
+        rank: int = 0,
+        shuffle: bool = True,
+        seed: int = 0,
+    ) -> None:
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self._init_resumable_state()
+
+    def _get_epoch_size(self) -> int:
+        return self.num_samples
+
+    def _get_global_batch_size(self) -> int:
+        return self.batch_size * self.num_replicas
+
+    def __iter__(self) -> Iterator[int]:
+        self.num_consumed_batches = 0
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.num_samples, generator=generator).tolist()
+        else:
+            indices = list(range(self.num_samples))
+
+        global_batch_size = self._get_global_batch_size()
+        indices = indices[self._get_start_index() :]
+        indices += [indices[i % len(indices)] for i in range(-len(indices) % global_batch_size)]
+        for start in range(0, len(indices), global_batch_size):
+            offset = start + self.rank * self.batch_size
+            yield from indices[offset : offset + self.batch_size]
+
+    def __len__(self) -> int:
+        return -(-self.num_samples // self._get_global_batch_size()) * self.batch_size
+
+
+class ResumableIterableDataset(IterableDataset):
+    r"""
+    Reads the global stream of a streaming dataset on each process and keeps the slice of each global batch.
+
+    The state of the stream is recorded after each global batch, so the position of the consumed batches can be
+    restored by `load_state_dict` of the dataset without reading the consumed examples. The last incomplete
+    global batch is dropped to keep the processes in step. Must be iterated in the main process.
+    """
+
+    def __init__(self, dataset: "HFIterableDataset", batch_size: int, num_replicas: int = 1, rank: int = 0) -> None:
+        if not hasattr(dataset, "state_dict"):
+            raise ValueError("Resuming streaming datasets requires `datasets>=2.18.0`.")
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_consumed_batches = 0
+        self._initial_state = dataset.state_dict()
+        self._dataset_state: Optional[Dict[str, Any]] = None
+        self._states: Dict[int, Dict[str, Any]] = {}
+
+    def set_epoch(self, epoch: int) -> None:
+        self.dataset.set_epoch(epoch)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        # the loaded state is kept by the dataset, thus the following epochs load the initial state
+        self.dataset.load_state_dict(self._dataset_state or self._initial_state)
+        self._dataset_state = None
+
+        self.num_consumed_batches = 0
+        self._states = {0: self.dataset.state_dict()}
+        global_batch_size = self.batch_size * self.num_replicas
+        global_batch, num_batches = [], 0
+        for example in self.dataset:
+            global_batch.append(example)
+            if len(global_batch) == global_batch_size:
+                num_batches += 1
+                self._states[num_batches] = self.dataset.state_dict()
+                for index in [index for index in self._states if index < self.num_consumed_batches]:
+                    self._states.pop(index)  # keep the states of the batches not consumed yet
+
+                offset = self.rank * self.batch_size
+                yield from global_batch[offset : offset + self.batch_size]
+                global_batch = []
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {"dataset": self._states.get(self.num_consumed_batches, self._dataset_state)}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        self._dataset_state = state_dict["dataset"]
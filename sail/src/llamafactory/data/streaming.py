@@ -0,0 +1,223 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import itertools
+import json
+import os
+import random
+from collections import defaultdict
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Literal, Optional, Sequence, Tuple
+
+from torch.utils.data import IterableDataset, get_worker_info
+from transformers.utils.versions import require_version
+
+from ..extras import logging
+from .aligner import convert_alpaca, convert_sharegpt
+from .parser import get_dataset_list
+from .preprocess import get_preprocess_and_print_func
+
+
+if TYPE_CHECKING:
+    from transformers import PreTrainedTokenizer, ProcessorMixin, Seq2SeqTrainingArguments
+
+    from ..hparams import DataArguments
+    from .parser import DatasetAttr
+    from .template import Template
+
+
+logger = logging.get_logger(__name__)
+
+
+SHARD_EXTENSIONS = (".jsonl", ".jsonl.zst")
+
+
+def _get_shard_files(dataset_attr: "DatasetAttr", dataset_dir: str) -> List[str]:
+    r"""
+    Lists the JSONL shards of a local dataset in a fixed order, which should be the same on all the nodes.
+    """
+    if dataset_attr.load_from != "file":
+        raise ValueError(f"`sharded_streaming` only reads local files, got dataset {dataset_attr}.")
+
+    if dataset_attr.num_samples is not None:
+        raise ValueError("`num_samples` is incompatible with `sharded_streaming`.")
+
+    local_path = os.path.join(dataset_dir, dataset_attr.dataset_name)
+    if os.path.isdir(local_path):
+        file_paths = [os.path.join(local_path, file_name) for file_name in sorted(os.listdir(local_path))]
+    elif os.path.isfile(local_path):
+        file_paths = [local_path]
+    else:
+        raise ValueError(f"File {local_path} not found.")
+
+    if not all(file_path.endswith(SHARD_EXTENSIONS) for file_path in file_paths):
+        raise ValueError("Allowed file types for `sharded_streaming`: {}.".format(",".join(SHARD_EXTENSIONS)))
+
+    return file_paths
+
+
+def _read_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    r"""
+    Reads the records of a JSONL file line by line, the zstd-compressed file is decompressed as a stream.
+    """
+    with open(path, "rb") as f:
+        if path.endswith(".zst"):
+            import zstandard  # type: ignore
+
+            stream = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(f), encoding="utf-8")
+        else:
+            stream = io.TextIOWrapper(f, encoding="utf-8")
+
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _get_length(row: Dict[str, Any]) -> int:
+    r"""
+    Returns the padded length of a tokenized example, i.e., the longer one of the chosen and rejected sequences.
+    """
+    if "prompt_length" in row:  # compact pairwise data
+        return row["prompt_length"] + max(row["chosen_length"], row["rejected_length"])
+
+    if "chosen_input_ids" in row:
+        return max(len(row["chosen_input_ids"]), len(row["rejected_input_ids"]))
+
+    return len(row["input_ids"])
+
+
+class ShardedJsonlDataset(IterableDataset):
+    r"""
+    Reads the JSONL shards of local datasets and tokenizes the examples on the fly in the dataloader workers.
+
+    Each process and worker reads a disjoint subset of the shards, which is reassigned in each pass over the data.
+    The tokenized examples are buffered, sorted by length and yielded in chunks of `batch_size` in a random order,
+    so that the examples in a batch have similar lengths. The stream repeats the shards in a new order after each
+    pass, thus the processes never run out of data at different steps and the training length is set by `max_steps`.
+    """
+
+    def __init__(
+        self,
+        shards: Sequence[Tuple["DatasetAttr", str]],
+        preprocess_func: Callable[[Dict[str, List[Any]]], Dict[str, List[Any]]],
+        data_args: "DataArguments",
+        batch_size: int,
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 0,
+    ) -> None:
+        if len(shards) < num_replicas:
+            raise ValueError(f"Found {len(shards)} shards, `sharded_streaming` requires one shard per process.")
+
+        if any(path.endswith(".zst") for _, path in shards):
+            require_version("zstandard", "To fix: pip install zstandard")
+
+        self.shards = list(shards)
+        self.preprocess_func = preprocess_func
+        self.data_args = data_args
+        self.batch_size = batch_size
+        self.buffer_size = max(data_args.buffer_size // batch_size, 1) * batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _get_shards(self, pass_index: int) -> List[Tuple["DatasetAttr", str]]:
+        shards = self.shards[:]
+        random.Random(self.seed + pass_index).shuffle(shards)
+        return shards
+
+    def _align(self, record: Dict[str, Any], dataset_attr: "DatasetAttr") -> Dict[str, Any]:
+        convert_func = convert_alpaca if dataset_attr.formatting == "alpaca" else convert_sharegpt
+        return convert_func(defaultdict(type(None), record), dataset_attr=dataset_attr, data_args=self.data_args)
+
+    def _tokenize(self, examples: List[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+        outputs = self.preprocess_func({key: [example[key] for example in examples] for key in examples[0].keys()})
+        for values in zip(*outputs.values()):
+            yield dict(zip(outputs.keys(), values))
+
+    def _read_rows(self, shards: List[Tuple["DatasetAttr", str]]) -> Iterator[Dict[str, Any]]:
+        examples = []
+        for dataset_attr, path in shards:
+            for record in _read_jsonl(path):
+                examples.append(self._align(record, dataset_attr))
+                if len(examples) == self.data_args.preprocessing_batch_size:
+                    yield from self._tokenize(examples)
+                    examples = []
+
+        if len(examples) != 0:
+            yield from self._tokenize(examples)
+
+    def _flush(self, buffer: List[Dict[str, Any]], rng: "random.Random") -> Iterator[Dict[str, Any]]:
+        buffer.sort(key=_get_length)
+        chunks = [buffer[i : i + self.batch_size] for i in range(0, len(buffer), self.batch_size)]
+        rng.shuffle(chunks)
+        for chunk in chunks:
+            yield from chunk
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        worker_info = get_worker_info()
+        num_workers, worker_id = (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id)
+        # the first workers of all the processes come first, so each process reads one shard at least
+        num_readers, reader_index = self.num_replicas * num_workers, worker_id * self.num_replicas + self.rank
+        if reader_index >= len(self.shards):  # an idle worker
+            return
+
+        rng = random.Random(self.seed + self.epoch * num_readers + reader_index)
+        buffer = []
+        for pass_index in itertools.count(self.epoch):
+            num_rows = 0
+            for row in self._read_rows(self._get_shards(pass_index)[reader_index::num_readers]):
+                num_rows += 1
+                buffer.append(row)
+                if len(buffer) == self.buffer_size:  # the chunks are full batches
+                    yield from self._flush(buffer, rng)
+                    buffer = []
+
+            if num_rows == 0:
+                raise RuntimeError("Cannot find valid samples, check `data/README.md` for the data format.")
+
+
+def get_sharded_stream_dataset(
+    template: "Template",
+    data_args: "DataArguments",
+    training_args: "Seq2SeqTrainingArguments",
+    stage: Literal["pt", "sft", "rm", "ppo", "kto"],
+    tokenizer: "PreTrainedTokenizer",
+    processor: Optional["ProcessorMixin"] = None,
+) -> "ShardedJsonlDataset":
+    r"""
+    Gets the train dataset read from the shards of `dataset` by each process, without loading the whole datasets.
+    """
+    shards = []
+    for dataset_attr in get_dataset_list(data_args.dataset, data_args.dataset_dir):
+        if (stage == "rm" and dataset_attr.ranking is False) or (stage != "rm" and dataset_attr.ranking is True):
+            raise ValueError("The dataset is not applicable in the current training stage.")
+
+        shards += [(dataset_attr, path) for path in _get_shard_files(dataset_attr, data_args.dataset_dir)]
+
+    preprocess_func, _ = get_preprocess_and_print_func(data_args, stage, template, tokenizer, processor)
+    logger.info_rank0(f"Streaming {len(shards)} shards across {training_args.world_size} processes.")
+    return ShardedJsonlDataset(
+        shards,
+        preprocess_func,
+        data_args,
+        batch_size=training_args.per_device_train_batch_size,
+        num_replicas=training_args.world_size,
+        rank=training_args.process_index,
+        seed=training_args.data_seed if training_args.data_seed is not None else training_args.seed,
+    )
@@ -14,6 +14,7 @@
 
 from dataclasses import dataclass
 from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple, Union
+from weakref import WeakKeyDictionary
 
 from transformers.utils.versions import require_version
 from typing_extensions import override
@@ -35,6 +36,17 @@ if TYPE_CHECKING:
 logger = logging.get_logger(__name__)
 
 
+_SLOT_IDS_CACHE: "WeakKeyDictionary[PreTrainedTokenizer, Dict[str, List[int]]]" = WeakKeyDictionary()
+_SINGLE_PASS_CACHE: "WeakKeyDictionary[PreTrainedTokenizer, Dict[int, bool]]" = WeakKeyDictionary()
+_SINGLE_PASS_PROBE_SYSTEM = "You are a helpful assistant."
+_SINGLE_PASS_PROBE_MESSAGES = [
+    {"role": Role.USER.value, "content": "Hello, world! What's 1 + 1?"},
+    {"role": Role.ASSISTANT.value, "content": " It's 2.\n\nAnything else? "},
+    {"role": Role.USER.value, "content": "\n你好，Write a `print` call.\n"},
+    {"role": Role.ASSISTANT.value, "content": "print('hi')"},
+]
+
+
 @dataclass
 class Template:
     format_user: "Formatter"
@@ -51,6 +63,7 @@ class Template:
     replace_eos: bool
     replace_jinja_template: bool
     mm_plugin: "BasePlugin"
+    single_pass: bool = False
 
     def encode_oneturn(
         self,
@@ -83,6 +96,28 @@ class Template:
         encoded_messages = self._encode(tokenizer, messages, system, tools)
         return [(encoded_messages[i], encoded_messages[i + 1]) for i in range(0, len(encoded_messages), 2)]
 
+    def encode_pairwise(
+        self,
+        tokenizer: "PreTrainedTokenizer",
+        prompt: Sequence[Dict[str, str]],
+        responses: Sequence[Dict[str, str]],
+        system: Optional[str] = None,
+        tools: Optional[str] = None,
+    ) -> Tuple[List[int], List[List[int]]]:
+        r"""
+        Returns the token ids of the prompt and of each response, the prompt is encoded once for all responses.
+
+        Same as calling `encode_oneturn` with `prompt + [response]` for each response.
+        """
+        system = system or self.default_system
+        indexed_messages = list(enumerate(prompt)) + [(len(prompt), response) for response in responses]
+        encoded_messages = self._encode_messages(tokenizer, indexed_messages, system, tools)
+        prompt_ids = []
+        for encoded_ids in encoded_messages[: len(prompt)]:
+            prompt_ids += encoded_ids
+
+        return prompt_ids, encoded_messages[len(prompt) :]
+
     def extract_tool(self, content: str) -> Union[str, List[Tuple[str, str]]]:
         r"""
         Extracts tool message.
@@ -102,42 +137,86 @@ class Template:
         Turn t: sep + query                    resp
         """
         system = system or self.default_system
-        encoded_messages = []
-        for i, message in enumerate(messages):
-            elements = []
-
-            if i == 0:
-                elements += self.format_prefix.apply()
-                if system or tools:
-                    tool_text = self.format_tools.apply(content=tools)[0] if tools else ""
-                    elements += self.format_system.apply(content=(system + tool_text))
-
-            if i > 0 and i % 2 == 0:
-                elements += self.format_separator.apply()
-
-            if message["role"] == Role.USER.value:
-                elements += self.format_user.apply(content=message["content"], idx=str(i // 2))
-            elif message["role"] == Role.ASSISTANT.value:
-                elements += self.format_assistant.apply(content=message["content"])
-            elif message["role"] == Role.OBSERVATION.value:
-                elements += self.format_observation.apply(content=message["content"])
-            elif message["role"] == Role.FUNCTION.value:
-                elements += self.format_function.apply(content=message["content"])
-            else:
-                raise NotImplementedError("Unexpected role: {}".format(message["role"]))
+        return self._encode_messages(tokenizer, list(enumerate(messages)), system, tools)
+
+    def _encode_messages(
+        self,
+        tokenizer: "PreTrainedTokenizer",
+        indexed_messages: Sequence[Tuple[int, Dict[str, str]]],
+        system: str,
+        tools: Optional[str],
+    ) -> List[List[int]]:
+        r"""
+        Encodes the messages at the given indices, with one tokenizer call if `single_pass` is enabled.
+        """
+        elements_list = [self._get_message_elements(i, message, system, tools) for i, message in indexed_messages]
+        if self.single_pass and self._is_single_pass_supported(tokenizer):
+            return self._convert_elements_to_ids_single_pass(tokenizer, elements_list)
 
-            encoded_messages.append(self._convert_elements_to_ids(tokenizer, elements))
+        return [self._convert_elements_to_ids(tokenizer, elements) for elements in elements_list]
 
-        return encoded_messages
+    def _get_message_elements(self, i: int, message: Dict[str, str], system: str, tools: Optional[str]) -> "SLOTS":
+        r"""
+        Formats the i-th message to elements, which depend on the other messages only through its index.
+        """
+        elements = []
+        if i == 0:
+            elements += self.format_prefix.apply()
+            if system or tools:
+                tool_text = self.format_tools.apply(content=tools)[0] if tools else ""
+                elements += self.format_system.apply(content=(system + tool_text))
+
+        if i > 0 and i % 2 == 0:
+            elements += self.format_separator.apply()
+
+        if message["role"] == Role.USER.value:
+            elements += self.format_user.apply(content=message["content"], idx=str(i // 2))
+        elif message["role"] == Role.ASSISTANT.value:
+            elements += self.format_assistant.apply(content=message["content"])
+        elif message["role"] == Role.OBSERVATION.value:
+            elements += self.format_observation.apply(content=message["content"])
+        elif message["role"] == Role.FUNCTION.value:
+            elements += self.format_function.apply(content=message["content"])
+        else:
+            raise NotImplementedError("Unexpected role: {}".format(message["role"]))
+
+        return elements
+
+    def _get_slot_ids(self, tokenizer: "PreTrainedTokenizer") -> Dict[str, List[int]]:
+        r"""
+        Returns the token ids of the constant string slots (e.g. prefix, separators), encoded once per tokenizer.
+        """
+        slot_ids = _SLOT_IDS_CACHE.get(tokenizer)
+        if slot_ids is None:
+            slot_ids = _SLOT_IDS_CACHE[tokenizer] = {}
+
+        for formatter in (
+            self.format_user,
+            self.format_assistant,
+            self.format_system,
+            self.format_function,
+            self.format_observation,
+            self.format_tools,
+            self.format_separator,
+            self.format_prefix,
+        ):
+            for slot in formatter.slots:
+                if isinstance(slot, str) and len(slot) != 0 and "{{" not in slot and slot not in slot_ids:
+                    slot_ids[slot] = tokenizer.encode(slot, add_special_tokens=False)
+
+        return slot_ids
 
     def _convert_elements_to_ids(self, tokenizer: "PreTrainedTokenizer", elements: "SLOTS") -> List[int]:
         r"""
         Converts elements to token ids.
         """
+        slot_ids = self._get_slot_ids(tokenizer)
         token_ids = []
         for elem in elements:
             if isinstance(elem, str):
-                if len(elem) != 0:
+                if elem in slot_ids:
+                    token_ids += slot_ids[elem]
+                elif len(elem) != 0:
                     token_ids += tokenizer.encode(elem, add_special_tokens=False)
             elif isinstance(elem, dict):
                 token_ids += [tokenizer.convert_tokens_to_ids(elem.get("token"))]
@@ -151,51 +230,127 @@ class Template:
 
         return token_ids
 
+    def _convert_elements_to_ids_single_pass(
+        self, tokenizer: "PreTrainedTokenizer", elements_list: Sequence["SLOTS"]
+    ) -> List[List[int]]:
+        r"""
+        Converts the elements of several messages to token ids with one call of the fast tokenizer.
+
+        The consecutive strings of a message are joined and tokenized together, the boundaries between them are
+        located by the character offsets. If a token does not end at a boundary, i.e., it was merged across two
+        strings, the strings fall back to `_convert_elements_to_ids`.
+        """
+        text_groups: List[List[str]] = []
+        message_parts: List[List[Union[int, "SLOTS"]]] = []  # text index or a non-string element
+        for elements in elements_list:
+            parts = []
+            for elem in elements:
+                if isinstance(elem, str):
+                    if len(elem) == 0:
+                        continue
+
+                    if len(parts) != 0 and isinstance(parts[-1], int):
+                        text_groups[parts[-1]].append(elem)
+                    else:
+                        parts.append(len(text_groups))
+                        text_groups.append([elem])
+                else:
+                    parts.append([elem])
+
+            message_parts.append(parts)
+
+        texts: List[str] = ["".join(group) for group in text_groups]
+        encodings = (
+            tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True) if len(texts) != 0 else None
+        )
+        encoded_messages = []
+        for parts in message_parts:
+            token_ids = []
+            for part in parts:
+                if not isinstance(part, int):
+                    token_ids += self._convert_elements_to_ids(tokenizer, part)
+                elif _is_aligned(encodings["offset_mapping"][part], text_groups[part]):
+                    token_ids += encodings["input_ids"][part]
+                else:
+                    token_ids += self._convert_elements_to_ids(tokenizer, text_groups[part])
+
+            encoded_messages.append(token_ids)
+
+        return encoded_messages
+
+    def _is_single_pass_supported(self, tokenizer: "PreTrainedTokenizer") -> bool:
+        r"""
+        Checks once per tokenizer if the single-pass encoding of this template matches the slot-based one,
+        e.g. it does not for tokenizers adding a prefix space to each encoded string.
+        """
+        results = _SINGLE_PASS_CACHE.get(tokenizer)
+        if results is None:
+            results = _SINGLE_PASS_CACHE[tokenizer] = {}
+
+        if id(self) in results:
+            return results[id(self)]
+
+        if not getattr(tokenizer, "is_fast", False):
+            logger.warning_rank0("Single-pass tokenization requires a fast tokenizer, using the slot-based one.")
+            supported = False
+        else:
+            elements_list = [
+                self._get_message_elements(i, message, _SINGLE_PASS_PROBE_SYSTEM, None)
+                for i, message in enumerate(_SINGLE_PASS_PROBE_MESSAGES)
+            ]
+            expected = [self._convert_elements_to_ids(tokenizer, elements) for elements in elements_list]
+            supported = self._convert_elements_to_ids_single_pass(tokenizer, elements_list) == expected
+            if not supported:
+                logger.warning_rank0("Single-pass tokenization does not match the template, using the slot-based one.")
+
+        results[id(self)] = supported
+        return supported
+
 
 @dataclass
 class Llama2Template(Template):
     @override
-    def _encode(
-        self,
-        tokenizer: "PreTrainedTokenizer",
-        messages: Sequence[Dict[str, str]],
-        system: str,
-        tools: str,
-    ) -> List[List[int]]:
+    def _get_message_elements(self, i: int, message: Dict[str, str], system: str, tools: Optional[str]) -> "SLOTS":
         r"""
-        Encodes formatted inputs to pairs of token ids.
-        Turn 0: prefix + system + query        resp
-        Turn t: sep + query                    resp
+        Formats the i-th message to elements, the system text is merged into the first user message.
         """
-        system = system or self.default_system
-        encoded_messages = []
-        for i, message in enumerate(messages):
-            elements = []
-
-            system_text = ""
-            if i == 0:
-                elements += self.format_prefix.apply()
-                if system or tools:
-                    tool_text = self.format_tools.apply(content=tools)[0] if tools else ""
-                    system_text = self.format_system.apply(content=(system + tool_text))[0]
-
-            if i > 0 and i % 2 == 0:
-                elements += self.format_separator.apply()
-
-            if message["role"] == Role.USER.value:
-                elements += self.format_user.apply(content=system_text + message["content"])
-            elif message["role"] == Role.ASSISTANT.value:
-                elements += self.format_assistant.apply(content=message["content"])
-            elif message["role"] == Role.OBSERVATION.value:
-                elements += self.format_observation.apply(content=message["content"])
-            elif message["role"] == Role.FUNCTION.value:
-                elements += self.format_function.apply(content=message["content"])
-            else:
-                raise NotImplementedError("Unexpected role: {}".format(message["role"]))
-
-            encoded_messages.append(self._convert_elements_to_ids(tokenizer, elements))
+        elements = []
+        system_text = ""
+        if i == 0:
+            elements += self.format_prefix.apply()
+            if system or tools:
+                tool_text = self.format_tools.apply(content=tools)[0] if tools else ""
+                system_text = self.format_system.apply(content=(system + tool_text))[0]
+
+        if i > 0 and i % 2 == 0:
+            elements += self.format_separator.apply()
+
+        if message["role"] == Role.USER.value:
+            elements += self.format_user.apply(content=system_text + message["content"])
+        elif message["role"] == Role.ASSISTANT.value:
+            elements += self.format_assistant.apply(content=message["content"])
+        elif message["role"] == Role.OBSERVATION.value:
+            elements += self.format_observation.apply(content=message["content"])
+        elif message["role"] == Role.FUNCTION.value:
+            elements += self.format_function.apply(content=message["content"])
+        else:
+            raise NotImplementedError("Unexpected role: {}".format(message["role"]))
+
+        return elements
+
+
+def _is_aligned(offsets: Sequence[Tuple[int, int]], strings: Sequence[str]) -> bool:
+    r"""
+    Checks if every boundary between the joined strings is the end of a token and is not crossed by any token.
+    """
+    boundaries, position = set(), 0
+    for string in strings[:-1]:
+        position += len(string)
+        boundaries.add(position)
 
-        return encoded_messages
+    token_ends = {end for _, end in offsets}
+    crossed = any(start < boundary < end for start, end in offsets for boundary in boundaries)
+    return boundaries.issubset(token_ends) and not crossed
 
 
 TEMPLATES: Dict[str, "Template"] = {}
@@ -375,6 +530,7 @@ def get_template_and_fix_tokenizer(tokenizer: "PreTrainedTokenizer", data_args:
         template.format_function = FunctionFormatter(slots=eos_slots, tool_format=data_args.tool_format)
         template.format_tools = ToolFormatter(tool_format=data_args.tool_format)
 
+    template.single_pass = data_args.single_pass_tokenization
     stop_words = template.stop_words
     if template.replace_eos:
         if not stop_words:
@@ -94,6 +94,8 @@ SUPPORTED_CLASS_FOR_BLOCK_DIAG_ATTN = {
     "starcoder2",
 }
 
+SUPPORTED_CLASS_FOR_FROZEN_PREFIX = {"llama", "mistral", "qwen2"}
+
 SUPPORTED_CLASS_FOR_S2ATTN = {"llama"}
 
 VIDEO_PLACEHOLDER = os.environ.get("VIDEO_PLACEHOLDER", "<video>")
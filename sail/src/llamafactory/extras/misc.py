@@ -95,6 +95,8 @@ def calculate_tps(dataset: Sequence[Dict[str, Any]], metrics: Dict[str, float],
     for data in dataset:
         if stage == "sft":
             effective_token_num += len(data["input_ids"])
+        elif stage == "rm" and "prompt_length" in data:  # compact pairwise data
+            effective_token_num += len(data["input_ids"]) + data["prompt_length"]
         elif stage == "rm":
             effective_token_num += len(data["chosen_input_ids"]) + len(data["rejected_input_ids"])
 
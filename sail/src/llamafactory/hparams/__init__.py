@@ -12,20 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from .benchmark_args import BenchmarkArguments
 from .data_args import DataArguments
 from .evaluation_args import EvaluationArguments
 from .finetuning_args import FinetuningArguments
 from .generating_args import GeneratingArguments
 from .model_args import ModelArguments
-from .parser import get_eval_args, get_infer_args, get_train_args
+from .parser import get_bench_args, get_eval_args, get_infer_args, get_train_args
 
 
 __all__ = [
+    "BenchmarkArguments",
     "DataArguments",
     "EvaluationArguments",
     "FinetuningArguments",
     "GeneratingArguments",
     "ModelArguments",
+    "get_bench_args",
     "get_eval_args",
     "get_infer_args",
     "get_train_args",
@@ -0,0 +1,97 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from dataclasses import dataclass, field
+from typing import List
+
+
+@dataclass
+class BenchmarkArguments:
+    r"""
+    Arguments pertaining to the SAIL training step benchmark on a tiny randomly-initialized model.
+    """
+
+    output_path: str = field(
+        default="sail_benchmark.json",
+        metadata={"help": "Path to save the benchmark results in JSON format."},
+    )
+    cutoff_lens: str = field(
+        default="256,1024",
+        metadata={"help": "Sequence lengths to benchmark, separated by commas."},
+    )
+    batch_sizes: str = field(
+        default="1,4",
+        metadata={"help": "Number of pairs per batch to benchmark, separated by commas."},
+    )
+    vocab_sizes: str = field(
+        default="32000",
+        metadata={"help": "Vocabulary sizes to benchmark, separated by commas."},
+    )
+    lora_layer_ranges: str = field(
+        default="2-3",
+        metadata={"help": "Values of `lora_layer_range` to benchmark, separated by semicolons, e.g. `0-3;2,3`."},
+    )
+    pref_losses: str = field(
+        default="sigmoid",
+        metadata={"help": "Values of `pref_loss` to benchmark, separated by commas."},
+    )
+    hidden_size: int = field(
+        default=256,
+        metadata={"help": "The hidden size of the tiny model."},
+    )
+    intermediate_size: int = field(
+        default=688,
+        metadata={"help": "The intermediate size of the tiny model."},
+    )
+    num_hidden_layers: int = field(
+        default=4,
+        metadata={"help": "The number of decoder layers of the tiny model."},
+    )
+    num_attention_heads: int = field(
+        default=4,
+        metadata={"help": "The number of attention heads of the tiny model."},
+    )
+    lora_rank: int = field(
+        default=8,
+        metadata={"help": "The intrinsic dimension for LoRA fine-tuning."},
+    )
+    warmup_steps: int = field(
+        default=1,
+        metadata={"help": "Number of untimed steps before the measurement."},
+    )
+    num_steps: int = field(
+        default=3,
+        metadata={"help": "Number of timed steps, the phase timings are averaged over them."},
+    )
+    use_cpu: bool = field(
+        default=True,
+        metadata={"help": "Whether or not to run the benchmark on CPU even if accelerators are available."},
+    )
+    seed: int = field(
+        default=42,
+        metadata={"help": "Random seed to initialize the models and the inputs."},
+    )
+
+    def __post_init__(self):
+        def split_arg(arg: str, sep: str = ",") -> List[str]:
+            return [item.strip() for item in arg.split(sep) if item.strip()]
+
+        self.cutoff_lens: List[int] = [int(item) for item in split_arg(self.cutoff_lens)]
+        self.batch_sizes: List[int] = [int(item) for item in split_arg(self.batch_sizes)]
+        self.vocab_sizes: List[int] = [int(item) for item in split_arg(self.vocab_sizes)]
+        self.lora_layer_ranges: List[str] = split_arg(self.lora_layer_ranges, sep=";")
+        self.pref_losses: List[str] = split_arg(self.pref_losses)
+
+        if self.num_steps <= 0:
+            raise ValueError("`num_steps` should be a positive integer.")
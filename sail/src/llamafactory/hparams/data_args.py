@@ -65,6 +65,15 @@ class DataArguments:
         default=16384,
         metadata={"help": "Size of the buffer to randomly sample examples from in dataset streaming."},
     )
+    sharded_streaming: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether or not to stream the JSONL (or zstd-compressed JSONL) shards of the local train datasets, "
+                "each process and dataloader worker reads a disjoint subset of the shards and tokenizes on the fly."
+            )
+        },
+    )
     mix_strategy: Literal["concat", "interleave_under", "interleave_over"] = field(
         default="concat",
         metadata={"help": "Strategy to use in dataset mixing (concat/interleave) (undersampling/oversampling)."},
@@ -109,10 +118,28 @@ class DataArguments:
         default=False,
         metadata={"help": "Enable sequence packing without cross-attention."},
     )
+    compact_pairwise: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether or not to store each tokenized pair as the int32 token ids of `prompt + chosen + rejected` "
+                "with the segment lengths, the attention masks and labels are built by the data collator."
+            )
+        },
+    )
     tool_format: Optional[str] = field(
         default=None,
         metadata={"help": "Tool format to use for constructing function calling examples."},
     )
+    single_pass_tokenization: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether or not to tokenize the formatted messages with one call of the fast tokenizer, "
+                "falling back to the slot-based encoding where tokens would be merged across slots."
+            )
+        },
+    )
     tokenized_path: Optional[str] = field(
         default=None,
         metadata={
@@ -124,6 +151,17 @@ class DataArguments:
         },
     )
 
+    preprocessing_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Directory of the tokenized datasets cached by the hash of the raw data files, dataset attributes, "
+                "template, tokenizer and preprocessing arguments. A cached dataset is memory-mapped, otherwise the "
+                "dataset is tokenized, cached and used in the same run."
+            )
+        },
+    )
+
     def __post_init__(self):
         def split_arg(arg):
             if isinstance(arg, str):
@@ -153,11 +191,27 @@ class DataArguments:
             if self.eval_dataset is not None and len(self.eval_dataset) != len(self.interleave_probs):
                 raise ValueError("The length of eval dataset and interleave probs should be identical.")
 
+        if self.compact_pairwise and (self.packing or self.neat_packing):
+            raise ValueError("`compact_pairwise` is incompatible with `packing` and `neat_packing`.")
+
+        if self.preprocessing_cache_dir is not None and (self.streaming or self.tokenized_path is not None):
+            raise ValueError("`preprocessing_cache_dir` is incompatible with `streaming` and `tokenized_path`.")
+
         if self.streaming and self.val_size > 1e-6 and self.val_size < 1:
             raise ValueError("Streaming mode should have an integer val size.")
 
         if self.streaming and self.max_samples is not None:
             raise ValueError("`max_samples` is incompatible with `streaming`.")
 
+        if self.sharded_streaming:
+            if not self.streaming:
+                raise ValueError("`sharded_streaming` requires `streaming` is True.")
+
+            if self.val_size > 1e-6 or self.packing or self.interleave_probs is not None:
+                raise ValueError("`sharded_streaming` is incompatible with `val_size`, `packing` and interleaving.")
+
+            if self.tokenized_path is not None:
+                raise ValueError("`sharded_streaming` is incompatible with `tokenized_path`.")
+
         if self.mask_history and self.train_on_prompt:
             raise ValueError("`mask_history` is incompatible with `train_on_prompt`.")
@@ -222,6 +222,35 @@ class RLHFArguments:
         default=None,
         metadata={"help": "max_prompt_length"},
     )
+    pref_response_logits_only: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether or not to project only the hidden states of the response tokens to the vocabulary "
+                "in pairwise training. The logged `logits/chosen` and `logits/rejected` are then averaged over "
+                "the response tokens instead of all the tokens."
+            )
+        },
+    )
+    pref_logps_chunk_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Number of tokens per chunk to fuse the output layer and the log-softmax in pairwise training, "
+                "which avoids materializing the full-vocabulary logits. Disabled if None."
+            )
+        },
+    )
+    pref_max_batch_tokens: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Maximum number of padded tokens in a pairwise training batch, including both chosen and "
+                "rejected rows. Batches are formed from examples of similar lengths under this budget "
+                "instead of `per_device_train_batch_size`. Disabled if None."
+            )
+        },
+    )
     sail_alpha: float = field(
         default=0.5,
         metadata={"help": "The alpha parameter in the sail loss."},
@@ -230,6 +259,163 @@ class RLHFArguments:
         default=None,
         metadata={"help": "Path to the reward model used for the SAIL training."},
     )
+    sail_reward_model_adapters: Optional[str] = field(
+        default=None,
+        metadata={"help": "Path to the adapters of the reward model used for the SAIL training."},
+    )
+    sail_reward_model_quantization_bit: Optional[int] = field(
+        default=None,
+        metadata={"help": "The number of bits to quantize the reward model used for the SAIL training."},
+    )
+    sail_reward_model_dtype: Literal["auto", "float16", "bfloat16", "float32"] = field(
+        default="auto",
+        metadata={"help": "Data type of the reward model used for the SAIL training, same as the policy if `auto`."},
+    )
+    sail_reward_model_device: str = field(
+        default="auto",
+        metadata={
+            "help": (
+                "Placement of the reward model used for the SAIL training: `auto` (same as the policy), `cpu`, "
+                "`offload` (weights in CPU memory, executed on the GPU layer by layer) or a device, e.g. `cuda:1`."
+            )
+        },
+    )
+    sail_ref_model_device: str = field(
+        default="auto",
+        metadata={
+            "help": (
+                "Placement of the standalone reference model used for the SAIL training, with the same choices as "
+                "`sail_reward_model_device`."
+            )
+        },
+    )
+    sail_reward_model_type: Literal["full", "lora"] = field(
+        default="full",
+        metadata={
+            "help": (
+                "The type of the reward model in SAIL training. LoRA reward model is loaded as a frozen adapter "
+                "of the policy model, and scored together with the reference model in one forward pass."
+            )
+        },
+    )
+    sail_logps_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Path to the cache of the frozen log probabilities in SAIL training. "
+                "Written by the `sail_precompute` stage and read by the `sail` stage."
+            )
+        },
+    )
+    sail_detach_frozen_prefix: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether or not to cut the autograd graph at the first layer of `lora_layer_range`, "
+                "so that the frozen layers below are neither checkpointed nor back-propagated."
+            )
+        },
+    )
+    sail_shared_prompt: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether or not to run the prompt of each pair once and evaluate the chosen and rejected "
+                "responses against its KV cache in SAIL training. The gradients flow through the KV cache, "
+                "thus it requires `disable_gradient_checkpointing` and keeps the activations of all the layers, "
+                "which only saves memory for long prompts with short responses. FlashAttention-2 is unsupported."
+            )
+        },
+    )
+    sail_group_by_prompt: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether or not to put the pairs sharing a prompt into the same training batch, so that the "
+                "prompt is run once per batch by the policy, reference and reward models. "
+                "Requires `sail_shared_prompt`."
+            )
+        },
+    )
+    sail_share_frozen_prefix: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether or not to run the layers below `lora_layer_range` once per batch, "
+                "and share their hidden states between the policy and the adapter-disabled reference model. "
+                "A `ref_model` other than the base model of the policy runs all the layers on its own."
+            )
+        },
+    )
+    sail_padding_free: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether or not to concatenate the sequences of each micro-batch into one row without padding, "
+                "which runs through varlen FlashAttention-2 or a block-diagonal attention mask in SAIL training."
+            )
+        },
+    )
+    sail_split_pair: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether or not to run the chosen and rejected halves of the policy model as separate forward "
+                "passes, first without gradients to compute the loss, then with gradients one at a time for the "
+                "backward pass, which halves peak activations at the cost of an extra forward pass. "
+                "Supports DDP and FSDP, but not DeepSpeed."
+            )
+        },
+    )
+    sail_prefetch_batches: int = field(
+        default=0,
+        metadata={
+            "help": (
+                "Number of batches whose reference and reward log probabilities are computed ahead "
+                "in a background thread while the policy model trains. Disabled if 0."
+            )
+        },
+    )
+    sail_sweep_grid: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Path to a JSON/YAML file or a JSON string of the SAIL sweep grid, which maps `lora_layer_range`, "
+                "`sail_alpha` or `pref_beta` to lists of values. Each config is trained in a subdirectory of "
+                "`output_dir`, sharing the tokenized dataset and the frozen-model computation."
+            )
+        },
+    )
+    sail_async_checkpoint: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether or not to save the checkpoints with only the trainable parameters and their optimizer "
+                "states, which are copied to host memory and written in a background thread on each process."
+            )
+        },
+    )
+    sail_fast_resume: bool = field(
+        default=False,
+        metadata={
+            "help": (
+                "Whether or not to save the data position in the checkpoints and resume from it directly, "
+                "instead of iterating over the consumed batches. The data order does not depend on the number "
+                "of processes as long as the global batch size is unchanged."
+            )
+        },
+    )
+    sail_adapters: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": (
+                "Path to a JSON/YAML file or a JSON string of a list of SAIL adapter configs, each setting "
+                "`sail_alpha`, `pref_beta`, `lora_rank`, `lora_alpha` or `learning_rate` of one LoRA adapter. "
+                "The adapters are trained concurrently on one base model, sharing the data and the frozen models. "
+                "Supports DDP and FSDP with `use_orig_params`, but not DeepSpeed."
+            )
+        },
+    )
 
 
 @dataclass
@@ -336,7 +522,7 @@ class FinetuningArguments(FreezeArguments, LoraArguments, RLHFArguments, GaloreA
         default=False,
         metadata={"help": "Whether or not to train model in purely bf16 precision (without AMP)."},
     )
-    stage: Literal["pt", "sft", "rm", "ppo", "dpo", "kto", "sail"] = field(
+    stage: Literal["pt", "sft", "rm", "ppo", "dpo", "kto", "sail", "sail_precompute"] = field(
         default="sft",
         metadata={"help": "Which stage will be performed in training."},
     )
@@ -388,8 +574,8 @@ class FinetuningArguments(FreezeArguments, LoraArguments, RLHFArguments, GaloreA
         
         # Process lora_layer_range for SAIL LoRA fine-tuning
         if self.lora_layer_range is not None:
-            if self.stage != "sail" or self.finetuning_type != "lora":
-                raise ValueError("`lora_layer_range` is only valid when stage is 'sail' and finetuning_type is 'lora'.")
+            if self.stage not in ["sail", "sail_precompute"] or self.finetuning_type != "lora":
+                raise ValueError("`lora_layer_range` is only valid for SAIL stages with finetuning_type 'lora'.")
             self.lora_layer_range: List[str] = split_arg(self.lora_layer_range)
         self.freeze_vision_tower = self.freeze_vision_tower or self.train_mm_proj_only
         self.use_ref_model = self.stage == "dpo" and self.pref_loss not in ["orpo", "simpo"]
@@ -397,6 +583,7 @@ class FinetuningArguments(FreezeArguments, LoraArguments, RLHFArguments, GaloreA
         assert self.finetuning_type in ["lora", "freeze", "full"], "Invalid fine-tuning method."
         assert self.ref_model_quantization_bit in [None, 8, 4], "We only accept 4-bit or 8-bit quantization."
         assert self.reward_model_quantization_bit in [None, 8, 4], "We only accept 4-bit or 8-bit quantization."
+        assert self.sail_reward_model_quantization_bit in [None, 8, 4], "We only accept 4-bit or 8-bit quantization."
 
         if self.stage == "ppo" and self.reward_model is None:
             raise ValueError("`reward_model` is necessary for PPO training.")
@@ -404,6 +591,97 @@ class FinetuningArguments(FreezeArguments, LoraArguments, RLHFArguments, GaloreA
         if self.stage == "ppo" and self.reward_model_type == "lora" and self.finetuning_type != "lora":
             raise ValueError("`reward_model_type` cannot be lora for Freeze/Full PPO training.")
 
+        if self.sail_share_frozen_prefix and (self.lora_layer_range is None or self.additional_target is not None):
+            raise ValueError("`sail_share_frozen_prefix` requires `lora_layer_range` without `additional_target`.")
+
+        if self.sail_detach_frozen_prefix and (self.lora_layer_range is None or self.additional_target is not None):
+            raise ValueError("`sail_detach_frozen_prefix` requires `lora_layer_range` without `additional_target`.")
+
+        if self.sail_shared_prompt and self.sail_share_frozen_prefix:
+            raise ValueError("`sail_shared_prompt` is incompatible with `sail_share_frozen_prefix`.")
+
+        if self.sail_group_by_prompt and (not self.sail_shared_prompt or self.pref_max_batch_tokens is not None):
+            raise ValueError("`sail_group_by_prompt` requires `sail_shared_prompt` without `pref_max_batch_tokens`.")
+
+        if self.sail_padding_free and (
+            self.sail_shared_prompt or self.sail_share_frozen_prefix or self.sail_logps_cache_dir is not None
+        ):
+            raise ValueError(
+                "`sail_padding_free` is incompatible with `sail_shared_prompt`, `sail_share_frozen_prefix` "
+                "and `sail_logps_cache_dir`."
+            )
+
+        if self.sail_split_pair and (self.sail_shared_prompt or self.sail_padding_free or self.sail_adapters):
+            raise ValueError(
+                "`sail_split_pair` is incompatible with `sail_shared_prompt`, `sail_padding_free` and `sail_adapters`."
+            )
+
+        if self.sail_reward_model_type == "lora":
+            if self.finetuning_type != "lora" or self.ref_model is not None:
+                raise ValueError("LoRA `sail_reward_model_type` requires LoRA training without `ref_model`.")
+
+            if (
+                self.sail_reward_model_adapters is not None
+                or self.sail_reward_model_quantization_bit is not None
+                or self.sail_reward_model_device != "auto"
+            ):
+                raise ValueError("LoRA `sail_reward_model_type` shares the policy model, cannot be loaded separately.")
+
+            if self.sail_shared_prompt:
+                raise ValueError("LoRA `sail_reward_model_type` is incompatible with `sail_shared_prompt`.")
+
+        if self.sail_prefetch_batches < 0:
+            raise ValueError("`sail_prefetch_batches` should be a non-negative integer.")
+
+        if self.sail_prefetch_batches > 0 and (
+            self.sail_reward_model_type == "lora"
+            or self.sail_share_frozen_prefix
+            or self.sail_logps_cache_dir is not None
+        ):
+            raise ValueError(
+                "`sail_prefetch_batches` requires standalone frozen models, it is incompatible with LoRA "
+                "`sail_reward_model_type`, `sail_share_frozen_prefix` and `sail_logps_cache_dir`."
+            )
+
+        if self.sail_reward_model_quantization_bit is not None and self.sail_reward_model_device != "auto":
+            raise ValueError("Quantized reward model can only be placed on the same device as the policy.")
+
+        if self.sail_ref_model_device != "auto" and (
+            self.ref_model is None or self.ref_model_quantization_bit is not None
+        ):
+            raise ValueError("`sail_ref_model_device` requires a standalone `ref_model` without quantization.")
+
+        if self.ref_model is None and self.ref_model_adapters is not None and self.sail_reward_model_type != "lora":
+            raise ValueError("`ref_model_adapters` requires `ref_model` unless `sail_reward_model_type` is LoRA.")
+
+        if self.sail_sweep_grid is not None and self.stage != "sail":
+            raise ValueError("`sail_sweep_grid` is only valid for the SAIL stage.")
+
+        if self.sail_async_checkpoint and (self.stage != "sail" or self.finetuning_type == "full"):
+            raise ValueError("`sail_async_checkpoint` is only valid for the SAIL stage with LoRA or Freeze training.")
+
+        if self.sail_adapters is not None:
+            if self.stage != "sail" or self.finetuning_type != "lora":
+                raise ValueError("`sail_adapters` is only valid for the SAIL stage with LoRA training.")
+
+            if self.sail_reward_model_type == "lora" or self.sail_sweep_grid is not None:
+                raise ValueError("`sail_adapters` is incompatible with LoRA `sail_reward_model_type` and sweeps.")
+
+            if self.use_galore or self.use_badam or self.use_adam_mini or self.loraplus_lr_ratio is not None:
+                raise ValueError("`sail_adapters` creates its own optimizer, cannot be used with a custom one.")
+
+            if self.pissa_init or self.create_new_adapter:
+                raise ValueError("`sail_adapters` is incompatible with `pissa_init` and `create_new_adapter`.")
+
+        if self.stage == "sail_precompute" and (self.sail_logps_cache_dir is None or self.sail_reward_model is None):
+            raise ValueError("`sail_logps_cache_dir` and `sail_reward_model` are necessary for SAIL precomputation.")
+
+        if self.pref_logps_chunk_size is not None and self.pref_logps_chunk_size <= 0:
+            raise ValueError("`pref_logps_chunk_size` should be a positive integer.")
+
+        if self.pref_max_batch_tokens is not None and self.pref_max_batch_tokens <= 0:
+            raise ValueError("`pref_max_batch_tokens` should be a positive integer.")
+
         if self.stage == "dpo" and self.pref_loss != "sigmoid" and self.dpo_label_smoothing > 1e-6:
             raise ValueError("`dpo_label_smoothing` is only valid for sigmoid loss function.")
 
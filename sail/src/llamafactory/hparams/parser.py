@@ -31,6 +31,7 @@ from transformers.utils.versions import require_version
 from ..extras import logging
 from ..extras.constants import CHECKPOINT_NAMES
 from ..extras.misc import check_dependencies, get_current_device
+from .benchmark_args import BenchmarkArguments
 from .data_args import DataArguments
 from .evaluation_args import EvaluationArguments
 from .finetuning_args import FinetuningArguments
@@ -142,6 +143,11 @@ def _check_extra_dependencies(
         require_version("rouge_chinese", "To fix: pip install rouge-chinese")
 
 
+def _parse_bench_args(args: Optional[Dict[str, Any]] = None) -> BenchmarkArguments:
+    parser = HfArgumentParser(BenchmarkArguments)
+    return _parse_args(parser, args)[0]
+
+
 def _parse_train_args(args: Optional[Dict[str, Any]] = None) -> _TRAIN_CLS:
     parser = HfArgumentParser(_TRAIN_ARGS)
     return _parse_args(parser, args)
@@ -172,8 +178,8 @@ def get_train_args(args: Optional[Dict[str, Any]] = None) -> _TRAIN_CLS:
         if training_args.predict_with_generate:
             raise ValueError("`predict_with_generate` cannot be set as True except SFT.")
 
-        if data_args.neat_packing:
-            raise ValueError("`neat_packing` cannot be set as True except SFT.")
+        if data_args.neat_packing and finetuning_args.stage != "sail":
+            raise ValueError("`neat_packing` cannot be set as True except SFT and SAIL.")
 
         if data_args.train_on_prompt or data_args.mask_history:
             raise ValueError("`train_on_prompt` or `mask_history` cannot be set as True except SFT.")
@@ -259,10 +265,65 @@ def get_train_args(args: Optional[Dict[str, Any]] = None) -> _TRAIN_CLS:
     if model_args.use_unsloth and is_deepspeed_zero3_enabled():
         raise ValueError("Unsloth is incompatible with DeepSpeed ZeRO-3.")
 
+    if finetuning_args.sail_shared_prompt:
+        if not model_args.disable_gradient_checkpointing:
+            raise ValueError(
+                "`sail_shared_prompt` requires `disable_gradient_checkpointing`, since the gradients of the "
+                "KV cache cannot cross the reentrant checkpoints."
+            )
+
+        if model_args.flash_attn == "fa2":
+            raise ValueError("`sail_shared_prompt` is incompatible with FlashAttention-2, use `sdpa` instead.")
+
+    if finetuning_args.sail_adapters is not None:
+        if not training_args.do_train or model_args.adapter_name_or_path is not None:
+            raise ValueError("`sail_adapters` only supports training new adapters.")
+
+        if training_args.deepspeed is not None:  # accelerate steps the engine in each backward pass
+            raise ValueError("`sail_adapters` is incompatible with DeepSpeed.")
+
+    if finetuning_args.sail_async_checkpoint:
+        if training_args.deepspeed is not None or training_args.load_best_model_at_end:
+            raise ValueError("`sail_async_checkpoint` is incompatible with DeepSpeed and `load_best_model_at_end`.")
+
     if data_args.neat_packing and not data_args.packing:
         logger.warning_rank0("`neat_packing` requires `packing` is True. Change `packing` to True.")
         data_args.packing = True
 
+    if data_args.sharded_streaming:
+        if finetuning_args.stage != "sail":
+            raise ValueError("`sharded_streaming` is only supported in the SAIL stage.")
+
+        if finetuning_args.include_effective_tokens_per_second:
+            raise ValueError("`include_effective_tokens_per_second` is incompatible with `sharded_streaming`.")
+
+    if data_args.packing and finetuning_args.stage not in ["pt", "sft", "sail"]:
+        raise ValueError("`packing` is only supported in PT, SFT and SAIL stages.")
+
+    if data_args.packing and finetuning_args.sail_padding_free:
+        raise ValueError("`sail_padding_free` cannot be used with `packing`.")
+
+    if data_args.packing and finetuning_args.sail_split_pair:
+        raise ValueError("`sail_split_pair` cannot be used with `packing`.")
+
+    if finetuning_args.sail_split_pair and training_args.deepspeed is not None:  # one backward pass per step
+        raise ValueError("`sail_split_pair` is incompatible with DeepSpeed.")
+
+    if data_args.packing and finetuning_args.stage == "sail":
+        if not data_args.neat_packing:
+            raise ValueError("Packed pairs must not attend to each other, please enable `neat_packing`.")
+
+        if (
+            finetuning_args.sail_shared_prompt
+            or finetuning_args.sail_share_frozen_prefix
+            or finetuning_args.sail_logps_cache_dir is not None
+            or finetuning_args.pref_max_batch_tokens is not None
+        ):
+            raise ValueError(
+                "`neat_packing` is incompatible with `sail_shared_prompt`, `sail_share_frozen_prefix`, "
+                "`sail_logps_cache_dir` and `pref_max_batch_tokens`."
+            )
+
     _verify_model_args(model_args, data_args, finetuning_args)
     _check_extra_dependencies(model_args, finetuning_args, training_args)
 
@@ -419,3 +480,11 @@ def get_eval_args(args: Optional[Dict[str, Any]] = None) -> _EVAL_CLS:
     transformers.set_seed(eval_args.seed)
 
     return model_args, data_args, eval_args, finetuning_args
+
+
+def get_bench_args(args: Optional[Dict[str, Any]] = None) -> BenchmarkArguments:
+    bench_args = _parse_bench_args(args)
+
+    transformers.set_seed(bench_args.seed)
+
+    return bench_args
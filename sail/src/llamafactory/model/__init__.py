@@ -13,7 +13,8 @@
 # limitations under the License.
 
 from .loader import load_config, load_model, load_tokenizer
-from .model_utils.misc import find_all_linear_modules, find_sail_lora_target_modules
+from .model_utils.frozen_prefix import forward_frozen_prefix, is_frozen_prefix_supported, split_decoder_layers
+from .model_utils.misc import find_all_linear_modules, find_sail_lora_target_modules, get_sail_layer_ids
 from .model_utils.quantization import QuantizationMethod
 from .model_utils.valuehead import load_valuehead_params
 
@@ -25,5 +26,9 @@ __all__ = [
     "load_tokenizer",
     "find_all_linear_modules",
     "find_sail_lora_target_modules",
+    "forward_frozen_prefix",
+    "get_sail_layer_ids",
+    "is_frozen_prefix_supported",
+    "split_decoder_layers",
     "load_valuehead_params",
 ]
@@ -21,7 +21,13 @@ from transformers.integrations import is_deepspeed_zero3_enabled
 from transformers.modeling_utils import is_fsdp_enabled
 
 from ..extras import logging
-from .model_utils.misc import find_all_linear_modules, find_expanded_modules, find_sail_lora_target_modules
+from .model_utils.frozen_prefix import detach_frozen_prefix, is_frozen_prefix_supported
+from .model_utils.misc import (
+    find_all_linear_modules,
+    find_expanded_modules,
+    find_sail_lora_target_modules,
+    get_sail_layer_ids,
+)
 from .model_utils.quantization import QuantizationMethod
 from .model_utils.unsloth import get_unsloth_peft_model, load_unsloth_peft_model
 from .model_utils.visual import get_forbidden_modules, patch_target_modules
@@ -279,6 +285,12 @@ def _setup_lora_tuning(
         for param in filter(lambda p: p.requires_grad, model.parameters()):
             param.data = param.data.to(torch.float32)
 
+    if is_trainable and finetuning_args.sail_detach_frozen_prefix:
+        if is_frozen_prefix_supported(model):
+            detach_frozen_prefix(model, get_sail_layer_ids(finetuning_args.lora_layer_range)[0])
+        else:
+            logger.warning_rank0("Current model does not support detaching the frozen prefix.")
+
     return model
 
 
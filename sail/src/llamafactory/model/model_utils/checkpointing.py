@@ -79,6 +79,8 @@ def get_unsloth_gradient_checkpointing_func() -> Callable:
 def get_custom_gradient_checkpointing_func(gradient_checkpointing_func: Callable) -> Callable:
     r"""
     Only applies gradient checkpointing to trainable layers.
+
+    Frozen layers whose inputs do not require grads are run without gradients instead.
     """
 
     @wraps(gradient_checkpointing_func, assigned=WRAPPER_ASSIGNMENTS + ("__self__",))
@@ -89,6 +91,9 @@ def get_custom_gradient_checkpointing_func(gradient_checkpointing_func: Callable
             for arg in args:
                 if torch.is_tensor(arg) and torch.is_floating_point(arg):
                     arg.requires_grad_(True)
+        elif not any(torch.is_tensor(arg) and arg.requires_grad for arg in args):  # nothing to recompute
+            with torch.no_grad():
+                return func(*args, **kwargs)
 
         return gradient_checkpointing_func(func, *args, **kwargs)
 
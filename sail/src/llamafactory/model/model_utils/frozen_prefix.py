@@ -0,0 +1,122 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Dict, Generator, Optional, Tuple
+
+import torch
+
+from ...extras import logging
+from ...extras.constants import SUPPORTED_CLASS_FOR_FROZEN_PREFIX
+
+
+if TYPE_CHECKING:
+    from transformers import PreTrainedModel
+
+
+logger = logging.get_logger(__name__)
+
+
+def _get_base_model(model: "torch.nn.Module") -> "PreTrainedModel":
+    if hasattr(model, "get_base_model"):  # peft model
+        return model.get_base_model()
+
+    return model
+
+
+def _get_decoder(model: "torch.nn.Module") -> Optional["torch.nn.Module"]:
+    r"""
+    Returns the decoder module holding the `layers` and the final `norm`, e.g. LlamaModel.
+    """
+    decoder = getattr(_get_base_model(model), "model", None)
+    if decoder is None or not hasattr(decoder, "layers") or not hasattr(decoder, "norm"):
+        return None
+
+    return decoder
+
+
+def is_frozen_prefix_supported(model: "torch.nn.Module") -> bool:
+    r"""
+    Checks if the decoder layers of the (unwrapped) model can be run in separate passes.
+    """
+    model_type = getattr(_get_base_model(model).config, "model_type", None)
+    return model_type in SUPPORTED_CLASS_FOR_FROZEN_PREFIX and _get_decoder(model) is not None
+
+
+@contextmanager
+def split_decoder_layers(
+    model: "torch.nn.Module", start: int, end: Optional[int] = None, return_hidden_states: bool = False
+) -> Generator[None, None, None]:
+    r"""
+    Temporarily keeps the decoder layers in [start, end) of the (unwrapped) model.
+
+    The forward pass should feed `inputs_embeds` as the hidden states of the `start`-th layer if `start` > 0.
+    If `return_hidden_states` is True, the final norm and the output layer are bypassed,
+    thus the `logits` of the outputs are the hidden states of the `end`-th layer.
+    """
+    base_model = _get_base_model(model)
+    decoder = _get_decoder(model)
+    layers, norm, output_layer = decoder.layers, decoder.norm, base_model.get_output_embeddings()
+    decoder.layers = torch.nn.ModuleList(layers[start:end])
+    if return_hidden_states:
+        decoder.norm = torch.nn.Identity()
+        base_model.set_output_embeddings(torch.nn.Identity())
+
+    try:
+        yield
+    finally:
+        decoder.layers = layers
+        decoder.norm = norm
+        base_model.set_output_embeddings(output_layer)
+
+
+def forward_frozen_prefix(
+    model: "torch.nn.Module", unwrapped_model: "torch.nn.Module", num_layers: int, **inputs
+) -> "torch.Tensor":
+    r"""
+    Runs the embeddings and the first `num_layers` decoder layers without gradients.
+
+    Returns the hidden states of the `num_layers`-th layer in the dtype of the embeddings.
+    """
+    dtype = unwrapped_model.get_input_embeddings().weight.dtype
+    with torch.no_grad(), split_decoder_layers(unwrapped_model, 0, num_layers, return_hidden_states=True):
+        hidden_states = model(**inputs, return_dict=True, use_cache=False).logits
+
+    return hidden_states.to(dtype)
+
+
+def _detach_hidden_states_hook(
+    module: "torch.nn.Module", args: Tuple[Any, ...], kwargs: Dict[str, Any]
+) -> Tuple[Tuple[Any, ...], Dict[str, Any]]:
+    if len(args) > 0 and torch.is_tensor(args[0]):
+        args = (args[0].detach(),) + tuple(args[1:])
+    elif torch.is_tensor(kwargs.get("hidden_states")):
+        kwargs["hidden_states"] = kwargs["hidden_states"].detach()
+
+    return args, kwargs
+
+
+def detach_frozen_prefix(model: "torch.nn.Module", num_layers: int) -> None:
+    r"""
+    Cuts the autograd graph at the input of the `num_layers`-th decoder layer of the (unwrapped) model.
+
+    The layers below then receive no gradients, and are neither checkpointed nor recorded by autograd.
+    """
+    base_model = _get_base_model(model)
+    if getattr(base_model, "_require_grads_hook", None) is not None:
+        base_model.disable_input_require_grads()
+
+    decoder = _get_decoder(model)
+    decoder.layers[num_layers].register_forward_pre_hook(_detach_hidden_states_hook, with_kwargs=True)
+    logger.info_rank0(f"Detached the hidden states at the input of layer {num_layers}.")
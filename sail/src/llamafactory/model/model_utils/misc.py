@@ -95,6 +95,21 @@ def register_autoclass(config: "PretrainedConfig", model: "PreTrainedModel", tok
         tokenizer.__class__.register_for_auto_class()
 
 
+def get_sail_layer_ids(lora_layer_range: List[str]) -> List[int]:
+    r"""
+    Parses the layer range of SAIL (e.g., ["19-23", "24"]) into sorted layer ids.
+    """
+    layer_ids = set()
+    for layer_spec in lora_layer_range:
+        if "-" in layer_spec:  # handle range like "19-23"
+            start, end = map(int, layer_spec.split("-"))
+            layer_ids.update(range(start, end + 1))
+        else:  # handle single layer like "24"
+            layer_ids.add(int(layer_spec))
+
+    return sorted(layer_ids)
+
+
 def find_sail_lora_target_modules(
     model: "PreTrainedModel", 
     lora_target: List[str], 
@@ -119,15 +134,7 @@ def find_sail_lora_target_modules(
     all_linear_modules = find_all_linear_modules(model, freeze_vision_tower)
     
     # Parse layer ranges
-    target_layer_ids = set()
-    for layer_spec in lora_layer_range:
-        if "-" in layer_spec:
-            # Handle range like "19-23"
-            start, end = map(int, layer_spec.split("-"))
-            target_layer_ids.update(range(start, end + 1))
-        else:
-            # Handle single layer like "24"
-            target_layer_ids.add(int(layer_spec))
+    target_layer_ids = set(get_sail_layer_ids(lora_layer_range))
     
     # Find modules that match both lora_target and layer range
     target_modules = []
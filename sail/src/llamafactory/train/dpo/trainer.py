@@ -16,7 +16,6 @@
 # limitations under the License.
 
 import warnings
-from collections import defaultdict
 from contextlib import nullcontext
 from types import MethodType
 from typing import TYPE_CHECKING, Dict, Literal, Optional, Tuple, Union
@@ -31,7 +30,14 @@ from typing_extensions import override
 from ...extras.constants import IGNORE_INDEX
 from ...extras.packages import is_transformers_version_equal_to_4_46
 from ..callbacks import PissaConvertCallback, SaveProcessorCallback
-from ..trainer_utils import create_custom_optimizer, create_custom_scheduler, get_batch_logps
+from ..trainer_utils import (
+    MetricsAccumulator,
+    create_custom_optimizer,
+    create_custom_scheduler,
+    get_batch_logps,
+    get_label_batch_logps,
+    is_label_logps_supported,
+)
 
 
 if TYPE_CHECKING:
@@ -69,7 +75,7 @@ class CustomDPOTrainer(DPOTrainer):
         self._peft_has_been_casted_to_bf16 = False
 
         self.ref_model = ref_model
-        self._stored_metrics = defaultdict(lambda: defaultdict(list))
+        self.metrics_accumulator = MetricsAccumulator()
 
         # dpo hyperparams
         self.beta = finetuning_args.pref_beta
@@ -183,12 +189,23 @@ class CustomDPOTrainer(DPOTrainer):
         Computes the sum log probabilities of the labels under given logits if loss_type is not IPO, ORPO or SimPO.
 
         Otherwise the average log probabilities.
+
+        If only the response tokens go through the output layer, the logits are averaged per sequence.
         """
         if self.finetuning_args.use_ref_model:
             batch = {k: v.detach().clone() for k, v in batch.items()}  # avoid error
 
-        all_logits: "torch.Tensor" = model(**batch, return_dict=True, use_cache=False).logits.to(torch.float32)
-        all_logps, valid_length = get_batch_logps(logits=all_logits, labels=batch["labels"])
+        unwrapped_model = self.accelerator.unwrap_model(model)
+        chunk_size = self.finetuning_args.pref_logps_chunk_size
+        use_label_logps = self.finetuning_args.pref_response_logits_only or chunk_size is not None
+        if use_label_logps and is_label_logps_supported(unwrapped_model, chunk_size):
+            all_logps, valid_length, all_logits = get_label_batch_logps(
+                model, unwrapped_model, batch, batch["labels"], chunk_size
+            )
+        else:
+            all_logits: "torch.Tensor" = model(**batch, return_dict=True, use_cache=False).logits.to(torch.float32)
+            all_logps, valid_length = get_batch_logps(logits=all_logits, labels=batch["labels"])
+
         if self.loss_type in ["ipo", "orpo", "simpo"]:
             all_logps = all_logps / valid_length
 
@@ -251,17 +268,17 @@ class CustomDPOTrainer(DPOTrainer):
             losses += self.ftx_gamma * sft_loss
 
         prefix = "eval_" if train_eval == "eval" else ""
-        metrics[f"{prefix}rewards/chosen"] = chosen_rewards.mean().item()
-        metrics[f"{prefix}rewards/rejected"] = rejected_rewards.mean().item()
-        metrics[f"{prefix}rewards/accuracies"] = (chosen_rewards > rejected_rewards).float().mean().item()
-        metrics[f"{prefix}rewards/margins"] = (chosen_rewards - rejected_rewards).mean().item()
-        metrics[f"{prefix}logps/chosen"] = policy_chosen_logps.mean().item()
-        metrics[f"{prefix}logps/rejected"] = policy_rejected_logps.mean().item()
-        metrics[f"{prefix}logits/chosen"] = policy_chosen_logits.mean().item()
-        metrics[f"{prefix}logits/rejected"] = policy_rejected_logits.mean().item()
+        metrics[f"{prefix}rewards/chosen"] = chosen_rewards.mean().detach()
+        metrics[f"{prefix}rewards/rejected"] = rejected_rewards.mean().detach()
+        metrics[f"{prefix}rewards/accuracies"] = (chosen_rewards > rejected_rewards).float().mean().detach()
+        metrics[f"{prefix}rewards/margins"] = (chosen_rewards - rejected_rewards).mean().detach()
+        metrics[f"{prefix}logps/chosen"] = policy_chosen_logps.mean().detach()
+        metrics[f"{prefix}logps/rejected"] = policy_rejected_logps.mean().detach()
+        metrics[f"{prefix}logits/chosen"] = policy_chosen_logits.mean().detach()
+        metrics[f"{prefix}logits/rejected"] = policy_rejected_logits.mean().detach()
         if self.loss_type == "orpo":
-            metrics[f"{prefix}sft_loss"] = sft_loss.mean().item()
-            metrics[f"{prefix}odds_ratio_loss"] = ((losses - sft_loss) / self.beta).mean().item()
+            metrics[f"{prefix}sft_loss"] = sft_loss.mean().detach()
+            metrics[f"{prefix}odds_ratio_loss"] = ((losses - sft_loss) / self.beta).mean().detach()
 
         return losses.mean(), metrics
 
@@ -280,6 +297,15 @@ class CustomDPOTrainer(DPOTrainer):
 
         return loss
 
+    @override
+    def store_metrics(
+        self, metrics: Dict[str, "torch.Tensor"], train_eval: Literal["train", "eval"] = "train"
+    ) -> None:
+        r"""
+        Accumulates the metrics on device instead of converting them to floats at each step.
+        """
+        self.metrics_accumulator.add(metrics, train_eval)
+
     @override
     def log(self, logs: Dict[str, float]) -> None:
         r"""
@@ -287,22 +313,5 @@ class CustomDPOTrainer(DPOTrainer):
         """
         # logs either has "loss" or "eval_loss"
         train_eval = "train" if "loss" in logs else "eval"
-        # Add averaged stored metrics to logs
-        key_list, metric_list = [], []
-        for key, metrics in self._stored_metrics[train_eval].items():
-            key_list.append(key)
-            metric_list.append(torch.tensor(metrics, dtype=torch.float).to(self.accelerator.device).mean().item())
-
-        del self._stored_metrics[train_eval]
-        if len(metric_list) < 10:  # pad to for all reduce
-            for i in range(10 - len(metric_list)):
-                key_list.append(f"dummy_{i}")
-                metric_list.append(0.0)
-
-        metric_list = torch.tensor(metric_list, dtype=torch.float).to(self.accelerator.device)
-        metric_list = self.accelerator.reduce(metric_list, "mean").tolist()
-        for key, metric in zip(key_list, metric_list):  # add remaining items
-            if not key.startswith("dummy_"):
-                logs[key] = metric
-
+        logs.update(self.metrics_accumulator.pop(train_eval, self.accelerator.device, self.accelerator.reduce))
         return Trainer.log(self, logs)
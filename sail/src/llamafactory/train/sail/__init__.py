@@ -12,7 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .workflow import run_sail
+from .benchmark import run_sail_bench
+from .sweep import run_sail_sweep
+from .workflow import run_sail, run_sail_precompute
 
 
-__all__ = ["run_sail"]
+__all__ = ["run_sail", "run_sail_bench", "run_sail_precompute", "run_sail_sweep"]
@@ -0,0 +1,236 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import math
+import os
+from contextlib import contextmanager
+from copy import deepcopy
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Generator, List, Optional
+
+import torch
+import yaml
+from peft.tuners.tuners_utils import BaseTunerLayer
+from transformers import Trainer
+
+from ...extras import logging
+
+
+if TYPE_CHECKING:
+    from peft import PeftModel
+    from transformers import Seq2SeqTrainingArguments
+
+    from ...hparams import FinetuningArguments
+
+
+logger = logging.get_logger(__name__)
+
+
+ADAPTER_KEYS = ("name", "sail_alpha", "pref_beta", "lora_rank", "lora_alpha", "learning_rate")
+
+
+@dataclass
+class SailAdapterConfig:
+    r"""
+    Hyperparameters of one SAIL adapter trained alongside the others.
+
+    The first adapter is the `default` one created by `load_model`, it is saved to `output_dir`,
+    the others are saved to `output_dir/<adapter_name>`.
+    """
+
+    name: str
+    adapter_name: str
+    sail_alpha: float
+    pref_beta: float
+    lora_rank: int
+    lora_alpha: int
+    learning_rate: float
+
+
+def load_sail_adapter_configs(
+    finetuning_args: "FinetuningArguments", training_args: "Seq2SeqTrainingArguments"
+) -> List["SailAdapterConfig"]:
+    r"""
+    Loads the adapter configs from a JSON/YAML file or a JSON string, the missing values fall back to the arguments.
+    """
+    if os.path.isfile(finetuning_args.sail_adapters):
+        with open(finetuning_args.sail_adapters, encoding="utf-8") as f:
+            configs = yaml.safe_load(f)
+    else:
+        configs = json.loads(finetuning_args.sail_adapters)
+
+    if not isinstance(configs, list) or len(configs) == 0 or not all(isinstance(config, dict) for config in configs):
+        raise ValueError("`sail_adapters` should be a non-empty list of dicts.")
+
+    adapter_configs = []
+    for index, config in enumerate(configs):
+        unknown_keys = set(config.keys()) - set(ADAPTER_KEYS)
+        if unknown_keys:
+            raise ValueError(f"Cannot set {unknown_keys} per adapter, supported arguments are {ADAPTER_KEYS}.")
+
+        name = str(config.get("name", f"adapter_{index}"))
+        adapter_configs.append(
+            SailAdapterConfig(
+                name=name,
+                adapter_name="default" if index == 0 else name,
+                sail_alpha=config.get("sail_alpha", finetuning_args.sail_alpha),
+                pref_beta=config.get("pref_beta", finetuning_args.pref_beta),
+                lora_rank=config.get("lora_rank", finetuning_args.lora_rank),
+                lora_alpha=config.get("lora_alpha", finetuning_args.lora_alpha),
+                learning_rate=config.get("learning_rate", training_args.learning_rate),
+            )
+        )
+
+    adapter_names = [config.adapter_name for config in adapter_configs]
+    if len(set(adapter_names)) != len(adapter_names) or "default" in adapter_names[1:]:
+        raise ValueError("The names of `sail_adapters` should be unique and should not be `default`.")
+
+    return adapter_configs
+
+
+def create_sail_adapters(model: "PeftModel", adapter_configs: List["SailAdapterConfig"]) -> None:
+    r"""
+    Adds the adapters other than the `default` one to the policy model, with the same target modules.
+
+    All the adapters are trainable while the `default` one stays active.
+    """
+    default_config = model.peft_config["default"]
+    default_param = next(param for name, param in model.named_parameters() if ".default." in name)
+    for adapter_config in adapter_configs[1:]:
+        peft_config = deepcopy(default_config)
+        peft_config.r = adapter_config.lora_rank
+        peft_config.lora_alpha = adapter_config.lora_alpha
+        model.add_adapter(adapter_config.adapter_name, peft_config)
+
+    for name, param in model.named_parameters():  # peft only marks the active adapter as trainable
+        if any(f".{config.adapter_name}." in name for config in adapter_configs):
+            param.requires_grad_(True)
+            param.data = param.data.to(default_param.dtype)
+
+    logger.info_rank0(f"Training {len(adapter_configs)} SAIL adapters: {[config.name for config in adapter_configs]}.")
+
+
+@contextmanager
+def activate_adapter(model: "torch.nn.Module", adapter_name: str) -> Generator[None, None, None]:
+    r"""
+    Activates the adapter in the LoRA layers for the forward pass.
+
+    Unlike `set_adapter` of peft, it keeps the `requires_grad` flags, so all the adapters remain trainable.
+    """
+    tuner_layers = [module for module in model.modules() if isinstance(module, BaseTunerLayer)]
+    active_adapters = [layer._active_adapter for layer in tuner_layers]
+    for layer in tuner_layers:
+        layer._active_adapter = adapter_name
+
+    try:
+        yield
+    finally:
+        for layer, active_adapter in zip(tuner_layers, active_adapters):
+            layer._active_adapter = active_adapter
+
+
+def create_sail_adapters_optimizer(
+    model: "PeftModel",
+    training_args: "Seq2SeqTrainingArguments",
+    adapter_configs: List["SailAdapterConfig"],
+) -> "torch.optim.Optimizer":
+    r"""
+    Creates an optimizer with one param group per adapter, in the order of `adapter_configs`.
+
+    The optimizer states and the learning rates of the groups are independent, so each adapter is optimized
+    as if it had its own optimizer and scheduler.
+    """
+    param_dict: List[List["torch.nn.Parameter"]] = [[] for _ in adapter_configs]
+    for name, param in model.named_parameters():
+        for params, config in zip(param_dict, adapter_configs):
+            if param.requires_grad and f".{config.adapter_name}." in name:
+                params.append(param)
+
+    optim_class, optim_kwargs = Trainer.get_optimizer_cls_and_kwargs(training_args)
+    param_groups = [
+        dict(params=params, lr=config.learning_rate, weight_decay=training_args.weight_decay)
+        for params, config in zip(param_dict, adapter_configs)
+    ]
+    return optim_class(param_groups, **optim_kwargs)
+
+
+def _clip_sharded_grad_norm_(params: List["torch.nn.Parameter"], max_norm: float, norm_type: float) -> "torch.Tensor":
+    r"""
+    Clips the gradients sharded across processes (FSDP), where the norms of the local shards are all-reduced.
+
+    All the processes must call it for the same param groups, even if they hold an empty shard.
+    """
+    grads = [param.grad.detach() for param in params if param.grad is not None and param.grad.numel() != 0]
+    total_norm = torch.zeros((), dtype=torch.float32, device=params[0].device)
+    if math.isinf(norm_type):
+        for grad in grads:
+            total_norm = torch.maximum(total_norm, grad.abs().max().float())
+
+        torch.distributed.all_reduce(total_norm, op=torch.distributed.ReduceOp.MAX)
+    else:
+        for grad in grads:
+            total_norm += torch.linalg.vector_norm(grad, norm_type, dtype=torch.float32) ** norm_type
+
+        torch.distributed.all_reduce(total_norm, op=torch.distributed.ReduceOp.SUM)
+        total_norm = total_norm ** (1.0 / norm_type)
+
+    clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+    for grad in grads:
+        grad.mul_(clip_coef.to(grad.device, grad.dtype))
+
+    return total_norm
+
+
+def clip_grad_norm_per_adapter(
+    optimizer: "torch.optim.Optimizer", max_norm: float, norm_type: float = 2.0, sharded: bool = False
+) -> Optional["torch.Tensor"]:
+    r"""
+    Clips the gradients of each adapter (param group) separately, so that one adapter does not scale the others.
+
+    If `sharded` is True, the gradients are the local shards of FSDP, whose norms are all-reduced across processes.
+    Returns the largest gradient norm among the adapters.
+    """
+    grad_norms = []
+    for group in optimizer.param_groups:
+        if len(group["params"]) == 0:
+            continue
+
+        if sharded:
+            grad_norms.append(_clip_sharded_grad_norm_(group["params"], max_norm, norm_type))
+        else:
+            grad_norms.append(torch.nn.utils.clip_grad_norm_(group["params"], max_norm, norm_type=norm_type))
+
+    if len(grad_norms) == 0:
+        return None
+
+    return torch.stack(grad_norms).max()
+
+
+def all_reduce_adapter_gradients(optimizer: "torch.optim.Optimizer") -> None:
+    r"""
+    Averages the gradients of all the adapters across processes in one flat all-reduce.
+
+    Used in DDP instead of the gradient hooks, which expect every parameter to get its gradient in each backward pass.
+    """
+    params = [param for group in optimizer.param_groups for param in group["params"]]
+    grads = [param.grad if param.grad is not None else torch.zeros_like(param) for param in params]
+    flat_grads = torch._utils._flatten_dense_tensors(grads)
+    torch.distributed.all_reduce(flat_grads)
+    flat_grads.div_(torch.distributed.get_world_size())
+    for param, grad in zip(params, torch._utils._unflatten_dense_tensors(flat_grads, grads)):
+        if param.grad is None:
+            param.grad = grad
+        else:
+            param.grad.copy_(grad)
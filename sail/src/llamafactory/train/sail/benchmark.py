@@ -0,0 +1,360 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import json
+import os
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from typing import TYPE_CHECKING, Any, Callable, Dict, Generator, List, Optional
+
+import torch
+import transformers
+from peft import LoraConfig, TaskType, get_peft_model
+from transformers import LlamaConfig, LlamaForCausalLM, Seq2SeqTrainingArguments
+
+from ...extras import logging
+from ...extras.constants import IGNORE_INDEX
+from ...extras.env import VERSION
+from ...hparams import FinetuningArguments, get_bench_args
+from ...model import find_all_linear_modules, find_sail_lora_target_modules
+from . import trainer as sail_trainer
+from .trainer import CustomDPOTrainer
+
+
+if TYPE_CHECKING:
+    from ...hparams import BenchmarkArguments
+
+
+logger = logging.get_logger(__name__)
+
+
+SAIL_STEP_PHASES = (
+    "policy_forward",
+    "get_batch_logps",
+    "reference_forward",
+    "reward_forward",
+    "loss",
+    "backward",
+    "optimizer_step",
+)
+
+
+class PhaseRecorder:
+    r"""
+    Records the wall time and the peak memory of the phases of a training step.
+
+    A phase is only recorded when entered from its `parent` phase (None for the top level), and the time of its
+    nested phases is excluded, so that the phase times add up to the step time.
+    The peak memory is read from the allocator on CUDA devices, and from the memory events of the profiler on CPU,
+    the latter is only enabled in the profiled step to keep the timings clean.
+    """
+
+    def __init__(self, device: "torch.device") -> None:
+        self.device = device
+        self.times: Dict[str, List[float]] = defaultdict(list)
+        self.peak_memory: Dict[str, int] = defaultdict(int)
+        self.timing = False
+        self.stack: List[Dict[str, Any]] = []
+
+    def _synchronize(self) -> None:
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def _update_parent_peak(self, peak_memory: int) -> None:
+        if len(self.stack) != 0:
+            self.stack[-1]["peak_memory"] = max(self.stack[-1]["peak_memory"], peak_memory)
+
+    @contextmanager
+    def phase(self, name: str, parent: Optional[str] = None) -> Generator[None, None, None]:
+        if (self.stack[-1]["name"] if len(self.stack) != 0 else None) != parent:
+            yield
+            return
+
+        self._synchronize()
+        record = {"name": name, "start_memory": 0, "peak_memory": 0, "nested_time": 0.0}
+        if self.device.type == "cuda":
+            self._update_parent_peak(torch.cuda.max_memory_allocated(self.device))
+            torch.cuda.reset_peak_memory_stats(self.device)
+            record["start_memory"] = torch.cuda.memory_allocated(self.device)
+
+        self.stack.append(record)
+        start_time = time.perf_counter()
+        try:
+            with torch.profiler.record_function(name):
+                yield
+        finally:
+            self.stack.pop()
+
+        self._synchronize()
+        elapsed_time = (time.perf_counter() - start_time) * 1000
+        if len(self.stack) != 0:
+            self.stack[-1]["nested_time"] += elapsed_time
+
+        if self.timing:
+            self.times[name].append(elapsed_time - record["nested_time"])
+
+        if self.device.type == "cuda":
+            peak_memory = max(record["peak_memory"], torch.cuda.max_memory_allocated(self.device))
+            self.peak_memory[name] = max(self.peak_memory[name], peak_memory - record["start_memory"])
+            self._update_parent_peak(peak_memory)
+
+    def record_profile(self, profiler: "torch.profiler.profile") -> None:
+        r"""
+        Accumulates the CPU memory events of the profiled step into the peak memory of each phase.
+        """
+        events = profiler.events()
+        memory_events = sorted(
+            (event for event in events if event.name == "[memory]"), key=lambda event: event.time_range.start
+        )
+        for event in events:
+            if event.name not in SAIL_STEP_PHASES:
+                continue
+
+            memory, peak_memory = 0, 0
+            for memory_event in memory_events:
+                if event.time_range.start <= memory_event.time_range.start <= event.time_range.end:
+                    memory += memory_event.cpu_memory_usage
+                    peak_memory = max(peak_memory, memory)
+
+            self.peak_memory[event.name] = max(self.peak_memory[event.name], peak_memory)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        results = {}
+        for name in SAIL_STEP_PHASES:
+            if name in self.times:
+                results[name] = {
+                    "time_ms": sum(self.times[name]) / len(self.times[name]),
+                    "peak_memory_mb": self.peak_memory[name] / 1024**2,
+                }
+
+        return results
+
+
+def _get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _create_tiny_model(bench_args: "BenchmarkArguments", vocab_size: int, max_length: int) -> "LlamaForCausalLM":
+    config = LlamaConfig(
+        vocab_size=vocab_size,
+        hidden_size=bench_args.hidden_size,
+        intermediate_size=bench_args.intermediate_size,
+        num_hidden_layers=bench_args.num_hidden_layers,
+        num_attention_heads=bench_args.num_attention_heads,
+        max_position_embeddings=max_length,
+    )
+    return LlamaForCausalLM(config)
+
+
+def _create_batch(batch_size: int, cutoff_len: int, vocab_size: int) -> Dict[str, "torch.Tensor"]:
+    r"""
+    Creates 2 * batch_size random rows, the first half of each row being the prompt.
+    """
+    input_ids = torch.randint(0, vocab_size, (2 * batch_size, cutoff_len))
+    labels = input_ids.clone()
+    labels[:, : cutoff_len // 2] = IGNORE_INDEX
+    return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids), "labels": labels}
+
+
+def _wrap_phase(func: Callable[..., Any], recorder: "PhaseRecorder", name: str, parent: Optional[str]) -> Callable:
+    @wraps(func)
+    def wrapper(*args, **kwargs) -> Any:
+        with recorder.phase(name, parent):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def _record_trainer_phases(trainer: "CustomDPOTrainer", recorder: "PhaseRecorder") -> Generator[None, None, None]:
+    r"""
+    Wraps the methods called by `get_batch_loss_metrics` to record their phases, the calls to `concatenated_forward`
+    made by the frozen models are recorded in the reference and reward phases.
+    """
+    method_phases = {
+        "concatenated_forward": ("policy_forward", None),
+        "compute_reference_log_probs": ("reference_forward", None),
+        "compute_reward_log_probs": ("reward_forward", None),
+        "compute_preference_loss": ("loss", None),
+    }
+    for method_name, (name, parent) in method_phases.items():
+        setattr(trainer, method_name, _wrap_phase(getattr(trainer, method_name), recorder, name, parent))
+
+    get_batch_logps = sail_trainer.get_batch_logps
+    sail_trainer.get_batch_logps = _wrap_phase(get_batch_logps, recorder, "get_batch_logps", "policy_forward")
+    try:
+        yield
+    finally:
+        sail_trainer.get_batch_logps = get_batch_logps
+        for method_name in method_phases:
+            delattr(trainer, method_name)
+
+
+def _run_step(trainer: "CustomDPOTrainer", batch: Dict[str, "torch.Tensor"], recorder: "PhaseRecorder") -> None:
+    r"""
+    Runs `get_batch_loss_metrics` of the trainer with its phases recorded, followed by the backward pass
+    and the optimizer step of the accelerator.
+    """
+    with _record_trainer_phases(trainer, recorder):
+        loss, _ = trainer.get_batch_loss_metrics(trainer.model, dict(batch))
+
+    with recorder.phase("backward"):
+        trainer.accelerator.backward(loss)
+
+    with recorder.phase("optimizer_step"):
+        trainer.optimizer.step()
+        trainer.optimizer.zero_grad(set_to_none=True)
+
+
+def benchmark_sail_step(
+    bench_args: "BenchmarkArguments",
+    cutoff_len: int,
+    batch_size: int,
+    vocab_size: int,
+    lora_layer_range: str,
+    pref_loss: str,
+    output_dir: str,
+) -> Dict[str, Any]:
+    r"""
+    Benchmarks the phases of a SAIL training step with the LoRA policy, the adapter-disabled reference model
+    and a standalone reward model, all randomly initialized.
+    """
+    finetuning_args = FinetuningArguments(
+        stage="sail",
+        finetuning_type="lora",
+        lora_rank=bench_args.lora_rank,
+        lora_layer_range=lora_layer_range,
+        pref_loss=pref_loss,
+        pref_response_logits_only=False,  # keep the output layer and `get_batch_logps` as separate phases
+    )
+    finetuning_args.use_ref_model = pref_loss not in ["orpo", "simpo"]
+
+    model = _create_tiny_model(bench_args, vocab_size, cutoff_len)
+    target_modules = find_sail_lora_target_modules(
+        model, find_all_linear_modules(model, freeze_vision_tower=False), finetuning_args.lora_layer_range, False
+    )
+    if len(target_modules) == 0:
+        raise ValueError(f"No target modules found for the specified layer range: {lora_layer_range}")
+
+    lora_config = LoraConfig(
+        task_type=TaskType.CAUSAL_LM,
+        r=finetuning_args.lora_rank,
+        lora_alpha=finetuning_args.lora_alpha,
+        lora_dropout=finetuning_args.lora_dropout,
+        target_modules=target_modules,
+    )
+    model = get_peft_model(model, lora_config)
+    reward_model = _create_tiny_model(bench_args, vocab_size, cutoff_len)
+    training_args = Seq2SeqTrainingArguments(
+        output_dir=output_dir,
+        per_device_train_batch_size=batch_size,
+        remove_unused_columns=False,
+        report_to="none",
+        use_cpu=bench_args.use_cpu,
+    )
+    trainer = CustomDPOTrainer(
+        model=model,
+        ref_model=None,
+        reward_model=reward_model,
+        finetuning_args=finetuning_args,
+        processor=None,
+        args=training_args,
+    )
+    trainer.create_optimizer()
+    model.train()
+
+    recorder = PhaseRecorder(trainer.args.device)
+    batch = trainer._prepare_inputs(_create_batch(batch_size, cutoff_len, vocab_size))
+    for _ in range(bench_args.warmup_steps):
+        _run_step(trainer, batch, recorder)
+
+    recorder.timing = True
+    for _ in range(bench_args.num_steps):
+        _run_step(trainer, batch, recorder)
+
+    recorder.timing = False
+    if trainer.args.device.type == "cpu":
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+            _run_step(trainer, batch, recorder)
+
+        recorder.record_profile(prof)
+
+    phases = recorder.summary()
+    return {
+        "cutoff_len": cutoff_len,
+        "batch_size": batch_size,
+        "vocab_size": vocab_size,
+        "lora_layer_range": lora_layer_range,
+        "pref_loss": pref_loss,
+        "phases": phases,
+        "step_time_ms": sum(phase["time_ms"] for phase in phases.values()),
+    }
+
+
+def run_sail_bench(args: Optional[Dict[str, Any]] = None) -> None:
+    bench_args = get_bench_args(args)
+    results = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        for cutoff_len, batch_size, vocab_size, lora_layer_range, pref_loss in itertools.product(
+            bench_args.cutoff_lens,
+            bench_args.batch_sizes,
+            bench_args.vocab_sizes,
+            bench_args.lora_layer_ranges,
+            bench_args.pref_losses,
+        ):
+            torch.manual_seed(bench_args.seed)
+            result = benchmark_sail_step(
+                bench_args, cutoff_len, batch_size, vocab_size, lora_layer_range, pref_loss, output_dir
+            )
+            results.append(result)
+            logger.info_rank0(
+                f"cutoff_len={cutoff_len}, batch_size={batch_size}, vocab_size={vocab_size}, "
+                f"lora_layer_range={lora_layer_range}, pref_loss={pref_loss}: {result['step_time_ms']:.2f} ms/step"
+            )
+
+    report = {
+        "environment": {
+            "llamafactory": VERSION,
+            "commit": _get_git_commit(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "device": "cpu" if bench_args.use_cpu or not torch.cuda.is_available() else torch.cuda.get_device_name(),
+            "num_threads": torch.get_num_threads(),
+        },
+        "model": {
+            "hidden_size": bench_args.hidden_size,
+            "intermediate_size": bench_args.intermediate_size,
+            "num_hidden_layers": bench_args.num_hidden_layers,
+            "num_attention_heads": bench_args.num_attention_heads,
+            "lora_rank": bench_args.lora_rank,
+        },
+        "steps": {"warmup": bench_args.warmup_steps, "timed": bench_args.num_steps},
+        "results": results,
+    }
+    output_dir = os.path.dirname(os.path.abspath(bench_args.output_path))
+    os.makedirs(output_dir, exist_ok=True)
+    with open(bench_args.output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    logger.info_rank0(f"Benchmark results saved at: {bench_args.output_path}")
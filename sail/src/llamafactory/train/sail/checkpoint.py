@@ -0,0 +1,336 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import dataclasses
+import json
+import os
+import random
+import re
+import shutil
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from transformers import TrainerCallback
+from transformers.trainer import SCHEDULER_NAME, TRAINER_STATE_NAME
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+from typing_extensions import override
+
+from ...extras import logging
+
+
+if TYPE_CHECKING:
+    from transformers import TrainerControl, TrainerState, TrainingArguments
+
+
+logger = logging.get_logger(__name__)
+
+
+ADAPTER_CHECKPOINT_NAME = "adapter_checkpoint.json"
+ADAPTER_SHARD_NAME = "adapter_shard_rank{}.pt"
+
+
+def get_rng_state_name(process_index: int, world_size: int) -> str:
+    r"""
+    Returns the file name of the RNG states loaded by the trainer when resuming.
+    """
+    return "rng_state.pth" if world_size <= 1 else f"rng_state_{process_index}.pth"
+
+
+def get_rng_state(all_devices: bool) -> Dict[str, Any]:
+    r"""
+    Collects the RNG states in the same format as the trainer.
+    """
+    rng_state = {"python": random.getstate(), "numpy": np.random.get_state(), "cpu": torch.random.get_rng_state()}
+    if torch.cuda.is_available():
+        rng_state["cuda"] = torch.cuda.random.get_rng_state_all() if all_devices else torch.cuda.random.get_rng_state()
+
+    return rng_state
+
+
+def is_adapter_checkpoint(checkpoint_dir: str) -> bool:
+    return os.path.isfile(os.path.join(checkpoint_dir, ADAPTER_CHECKPOINT_NAME))
+
+
+def _get_trainable_parameters(model: "torch.nn.Module") -> Dict[str, "torch.nn.Parameter"]:
+    r"""
+    Returns the trainable parameters, which are the local shards of the original parameters under FSDP.
+    """
+    return {name: param for name, param in model.named_parameters() if param.requires_grad}
+
+
+def _save_atomic(obj: Any, path: str) -> None:
+    torch.save(obj, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def _barrier() -> None:
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        torch.distributed.barrier()
+
+
+class AsyncAdapterCheckpointer:
+    r"""
+    Saves the trainable parameters and their optimizer states in the background, without gathering the model.
+
+    Each process snapshots its local shards to host memory and writes them from a background thread, the main
+    process then renames the temporary directory to `checkpoint-<step>` once all the shards are written, and keeps
+    the last `save_total_limit` checkpoints. At most one checkpoint is written at a time.
+
+    If the parameters are not sharded (e.g. DDP), only the main process writes them.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        process_index: int,
+        world_size: int,
+        sharded: bool,
+        save_total_limit: Optional[int] = None,
+        timeout: float = 1800.0,
+    ) -> None:
+        self.output_dir = output_dir
+        self.process_index = process_index
+        self.world_size = world_size
+        self.num_shards = world_size if sharded else 1
+        self.save_total_limit = save_total_limit
+        self.timeout = timeout
+        self._buffers: Dict[str, "torch.Tensor"] = {}
+        self._thread: Optional["threading.Thread"] = None
+        self._exception: Optional[BaseException] = None
+
+    def _copy_to_host(self, key: str, tensor: "torch.Tensor") -> "torch.Tensor":
+        r"""
+        Copies the tensor into a reused host buffer, which is pinned for device tensors.
+        """
+        buffer = self._buffers.get(key)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=tensor.is_cuda)
+            self._buffers[key] = buffer
+
+        buffer.copy_(tensor.detach(), non_blocking=True)
+        return buffer
+
+    def snapshot(self, model: "torch.nn.Module", optimizer: "torch.optim.Optimizer") -> Dict[str, Dict[str, Any]]:
+        r"""
+        Copies the trainable parameters and their optimizer states to host memory.
+        """
+        optimizer = getattr(optimizer, "optimizer", optimizer)  # unwrap the accelerated optimizer
+        params, optimizer_states = {}, {}
+        for name, param in _get_trainable_parameters(model).items():
+            params[name] = self._copy_to_host(f"param.{name}", param)
+            state = optimizer.state.get(param, {})
+            optimizer_states[name] = {
+                key: self._copy_to_host(f"optimizer.{name}.{key}", value) if torch.is_tensor(value) else value
+                for key, value in state.items()
+            }
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        return {"params": params, "optimizer": optimizer_states}
+
+    def save(
+        self,
+        step: int,
+        model: "torch.nn.Module",
+        optimizer: "torch.optim.Optimizer",
+        lr_scheduler: Optional["torch.optim.lr_scheduler.LRScheduler"],
+        state: "TrainerState",
+        extra_files: Optional[Dict[str, str]] = None,
+        rng_state: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        r"""
+        Snapshots the training states and returns once the background writer has been started.
+
+        The extra text files (e.g. the sampler state) are written by the main process, the RNG states are written
+        by each process before returning.
+        """
+        self.wait()  # the host buffers are reused
+        shard = self.snapshot(model, optimizer) if self.process_index < self.num_shards else None
+        extra_files = dict(extra_files or {}) if self.process_index == 0 else {}
+        if self.process_index == 0:
+            extra_files[TRAINER_STATE_NAME] = json.dumps(dataclasses.asdict(state), indent=2, sort_keys=True) + "\n"
+            if lr_scheduler is not None:
+                extra_files[SCHEDULER_NAME] = lr_scheduler.state_dict()
+
+        tmp_dir = os.path.join(self.output_dir, f"tmp-{PREFIX_CHECKPOINT_DIR}-{step}")
+        if self.process_index == 0:
+            shutil.rmtree(tmp_dir, ignore_errors=True)  # remove the leftovers of an interrupted save
+            os.makedirs(tmp_dir)
+
+        _barrier()
+        if rng_state is not None:
+            _save_atomic(rng_state, os.path.join(tmp_dir, get_rng_state_name(self.process_index, self.world_size)))
+
+        if shard is None:
+            return
+
+        file_names = [ADAPTER_SHARD_NAME.format(rank) for rank in range(self.num_shards)]
+        if rng_state is not None:
+            file_names += [get_rng_state_name(rank, self.world_size) for rank in range(self.world_size)]
+
+        self._thread = threading.Thread(
+            target=self._write, args=(step, tmp_dir, shard, extra_files, file_names), daemon=True
+        )
+        self._thread.start()
+
+    def _write(
+        self, step: int, tmp_dir: str, shard: Dict[str, Any], extra_files: Dict[str, Any], file_names: List[str]
+    ) -> None:
+        try:
+            start_time = time.perf_counter()
+            _save_atomic(shard, os.path.join(tmp_dir, ADAPTER_SHARD_NAME.format(self.process_index)))
+            if self.process_index != 0:
+                return
+
+            for name, obj in extra_files.items():
+                if isinstance(obj, str):
+                    with open(os.path.join(tmp_dir, name), "w", encoding="utf-8") as f:
+                        f.write(obj)
+                else:
+                    _save_atomic(obj, os.path.join(tmp_dir, name))
+
+            self._wait_for_files(tmp_dir, file_names)
+            with open(os.path.join(tmp_dir, ADAPTER_CHECKPOINT_NAME), "w", encoding="utf-8") as f:
+                json.dump({"step": step, "num_shards": self.num_shards}, f, indent=2)
+
+            checkpoint_dir = os.path.join(self.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{step}")
+            self._rename(tmp_dir, checkpoint_dir)
+            self._rotate_checkpoints()
+            logger.info(f"Saved adapter checkpoint to {checkpoint_dir} in {time.perf_counter() - start_time:.2f}s.")
+        except BaseException as exception:
+            self._exception = exception
+
+    def _wait_for_files(self, tmp_dir: str, file_names: List[str]) -> None:
+        r"""
+        Waits for the files written by all the processes, i.e., the adapter shards and the RNG states.
+        """
+        deadline = time.monotonic() + self.timeout
+        file_paths = [os.path.join(tmp_dir, file_name) for file_name in file_names]
+        while not all(os.path.isfile(path) for path in file_paths):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for the checkpoint files in {tmp_dir}.")
+
+            time.sleep(1.0)
+
+    def _rename(self, tmp_dir: str, checkpoint_dir: str) -> None:
+        r"""
+        Renames the directory in one step. If callbacks have created the checkpoint directory (e.g. to save the
+        processor), moves the files into it with the marker file being the last one.
+        """
+        if not os.path.exists(checkpoint_dir):
+            os.replace(tmp_dir, checkpoint_dir)
+            return
+
+        names = sorted(os.listdir(tmp_dir), key=lambda name: name == ADAPTER_CHECKPOINT_NAME)
+        for name in names:
+            os.replace(os.path.join(tmp_dir, name), os.path.join(checkpoint_dir, name))
+
+        os.rmdir(tmp_dir)
+
+    def _rotate_checkpoints(self) -> None:
+        if self.save_total_limit is None or self.save_total_limit <= 0:
+            return
+
+        checkpoints: List[Tuple[int, str]] = []
+        for name in os.listdir(self.output_dir):
+            match = re.fullmatch(rf"{PREFIX_CHECKPOINT_DIR}-(\d+)", name)
+            path = os.path.join(self.output_dir, name)
+            if match is not None and is_adapter_checkpoint(path):
+                checkpoints.append((int(match.group(1)), path))
+
+        for _, path in sorted(checkpoints)[: -self.save_total_limit]:
+            logger.info(f"Deleting older checkpoint [{path}] due to args.save_total_limit.")
+            shutil.rmtree(path, ignore_errors=True)
+
+    def wait(self) -> None:
+        r"""
+        Waits for the checkpoint being written, re-raises the exception of the writer if any.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._exception is not None:
+            exception, self._exception = self._exception, None
+            raise RuntimeError("Failed to save the adapter checkpoint.") from exception
+
+
+def _load_adapter_shard(checkpoint_dir: str, process_index: int) -> Dict[str, Dict[str, Any]]:
+    with open(os.path.join(checkpoint_dir, ADAPTER_CHECKPOINT_NAME), encoding="utf-8") as f:
+        num_shards = json.load(f)["num_shards"]
+
+    shard_rank = process_index if num_shards > 1 else 0
+    shard_path = os.path.join(checkpoint_dir, ADAPTER_SHARD_NAME.format(shard_rank))
+    if not os.path.isfile(shard_path):
+        raise ValueError(f"Adapter checkpoint is saved in {num_shards} shards, cannot be resumed by this process.")
+
+    return torch.load(shard_path, map_location="cpu")
+
+
+def load_adapter_params(checkpoint_dir: str, model: "torch.nn.Module", process_index: int) -> None:
+    r"""
+    Loads the trainable parameters of the current process, the sharding must match the saving run.
+    """
+    shard = _load_adapter_shard(checkpoint_dir, process_index)
+    params = _get_trainable_parameters(model)
+    if set(params.keys()) != set(shard["params"].keys()):
+        raise ValueError("The trainable parameters do not match the adapter checkpoint.")
+
+    with torch.no_grad():
+        for name, param in params.items():
+            param.copy_(shard["params"][name])
+
+    logger.info_rank0(f"Loaded adapter checkpoint from {checkpoint_dir}.")
+
+
+def load_adapter_optimizer_and_scheduler(
+    checkpoint_dir: str,
+    model: "torch.nn.Module",
+    optimizer: "torch.optim.Optimizer",
+    lr_scheduler: Optional["torch.optim.lr_scheduler.LRScheduler"],
+    process_index: int,
+) -> None:
+    r"""
+    Loads the optimizer states of the trainable parameters and the scheduler state.
+    """
+    shard = _load_adapter_shard(checkpoint_dir, process_index)
+    optimizer = getattr(optimizer, "optimizer", optimizer)
+    for name, param in _get_trainable_parameters(model).items():
+        state = shard["optimizer"].get(name, {})
+        if len(state) != 0:  # keep the step counters on cpu as the optimizer does
+            optimizer.state[param] = {
+                key: value.to(param.device) if torch.is_tensor(value) and value.dim() != 0 else value
+                for key, value in state.items()
+            }
+
+    scheduler_path = os.path.join(checkpoint_dir, SCHEDULER_NAME)
+    if lr_scheduler is not None and os.path.isfile(scheduler_path):
+        lr_scheduler.load_state_dict(torch.load(scheduler_path))
+
+
+class AsyncCheckpointCallback(TrainerCallback):
+    r"""
+    Waits for the last checkpoint at the end of training.
+    """
+
+    def __init__(self, checkpointer: "AsyncAdapterCheckpointer") -> None:
+        self.checkpointer = checkpointer
+
+    @override
+    def on_train_end(self, args: "TrainingArguments", state: "TrainerState", control: "TrainerControl", **kwargs):
+        self.checkpointer.wait()
@@ -0,0 +1,248 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+from typing import TYPE_CHECKING, Any, Dict, List, Literal, Optional, Sequence
+
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+
+from ...data import iter_pairwise_examples
+from ...extras import logging
+from ...extras.constants import IGNORE_INDEX
+from ..trainer_utils import get_sail_reward_model_args
+
+
+if TYPE_CHECKING:
+    from datasets import Dataset
+
+    from ...hparams import DataArguments, FinetuningArguments, ModelArguments
+
+
+logger = logging.get_logger(__name__)
+
+
+SAIL_CACHE_KEYS = ("ref", "reward")
+SAMPLE_INDEX_COLUMN = "sample_index"
+CACHE_META_NAME = "meta.json"
+CACHE_OFFSETS_NAME = "offsets.npy"
+CACHE_FILLED_NAME = "filled.npy"
+
+
+def _get_logps_name(key: str) -> str:
+    return f"{key}_logps.npy"
+
+
+def get_response_segment_lengths(dataset: "Dataset") -> List[int]:
+    r"""
+    Counts the response tokens of each segment (chosen, rejected), only needed to allocate the cache.
+    """
+    segment_lengths = []
+    for example in iter_pairwise_examples(dataset):
+        for key in ("chosen", "rejected"):
+            labels = np.asarray(example[f"{key}_labels"], dtype=np.int64)
+            segment_lengths.append(int((labels[1:] != IGNORE_INDEX).sum()))
+
+    return segment_lengths
+
+
+def _get_dataset_fingerprint(dataset: "Dataset") -> str:
+    r"""
+    Returns the fingerprint of the tokenized dataset tracked by `datasets`, instead of hashing the tokens.
+
+    The fingerprint of the first process is used by all the processes, in case it is randomly generated.
+    """
+    fingerprint = [f"{dataset._fingerprint}-{len(dataset)}"]
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        torch.distributed.broadcast_object_list(fingerprint, src=0)
+
+    return fingerprint[0]
+
+
+def _get_frozen_model_signature(
+    model_args: "ModelArguments", finetuning_args: "FinetuningArguments"
+) -> Dict[str, Dict[str, Any]]:
+    if finetuning_args.ref_model is not None:
+        ref_signature = {
+            "path": finetuning_args.ref_model,
+            "adapters": finetuning_args.ref_model_adapters,
+            "quantization_bit": finetuning_args.ref_model_quantization_bit,
+        }
+    else:
+        ref_signature = {
+            "path": model_args.model_name_or_path,
+            "adapters": finetuning_args.ref_model_adapters,
+            "quantization_bit": model_args.quantization_bit,
+        }
+
+    reward_model_args = get_sail_reward_model_args(model_args, finetuning_args)
+    reward_signature = {
+        "path": reward_model_args.model_name_or_path,
+        "adapters": reward_model_args.adapter_name_or_path,
+        "quantization_bit": reward_model_args.quantization_bit,
+        "dtype": finetuning_args.sail_reward_model_dtype,
+    }
+    return {"ref": ref_signature, "reward": reward_signature}
+
+
+def get_sail_cache_path(
+    dataset: "Dataset",
+    model_args: "ModelArguments",
+    data_args: "DataArguments",
+    finetuning_args: "FinetuningArguments",
+) -> str:
+    r"""
+    Returns the cache directory keyed by the dataset, template and frozen model fingerprints.
+    """
+    signature = {
+        "dataset": _get_dataset_fingerprint(dataset),
+        "template": data_args.template,
+        "cutoff_len": data_args.cutoff_len,
+        "compute_dtype": str(model_args.compute_dtype),
+        "models": _get_frozen_model_signature(model_args, finetuning_args),
+    }
+    fingerprint = hashlib.sha256(json.dumps(signature, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(finetuning_args.sail_logps_cache_dir, fingerprint)
+
+
+def add_sample_index(dataset: "Dataset") -> "Dataset":
+    r"""
+    Adds the position of each example so that the collated batches can be looked up in the cache.
+    """
+    if SAMPLE_INDEX_COLUMN in dataset.column_names:
+        dataset = dataset.remove_columns(SAMPLE_INDEX_COLUMN)
+
+    return dataset.add_column(SAMPLE_INDEX_COLUMN, list(range(len(dataset))))
+
+
+class SailLogpsCache:
+    r"""
+    Stores the per-token log probabilities of the frozen (reference and reward) models.
+
+    Only response tokens are kept. Each example owns two segments (chosen, rejected) in a flat float16
+    buffer per model, the boundaries of segment `2 * i + j` are `offsets[2 * i + j]` and `offsets[2 * i + j + 1]`.
+    """
+
+    def __init__(self, cache_dir: str, mode: Literal["r", "r+"] = "r") -> None:
+        self.cache_dir = cache_dir
+        self.offsets: "np.ndarray" = np.load(os.path.join(cache_dir, CACHE_OFFSETS_NAME))
+        self.filled: "np.ndarray" = np.load(os.path.join(cache_dir, CACHE_FILLED_NAME), mmap_mode=mode)
+        self.logps: Dict[str, "np.ndarray"] = {
+            key: np.load(os.path.join(cache_dir, _get_logps_name(key)), mmap_mode=mode) for key in SAIL_CACHE_KEYS
+        }
+
+    @classmethod
+    def create(cls, cache_dir: str, segment_lengths: Sequence[int], signature: Dict[str, str]) -> None:
+        r"""
+        Allocates an empty cache on disk, should be called on the main process only.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        offsets = np.zeros(len(segment_lengths) + 1, dtype=np.int64)
+        np.cumsum(np.asarray(segment_lengths, dtype=np.int64), out=offsets[1:])
+        np.save(os.path.join(cache_dir, CACHE_OFFSETS_NAME), offsets)
+        open_memmap(
+            os.path.join(cache_dir, CACHE_FILLED_NAME), mode="w+", dtype=np.bool_, shape=(len(segment_lengths) // 2,)
+        ).flush()
+        for key in SAIL_CACHE_KEYS:
+            open_memmap(
+                os.path.join(cache_dir, _get_logps_name(key)), mode="w+", dtype=np.float16, shape=(int(offsets[-1]),)
+            ).flush()
+
+        with open(os.path.join(cache_dir, CACHE_META_NAME), "w", encoding="utf-8") as f:
+            json.dump(signature, f, indent=2)
+
+    @staticmethod
+    def exists(cache_dir: str) -> bool:
+        return os.path.isfile(os.path.join(cache_dir, CACHE_META_NAME))
+
+    def __len__(self) -> int:
+        return len(self.filled)
+
+    def _get_segments(self, sample_index: "torch.Tensor") -> List[int]:
+        r"""
+        Returns the segment ids following the row order of the collated batch (chosen first, then rejected).
+        """
+        indices = sample_index.tolist()
+        return [2 * index for index in indices] + [2 * index + 1 for index in indices]
+
+    def write(
+        self, key: str, sample_index: "torch.Tensor", per_token_logps: "torch.Tensor", mask: "torch.Tensor"
+    ) -> None:
+        r"""
+        Writes the masked per-token log probabilities of shape (2 * batch_size, seq_len).
+        """
+        per_token_logps = per_token_logps.detach().to(device="cpu", dtype=torch.float16).numpy()
+        mask = mask.cpu().numpy()
+        for row, segment in enumerate(self._get_segments(sample_index)):
+            start, end = self.offsets[segment], self.offsets[segment + 1]
+            values = per_token_logps[row][mask[row]]
+            if len(values) != end - start:
+                raise ValueError("The batch does not match the cached dataset, please check the data arguments.")
+
+            self.logps[key][start:end] = values
+
+    def mark_filled(self, sample_index: "torch.Tensor") -> None:
+        self.filled[sample_index.cpu().numpy()] = True
+
+    def read(self, key: str, sample_index: "torch.Tensor", mask: "torch.Tensor") -> Optional["torch.Tensor"]:
+        r"""
+        Reads the per-token log probabilities into a zero tensor shaped like `mask`.
+
+        Returns None on a cache miss, e.g. unfilled examples or mismatched lengths.
+        """
+        indices = sample_index.cpu().numpy()
+        if indices.max(initial=-1) >= len(self) or not self.filled[indices].all():
+            return None
+
+        values = []
+        for segment, valid_length in zip(self._get_segments(sample_index), mask.sum(-1).tolist()):
+            start, end = self.offsets[segment], self.offsets[segment + 1]
+            if end - start != valid_length:
+                return None
+
+            values.append(self.logps[key][start:end])
+
+        per_token_logps = torch.zeros(mask.size(), dtype=torch.float32, device=mask.device)
+        per_token_logps[mask] = torch.from_numpy(np.concatenate(values)).to(mask.device, torch.float32)
+        return per_token_logps
+
+    def flush(self) -> None:
+        self.filled.flush()
+        for logps in self.logps.values():
+            logps.flush()
+
+
+def load_sail_logps_cache(
+    dataset: "Dataset",
+    model_args: "ModelArguments",
+    data_args: "DataArguments",
+    finetuning_args: "FinetuningArguments",
+) -> Optional["SailLogpsCache"]:
+    r"""
+    Opens the precomputed cache of the dataset if it exists.
+    """
+    cache_dir = get_sail_cache_path(dataset, model_args, data_args, finetuning_args)
+    if not SailLogpsCache.exists(cache_dir):
+        logger.warning_rank0(f"Frozen log probabilities are not cached in {cache_dir}, computing them on the fly.")
+        return None
+
+    cache = SailLogpsCache(cache_dir)
+    logger.info_rank0(f"Loaded cached frozen log probabilities from {cache_dir}.")
+    if not cache.filled.all():
+        logger.warning_rank0("The cache is incomplete, missing examples will be computed on the fly.")
+
+    return cache
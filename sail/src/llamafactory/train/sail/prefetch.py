@@ -0,0 +1,183 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from queue import Empty, Full, Queue
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+import torch
+
+
+FROZEN_LOGPS_KEY = "frozen_logps"
+_END_OF_DATA = object()
+
+
+class _ProducerError:
+    def __init__(self, exception: BaseException) -> None:
+        self.exception = exception
+
+
+def _put(queue: "Queue", item: Any, stop_event: "threading.Event") -> bool:
+    r"""
+    Puts the item into the bounded queue, gives up if the consumer has stopped.
+    """
+    while not stop_event.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            continue
+
+    return False
+
+
+def _record_stream(outputs: Any, stream: "torch.cuda.Stream") -> None:
+    r"""
+    Marks the tensors produced on the side stream as used by the consumer stream, so that their memory is not reused
+    by the producer before the consumer is done with them.
+    """
+    if isinstance(outputs, torch.Tensor):
+        if outputs.is_cuda:
+            outputs.record_stream(stream)
+    elif isinstance(outputs, dict):
+        for value in outputs.values():
+            _record_stream(value, stream)
+    elif isinstance(outputs, (list, tuple)):
+        for value in outputs:
+            _record_stream(value, stream)
+
+
+class FrozenLogpsPrefetcher:
+    r"""
+    Wraps a dataloader to compute the log probabilities of the frozen models ahead of the training steps.
+
+    A background thread pulls the batches from the dataloader, attaches the outputs of `compute_fn` to them as
+    `frozen_logps`, and hands them off through a queue holding at most `num_batches` batches.
+    On a CUDA device, the thread launches its kernels on a dedicated stream, and the consumer stream waits for
+    the event recorded after each batch, so the frozen models overlap with the training step.
+    Other attributes (e.g. `set_epoch`) are forwarded to the wrapped dataloader.
+    """
+
+    def __init__(
+        self,
+        dataloader: Iterable[Dict[str, Any]],
+        compute_fn: Callable[[Dict[str, Any]], Dict[str, Any]],
+        num_batches: int = 1,
+        device: Optional["torch.device"] = None,
+    ) -> None:
+        self.dataloader = dataloader
+        self.compute_fn = compute_fn
+        self.num_batches = num_batches
+        self.device = device
+
+    def __getattr__(self, name: str) -> Any:
+        if name == "dataloader":  # not initialized yet
+            raise AttributeError(name)
+
+        return getattr(self.dataloader, name)
+
+    def __len__(self) -> int:
+        return len(self.dataloader)
+
+    def rewrap(self, dataloader: Iterable[Dict[str, Any]]) -> "FrozenLogpsPrefetcher":
+        r"""
+        Wraps another dataloader with the same settings, e.g. the one skipping the consumed batches on resume.
+        """
+        return FrozenLogpsPrefetcher(dataloader, self.compute_fn, self.num_batches, self.device)
+
+    def _use_cuda_stream(self) -> bool:
+        return self.device is not None and self.device.type == "cuda"
+
+    def _produce(self, queue: "Queue", stop_event: "threading.Event") -> None:
+        try:
+            stream = None
+            if self._use_cuda_stream():
+                torch.cuda.set_device(self.device)  # the current device is not inherited by the thread
+                stream = torch.cuda.Stream(self.device)
+
+            for batch in self.dataloader:
+                if stop_event.is_set():
+                    return
+
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch[FROZEN_LOGPS_KEY] = self.compute_fn(batch)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+
+                    item = (batch, event)
+                else:
+                    batch[FROZEN_LOGPS_KEY] = self.compute_fn(batch)
+                    item = (batch, None)
+
+                if not _put(queue, item, stop_event):
+                    return
+        except BaseException as exception:
+            _put(queue, _ProducerError(exception), stop_event)
+            return
+
+        _put(queue, _END_OF_DATA, stop_event)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        queue = Queue(maxsize=self.num_batches)
+        stop_event = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(queue, stop_event), daemon=True)
+        producer.start()
+        try:
+            while True:
+                try:
+                    item = queue.get(timeout=1.0)
+                except Empty:
+                    if not producer.is_alive():
+                        raise RuntimeError("The frozen log probabilities producer exited unexpectedly.")
+
+                    continue
+
+                if item is _END_OF_DATA:
+                    break
+
+                if isinstance(item, _ProducerError):
+                    raise item.exception
+
+                batch, event = item
+                if event is not None:
+                    consumer_stream = torch.cuda.current_stream(self.device)
+                    consumer_stream.wait_event(event)
+                    _record_stream(batch[FROZEN_LOGPS_KEY], consumer_stream)
+
+                yield batch
+        finally:
+            stop_event.set()
+            producer.join()
+
+
+def patch_skip_first_batches() -> None:
+    r"""
+    Patches the batch skipping of the Trainer on resume, which rebuilds a plain dataloader from the attributes of
+    the prefetcher, to skip the batches inside the wrapped dataloader and keep prefetching.
+    """
+    import transformers.trainer
+
+    skip_first_batches = transformers.trainer.skip_first_batches
+    if getattr(skip_first_batches, "_keeps_prefetcher", False):
+        return
+
+    def _skip_first_batches(dataloader: Iterable[Dict[str, Any]], num_batches: int = 0) -> Iterable[Dict[str, Any]]:
+        if isinstance(dataloader, FrozenLogpsPrefetcher):
+            return dataloader.rewrap(skip_first_batches(dataloader.dataloader, num_batches))
+
+        return skip_first_batches(dataloader, num_batches)
+
+    _skip_first_batches._keeps_prefetcher = True
+    transformers.trainer.skip_first_batches = _skip_first_batches
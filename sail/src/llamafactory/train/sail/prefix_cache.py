@@ -0,0 +1,155 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+from typing import TYPE_CHECKING, Any, Dict, List, Literal, Optional, Sequence
+
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+
+from ...data import is_compact_pairwise_dataset
+
+
+if TYPE_CHECKING:
+    from datasets import Dataset
+
+
+CACHE_META_NAME = "meta.json"
+CACHE_OFFSETS_NAME = "offsets.npy"
+CACHE_FILLED_NAME = "filled.npy"
+CACHE_HIDDEN_STATES_NAME = "hidden_states.npy"
+
+
+def get_pairwise_segment_lengths(dataset: "Dataset") -> List[int]:
+    r"""
+    Returns the number of tokens of each segment (chosen, rejected) in the dataset.
+    """
+    segment_lengths = []
+    if is_compact_pairwise_dataset(dataset):  # read the lengths only
+        columns = ["prompt_length", "chosen_length", "rejected_length"]
+        for batch in dataset.select_columns(columns).iter(batch_size=1024):
+            for prompt_len, chosen_len, rejected_len in zip(*(batch[column] for column in columns)):
+                segment_lengths += [prompt_len + chosen_len, prompt_len + rejected_len]
+
+        return segment_lengths
+
+    for batch in dataset.select_columns(["chosen_input_ids", "rejected_input_ids"]).iter(batch_size=1024):
+        for chosen_ids, rejected_ids in zip(batch["chosen_input_ids"], batch["rejected_input_ids"]):
+            segment_lengths += [len(chosen_ids), len(rejected_ids)]
+
+    return segment_lengths
+
+
+class FrozenPrefixCache:
+    r"""
+    Stores the hidden states at the input of the first focal layer, which do not depend on the trainable layers.
+
+    Each example owns two segments (chosen, rejected) of all their tokens in a flat buffer of shape
+    (num_tokens, hidden_size). The 16-bit hidden states are stored bitwise, so bfloat16 is kept as is.
+    """
+
+    def __init__(self, cache_dir: str, mode: Literal["r", "r+"] = "r") -> None:
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, CACHE_META_NAME), encoding="utf-8") as f:
+            self.meta: Dict[str, Any] = json.load(f)
+
+        self.dtype: "torch.dtype" = getattr(torch, self.meta["dtype"])
+        self.offsets: "np.ndarray" = np.load(os.path.join(cache_dir, CACHE_OFFSETS_NAME))
+        self.filled: "np.ndarray" = np.load(os.path.join(cache_dir, CACHE_FILLED_NAME), mmap_mode=mode)
+        self.hidden_states: "np.ndarray" = np.load(os.path.join(cache_dir, CACHE_HIDDEN_STATES_NAME), mmap_mode=mode)
+
+    @classmethod
+    def create(
+        cls, cache_dir: str, segment_lengths: Sequence[int], hidden_size: int, dtype: "torch.dtype", num_layers: int
+    ) -> None:
+        r"""
+        Allocates an empty cache on disk, should be called on the main process only.
+        """
+        if dtype not in [torch.float16, torch.bfloat16]:
+            raise ValueError("Only 16-bit hidden states can be cached.")
+
+        os.makedirs(cache_dir, exist_ok=True)
+        offsets = np.zeros(len(segment_lengths) + 1, dtype=np.int64)
+        np.cumsum(np.asarray(segment_lengths, dtype=np.int64), out=offsets[1:])
+        np.save(os.path.join(cache_dir, CACHE_OFFSETS_NAME), offsets)
+        open_memmap(
+            os.path.join(cache_dir, CACHE_FILLED_NAME), mode="w+", dtype=np.bool_, shape=(len(segment_lengths) // 2,)
+        ).flush()
+        open_memmap(
+            os.path.join(cache_dir, CACHE_HIDDEN_STATES_NAME),
+            mode="w+",
+            dtype=np.int16,
+            shape=(int(offsets[-1]), hidden_size),
+        ).flush()
+        with open(os.path.join(cache_dir, CACHE_META_NAME), "w", encoding="utf-8") as f:
+            json.dump({"dtype": str(dtype).split(".")[-1], "num_layers": num_layers}, f, indent=2)
+
+    @staticmethod
+    def exists(cache_dir: str) -> bool:
+        return os.path.isfile(os.path.join(cache_dir, CACHE_META_NAME))
+
+    def __len__(self) -> int:
+        return len(self.filled)
+
+    def _get_segments(self, sample_index: "torch.Tensor") -> List[int]:
+        r"""
+        Returns the segment ids following the row order of the collated batch (chosen first, then rejected).
+        """
+        indices = sample_index.tolist()
+        return [2 * index for index in indices] + [2 * index + 1 for index in indices]
+
+    def write(
+        self, sample_index: "torch.Tensor", hidden_states: "torch.Tensor", attention_mask: "torch.Tensor"
+    ) -> None:
+        r"""
+        Writes the hidden states of shape (2 * batch_size, seq_len, hidden_size) of the right-padded rows.
+        """
+        hidden_states = hidden_states.detach().to(self.dtype).view(torch.int16).cpu().numpy()
+        lengths = attention_mask.sum(-1).tolist()
+        for row, (segment, length) in enumerate(zip(self._get_segments(sample_index), lengths)):
+            start, end = self.offsets[segment], self.offsets[segment + 1]
+            if length != end - start:
+                raise ValueError("The batch does not match the cached dataset, please check the data arguments.")
+
+            self.hidden_states[start:end] = hidden_states[row, :length]
+
+    def mark_filled(self, sample_index: "torch.Tensor") -> None:
+        self.filled[sample_index.cpu().numpy()] = True
+
+    def read(self, sample_index: "torch.Tensor", attention_mask: "torch.Tensor") -> Optional["torch.Tensor"]:
+        r"""
+        Reads the hidden states into a zero tensor of shape (2 * batch_size, seq_len, hidden_size).
+
+        Returns None on a cache miss, e.g. unfilled examples or mismatched lengths.
+        """
+        indices = sample_index.cpu().numpy()
+        if indices.max(initial=-1) >= len(self) or not self.filled[indices].all():
+            return None
+
+        lengths = attention_mask.sum(-1).tolist()
+        hidden_states = np.zeros((*attention_mask.size(), self.hidden_states.shape[-1]), dtype=np.int16)
+        for row, (segment, length) in enumerate(zip(self._get_segments(sample_index), lengths)):
+            start, end = self.offsets[segment], self.offsets[segment + 1]
+            if end - start != length:
+                return None
+
+            hidden_states[row, :length] = self.hidden_states[start:end]
+
+        return torch.from_numpy(hidden_states).view(self.dtype).to(attention_mask.device, non_blocking=True)
+
+    def flush(self) -> None:
+        self.filled.flush()
+        self.hidden_states.flush()
@@ -0,0 +1,271 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import gc
+import itertools
+import json
+import os
+from dataclasses import replace
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+import numpy as np
+import torch
+import yaml
+from torch.utils.data import DataLoader
+
+from ...data import PairwiseDataCollatorWithPadding, get_dataset, get_template_and_fix_tokenizer
+from ...extras import logging
+from ...extras.constants import IGNORE_INDEX
+from ...model import get_sail_layer_ids, is_frozen_prefix_supported, load_tokenizer, split_decoder_layers
+from .logps_cache import SAMPLE_INDEX_COLUMN, add_sample_index
+from .prefix_cache import FrozenPrefixCache, get_pairwise_segment_lengths
+from .workflow import _get_cacheable_splits, _load_frozen_model, run_sail, run_sail_precompute
+
+
+if TYPE_CHECKING:
+    from datasets import Dataset
+    from transformers import Seq2SeqTrainingArguments, TrainerCallback
+
+    from ...hparams import DataArguments, FinetuningArguments, ModelArguments
+
+
+logger = logging.get_logger(__name__)
+
+
+SWEEP_KEYS = ("lora_layer_range", "sail_alpha", "pref_beta")
+SWEEP_RESULTS_NAME = "sweep_results.json"
+SWEEP_TABLE_NAME = "sweep_results.md"
+TABLE_METRICS = ("train_loss", "train_runtime", "eval_loss", "eval_rewards/accuracies", "eval_rewards/margins")
+
+
+def load_sweep_grid(sweep_grid: str) -> List[Dict[str, Any]]:
+    r"""
+    Loads the sweep points from a JSON/YAML file or a JSON string.
+
+    The grid is either a dict mapping the swept arguments to lists of values, whose cartesian product is taken,
+    or a list of dicts, each being a sweep point.
+    """
+    if os.path.isfile(sweep_grid):
+        with open(sweep_grid, encoding="utf-8") as f:
+            grid = yaml.safe_load(f)
+    else:
+        grid = json.loads(sweep_grid)
+
+    if isinstance(grid, dict):
+        values = [value if isinstance(value, list) else [value] for value in grid.values()]
+        points = [dict(zip(grid.keys(), combination)) for combination in itertools.product(*values)]
+    elif isinstance(grid, list) and all(isinstance(point, dict) for point in grid):
+        points = grid
+    else:
+        raise ValueError("`sail_sweep_grid` should be a dict of lists or a list of dicts.")
+
+    for point in points:
+        unknown_keys = set(point.keys()) - set(SWEEP_KEYS)
+        if unknown_keys:
+            raise ValueError(f"Cannot sweep over {unknown_keys}, supported arguments are {SWEEP_KEYS}.")
+
+    if len(points) == 0:
+        raise ValueError("`sail_sweep_grid` is empty.")
+
+    return points
+
+
+def _can_share_frozen_logps(data_args: "DataArguments", finetuning_args: "FinetuningArguments") -> bool:
+    return (
+        finetuning_args.sail_reward_model is not None
+        and finetuning_args.sail_reward_model_type == "full"
+        and not finetuning_args.sail_padding_free
+        and finetuning_args.sail_prefetch_batches == 0
+        and not data_args.packing
+    )
+
+
+def precompute_frozen_prefix(
+    model_args: "ModelArguments",
+    data_args: "DataArguments",
+    training_args: "Seq2SeqTrainingArguments",
+    dataset_module: Dict[str, "Dataset"],
+    num_layers: List[int],
+    cache_root: str,
+) -> Dict[int, Dict[str, "FrozenPrefixCache"]]:
+    r"""
+    Computes the hidden states at the input of each given layer in one pass of the frozen model.
+
+    Returns the caches keyed by the number of frozen layers and the split.
+    """
+    tokenizer_module = load_tokenizer(model_args)
+    tokenizer = tokenizer_module["tokenizer"]
+    template = get_template_and_fix_tokenizer(tokenizer, data_args)
+    data_collator = PairwiseDataCollatorWithPadding(
+        template=template,
+        pad_to_multiple_of=8,
+        label_pad_token_id=IGNORE_INDEX if data_args.ignore_pad_token_for_loss else tokenizer.pad_token_id,
+        **tokenizer_module,
+    )
+    model = _load_frozen_model(model_args, training_args.device)
+    if not is_frozen_prefix_supported(model):
+        raise ValueError("Current model does not support sharing the frozen prefix.")
+
+    dtype = model.get_input_embeddings().weight.dtype
+    prefix_caches: Dict[int, Dict[str, "FrozenPrefixCache"]] = {layers: {} for layers in num_layers}
+    for split, key in _get_cacheable_splits(dataset_module).items():
+        segment_lengths = get_pairwise_segment_lengths(dataset_module[key])
+        caches = {}
+        for layers in num_layers:
+            cache_dir = os.path.join(cache_root, f"layer_{layers}", split)
+            with training_args.main_process_first(desc="allocate cache"):
+                if training_args.local_process_index == 0 and not FrozenPrefixCache.exists(cache_dir):
+                    FrozenPrefixCache.create(cache_dir, segment_lengths, model.config.hidden_size, dtype, layers)
+
+            caches[layers] = FrozenPrefixCache(cache_dir, mode="r+")
+
+        indices = np.arange(training_args.process_index, len(segment_lengths) // 2, training_args.world_size)
+        filled = np.logical_and.reduce([cache.filled[indices] for cache in caches.values()])
+        indices = indices[~filled].tolist()
+        logger.info_rank0(f"Precomputing frozen hidden states of {len(indices)} {split} examples to {cache_root}.")
+        dataloader = DataLoader(
+            add_sample_index(dataset_module[key]).select(indices),
+            batch_size=training_args.per_device_eval_batch_size,
+            collate_fn=data_collator,
+            num_workers=training_args.dataloader_num_workers,
+            pin_memory=training_args.dataloader_pin_memory,
+        )
+        for batch in dataloader:
+            sample_index = batch.pop(SAMPLE_INDEX_COLUMN)
+            input_ids = batch["input_ids"].to(training_args.device)
+            attention_mask = batch["attention_mask"].to(training_args.device)
+            with torch.no_grad(), split_decoder_layers(model, 0, max(num_layers), return_hidden_states=True):
+                hidden_states = model(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    output_hidden_states=True,
+                    return_dict=True,
+                    use_cache=False,
+                ).hidden_states  # the input of each layer, the last one is not normalized
+
+            for layers, cache in caches.items():
+                cache.write(sample_index, hidden_states[layers], attention_mask)
+                cache.mark_filled(sample_index)
+
+        for cache in caches.values():
+            cache.flush()
+
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.barrier()
+
+        for layers, cache in caches.items():
+            prefix_caches[layers][split] = FrozenPrefixCache(cache.cache_dir)
+
+    del model
+    gc.collect()
+    torch.cuda.empty_cache()
+    return prefix_caches
+
+
+def _save_sweep_results(output_dir: str, results: List[Dict[str, Any]]) -> None:
+    with open(os.path.join(output_dir, SWEEP_RESULTS_NAME), "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    columns = ["point", *SWEEP_KEYS] + [key for key in TABLE_METRICS if any(key in result for result in results)]
+    lines = ["| " + " | ".join(columns) + " |", "|" + "---|" * len(columns)]
+    for result in results:
+        values = []
+        for column in columns:
+            value = result.get(column, "-")
+            values.append(f"{value:.4f}" if isinstance(value, float) else str(value))
+
+        lines.append("| " + " | ".join(values) + " |")
+
+    table = "\n".join(lines)
+    with open(os.path.join(output_dir, SWEEP_TABLE_NAME), "w", encoding="utf-8") as f:
+        f.write(table + "\n")
+
+    logger.info_rank0(f"SAIL sweep results:\n{table}")
+
+
+def run_sail_sweep(
+    model_args: "ModelArguments",
+    data_args: "DataArguments",
+    training_args: "Seq2SeqTrainingArguments",
+    finetuning_args: "FinetuningArguments",
+    callbacks: Optional[List["TrainerCallback"]] = None,
+):
+    r"""
+    Trains a grid of SAIL configs over one tokenized dataset, each in a subdirectory of `output_dir`.
+
+    The log probabilities of the frozen models and, if `sail_share_frozen_prefix` is set, the hidden states below
+    the first focal layer of each config are computed once and shared by all the sweep points.
+    """
+    points = load_sweep_grid(finetuning_args.sail_sweep_grid)
+    point_args = [replace(finetuning_args, sail_sweep_grid=None, **point) for point in points]
+    tokenizer_module = load_tokenizer(model_args)
+    template = get_template_and_fix_tokenizer(tokenizer_module["tokenizer"], data_args)
+    dataset_module = get_dataset(template, model_args, data_args, training_args, stage="rm", **tokenizer_module)
+    logger.info_rank0(f"Tokenized the dataset once for {len(points)} sweep points.")
+
+    if finetuning_args.sail_logps_cache_dir is None and _can_share_frozen_logps(data_args, finetuning_args):
+        logps_cache_dir = os.path.join(training_args.output_dir, "logps_cache")
+        for args in [finetuning_args, *point_args]:
+            args.sail_logps_cache_dir = logps_cache_dir
+
+    if finetuning_args.sail_logps_cache_dir is not None:
+        run_sail_precompute(model_args, data_args, training_args, finetuning_args, dataset_module=dataset_module)
+    else:
+        logger.warning_rank0("Frozen log probabilities cannot be shared, computing them in each sweep point.")
+
+    prefix_caches: Dict[int, Dict[str, "FrozenPrefixCache"]] = {}
+    if finetuning_args.sail_share_frozen_prefix:
+        num_layers = sorted({get_sail_layer_ids(args.lora_layer_range)[0] for args in point_args} - {0})
+        prefix_caches = precompute_frozen_prefix(
+            model_args,
+            data_args,
+            training_args,
+            dataset_module,
+            num_layers,
+            os.path.join(training_args.output_dir, "prefix_cache"),
+        )
+
+    results = []
+    for index, (point, args) in enumerate(zip(points, point_args)):
+        output_dir = os.path.join(training_args.output_dir, f"point_{index}")
+        logger.info_rank0(f"Running sweep point {index + 1}/{len(points)}: {point} in {output_dir}.")
+        point_training_args = copy.deepcopy(training_args)
+        point_training_args.output_dir = output_dir
+        point_training_args.logging_dir = os.path.join(output_dir, "runs")
+        prefix_cache = None
+        if args.sail_share_frozen_prefix:
+            prefix_cache = prefix_caches.get(get_sail_layer_ids(args.lora_layer_range)[0])
+
+        run_sail(
+            copy.deepcopy(model_args),
+            data_args,
+            point_training_args,
+            args,
+            callbacks,
+            dataset_module=dataset_module,
+            prefix_cache=prefix_cache,
+        )
+        result = {"point": index, **point}
+        metrics_path = os.path.join(output_dir, "all_results.json")
+        if os.path.isfile(metrics_path):
+            with open(metrics_path, encoding="utf-8") as f:
+                result.update(json.load(f))
+
+        results.append(result)
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    if training_args.should_save:
+        _save_sweep_results(training_args.output_dir, results)
@@ -14,31 +14,80 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
+import os
 import numpy as np
 import warnings
-from collections import defaultdict
 from contextlib import nullcontext
 from types import MethodType
-from typing import TYPE_CHECKING, Dict, Literal, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Dict, List, Literal, Optional, Tuple, Union
 
 import torch
 import torch.nn.functional as F
-from transformers import Trainer
+from torch.utils.data import DataLoader, IterableDataset
+from transformers import DynamicCache, Trainer
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR
+from transformers.training_args import ParallelMode
 from trl import DPOTrainer
 from trl.trainer import disable_dropout_in_model
 from typing_extensions import override
 
+from ...data import (
+    PromptGroupedBatchSampler,
+    ResumableIterableDataset,
+    ResumableSampler,
+    ShardedJsonlDataset,
+    TokenBudgetBatchSampler,
+    get_pairwise_lengths,
+    get_prompt_groups,
+)
+from ...extras import logging
 from ...extras.constants import IGNORE_INDEX
 from ...extras.packages import is_transformers_version_equal_to_4_46
+from ...model import forward_frozen_prefix, get_sail_layer_ids, is_frozen_prefix_supported, split_decoder_layers
 from ..callbacks import PissaConvertCallback, SaveProcessorCallback
-from ..trainer_utils import create_custom_optimizer, create_custom_scheduler, get_batch_logps
-
+from ..trainer_utils import (
+    MetricsAccumulator,
+    create_custom_optimizer,
+    create_custom_scheduler,
+    get_batch_logps,
+    get_label_batch_logps,
+    is_label_logps_supported,
+    replace_output_layer,
+    unpack_pairwise_logps,
+)
+
+from .adapters import (
+    activate_adapter,
+    all_reduce_adapter_gradients,
+    clip_grad_norm_per_adapter,
+    create_sail_adapters_optimizer,
+)
+from .checkpoint import (
+    AsyncAdapterCheckpointer,
+    AsyncCheckpointCallback,
+    get_rng_state,
+    is_adapter_checkpoint,
+    load_adapter_optimizer_and_scheduler,
+    load_adapter_params,
+)
 from .dpo_config import DPOConfig, FDivergenceConstants, FDivergenceType
+from .logps_cache import SAMPLE_INDEX_COLUMN
+from .prefetch import FROZEN_LOGPS_KEY, FrozenLogpsPrefetcher, patch_skip_first_batches
 
 if TYPE_CHECKING:
     from transformers import PreTrainedModel, ProcessorMixin
 
     from ...hparams import FinetuningArguments
+    from .adapters import SailAdapterConfig
+    from .logps_cache import SailLogpsCache
+    from .prefix_cache import FrozenPrefixCache
+
+
+logger = logging.get_logger(__name__)
+
+
+SAMPLER_STATE_NAME = "sampler_state.json"
 
 
 class CustomDPOTrainer(DPOTrainer):
@@ -49,6 +98,10 @@ class CustomDPOTrainer(DPOTrainer):
         reward_model: Optional[Union["PreTrainedModel", torch.nn.Module]],
         finetuning_args: "FinetuningArguments",
         processor: Optional["ProcessorMixin"],
+        logps_cache: Optional[Dict[str, "SailLogpsCache"]] = None,
+        frozen_adapters: Optional[Dict[str, str]] = None,
+        prefix_cache: Optional[Dict[str, "FrozenPrefixCache"]] = None,
+        sail_adapters: Optional[List["SailAdapterConfig"]] = None,
         disable_dropout: bool = True,
         **kwargs,
     ):
@@ -72,8 +125,16 @@ class CustomDPOTrainer(DPOTrainer):
 
         self.ref_model = ref_model
         self.reward_model = reward_model
-        
-        self._stored_metrics = defaultdict(lambda: defaultdict(list))
+        self.logps_cache = logps_cache or {}
+        self.frozen_adapters = frozen_adapters
+        self.prefix_cache = prefix_cache or {}
+        self.sail_adapters = sail_adapters
+        self.resumable_data: Optional[
+            Union[
+                "TokenBudgetBatchSampler", "PromptGroupedBatchSampler", "ResumableSampler", "ResumableIterableDataset"
+            ]
+        ] = None
+        self.metrics_accumulator = MetricsAccumulator()
 
         self.beta = finetuning_args.pref_beta
         self.loss_type = finetuning_args.pref_loss
@@ -83,13 +144,32 @@ class CustomDPOTrainer(DPOTrainer):
 
         self.sail_alpha = finetuning_args.sail_alpha
 
+        self.frozen_prefix_layers = 0
+        if finetuning_args.sail_share_frozen_prefix:
+            if is_frozen_prefix_supported(model):
+                self.frozen_prefix_layers = get_sail_layer_ids(finetuning_args.lora_layer_range)[0]
+                logger.info_rank0(f"Share the hidden states of the first {self.frozen_prefix_layers} layers.")
+            else:
+                logger.warning_rank0("Current model does not support sharing the frozen prefix.")
+
+        if self.frozen_prefix_layers != 0 and ref_model is not None:
+            logger.warning_rank0(
+                "The frozen prefix is not shared with a standalone `ref_model`, which runs all the layers. "
+                "Set `ref_model` to the base model of the policy to share it."
+            )
+
+        if any(cache.meta["num_layers"] != self.frozen_prefix_layers for cache in self.prefix_cache.values()):
+            raise ValueError("The cached hidden states do not match the first layer of `lora_layer_range`.")
+
         Trainer.__init__(self, model=model, **kwargs)
         if not hasattr(self, "accelerator"):
             raise AttributeError("Please update `transformers`.")
 
         warnings.simplefilter("ignore")
         if ref_model is not None:
-            if self.is_deepspeed_enabled:
+            if finetuning_args.sail_ref_model_device != "auto":  # already placed
+                self.ref_model.eval()
+            elif self.is_deepspeed_enabled:
                 if not (
                     getattr(ref_model, "is_loaded_in_8bit", False) or getattr(ref_model, "is_loaded_in_4bit", False)
                 ):
@@ -100,13 +180,22 @@ class CustomDPOTrainer(DPOTrainer):
 
         
         if self.reward_model is not None:
-            if self.is_deepspeed_enabled:
+            if finetuning_args.sail_reward_model_device != "auto":  # already placed
+                self.reward_model.eval()
+            elif self.is_deepspeed_enabled:
                 self.reward_model = self._prepare_deepspeed(self.reward_model)
             else:
                 self.reward_model = self.accelerator.prepare_model(self.reward_model, evaluation_mode=True)
                 self.reward_model.eval() 
         
 
+        if finetuning_args.sail_prefetch_batches > 0:
+            if self.is_deepspeed_enabled or self.is_fsdp_enabled:
+                raise ValueError("`sail_prefetch_batches` is incompatible with DeepSpeed and FSDP.")
+
+            if finetuning_args.use_ref_model and self.ref_model is None:
+                raise ValueError("`sail_prefetch_batches` requires `ref_model` rather than the policy model.")
+
         if processor is not None:
             self.add_callback(SaveProcessorCallback(processor))
 
@@ -119,10 +208,103 @@ class CustomDPOTrainer(DPOTrainer):
             self.accelerator.clip_grad_norm_ = MethodType(clip_grad_norm_old_version, self.accelerator)
             self.add_callback(BAdamCallback)
 
+        if self.sail_adapters is not None:
+            if self.is_fsdp_enabled and not getattr(self.accelerator.state.fsdp_plugin, "use_orig_params", False):
+                raise ValueError("`sail_adapters` requires `use_orig_params` in FSDP to group the adapter parameters.")
+
+            self.accelerator.clip_grad_norm_ = self._clip_grad_norm_per_adapter
+
+        self.checkpointer = None
+        if finetuning_args.sail_async_checkpoint:
+            self.checkpointer = AsyncAdapterCheckpointer(
+                self.args.output_dir,
+                process_index=self.args.process_index,
+                world_size=self.args.world_size,
+                sharded=self.is_fsdp_enabled,
+                save_total_limit=self.args.save_total_limit,
+            )
+            self.add_callback(AsyncCheckpointCallback(self.checkpointer))
+
+    def _clip_grad_norm_per_adapter(
+        self, parameters, max_norm: float, norm_type: float = 2.0
+    ) -> Optional["torch.Tensor"]:
+        r"""
+        Replaces the global gradient clipping of the accelerator, so that each adapter is clipped on its own.
+        """
+        self.accelerator.unscale_gradients()
+        return clip_grad_norm_per_adapter(self.optimizer, max_norm, norm_type, sharded=self.is_fsdp_enabled)
+
+    @override
+    def _save_checkpoint(self, model, trial, metrics=None):
+        r"""
+        Saves the trainable parameters asynchronously if `sail_async_checkpoint` is set.
+
+        Also saves the data position if `sail_fast_resume` is set.
+        """
+        extra_files = {}
+        if self.resumable_data is not None:
+            extra_files[SAMPLER_STATE_NAME] = json.dumps(self.resumable_data.state_dict(), indent=2) + "\n"
+
+        if self.checkpointer is not None:
+            self.checkpointer.save(
+                self.state.global_step,
+                self.accelerator.unwrap_model(model),
+                self.optimizer,
+                self.lr_scheduler,
+                self.state,
+                extra_files=extra_files,
+                rng_state=get_rng_state(all_devices=self.args.parallel_mode == ParallelMode.DISTRIBUTED),
+            )
+            return
+
+        super()._save_checkpoint(model, trial, metrics)
+        if self.args.should_save:
+            output_dir = os.path.join(self._get_output_dir(trial), f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}")
+            for name, content in extra_files.items():
+                with open(os.path.join(output_dir, name), "w", encoding="utf-8") as f:
+                    f.write(content)
+
+    @override
+    def _load_from_checkpoint(self, resume_from_checkpoint, model=None):
+        if not is_adapter_checkpoint(resume_from_checkpoint):
+            return super()._load_from_checkpoint(resume_from_checkpoint, model)
+
+        model = model if model is not None else self.model
+        load_adapter_params(resume_from_checkpoint, self.accelerator.unwrap_model(model), self.args.process_index)
+
+    @override
+    def _load_optimizer_and_scheduler(self, checkpoint):
+        r"""
+        Also restores the data position if `sail_fast_resume` is set.
+        """
+        if checkpoint is not None and is_adapter_checkpoint(checkpoint):
+            load_adapter_optimizer_and_scheduler(
+                checkpoint,
+                self.accelerator.unwrap_model(self.model_wrapped),
+                self.optimizer,
+                self.lr_scheduler,
+                self.args.process_index,
+            )
+        else:
+            super()._load_optimizer_and_scheduler(checkpoint)
+
+        if checkpoint is not None and self.resumable_data is not None:
+            sampler_state_path = os.path.join(checkpoint, SAMPLER_STATE_NAME)
+            if os.path.isfile(sampler_state_path):
+                with open(sampler_state_path, encoding="utf-8") as f:
+                    self.resumable_data.load_state_dict(json.load(f))
+
+                logger.info_rank0(f"Resumed the data position from {sampler_state_path}.")
+            else:
+                logger.warning_rank0(f"{SAMPLER_STATE_NAME} is not found, the data restarts from the epoch start.")
+
     @override
     def create_optimizer(self) -> "torch.optim.Optimizer":
         if self.optimizer is None:
-            self.optimizer = create_custom_optimizer(self.model, self.args, self.finetuning_args)
+            if self.sail_adapters is not None:
+                self.optimizer = create_sail_adapters_optimizer(self.model, self.args, self.sail_adapters)
+            else:
+                self.optimizer = create_custom_optimizer(self.model, self.args, self.finetuning_args)
         return super().create_optimizer()
 
     @override
@@ -132,6 +314,217 @@ class CustomDPOTrainer(DPOTrainer):
         create_custom_scheduler(self.args, num_training_steps, optimizer)
         return super().create_scheduler(num_training_steps, optimizer)
 
+    def _get_batch_sampler_dataloader(
+        self, batch_sampler: Union["TokenBudgetBatchSampler", "PromptGroupedBatchSampler"]
+    ) -> "DataLoader":
+        r"""
+        The batch sampler has been sharded across processes, thus the dataloader is not prepared by accelerate.
+        """
+        dataloader = DataLoader(
+            self.train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            persistent_workers=self.args.dataloader_persistent_workers,
+        )
+        dataloader.set_epoch = batch_sampler.set_epoch  # called by the trainer at the beginning of each epoch
+        if self.finetuning_args.sail_fast_resume:
+            self.resumable_data = batch_sampler
+
+        return dataloader
+
+    def _get_token_budget_dataloader(self) -> "DataLoader":
+        r"""
+        Forms the batches under the token budget of `pref_max_batch_tokens`.
+        """
+        if not hasattr(self.train_dataset, "__len__"):
+            raise ValueError("`pref_max_batch_tokens` does not support streaming datasets.")
+
+        batch_sampler = TokenBudgetBatchSampler(
+            get_pairwise_lengths(self.train_dataset),
+            max_tokens=self.finetuning_args.pref_max_batch_tokens,
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+            seed=self.args.data_seed if self.args.data_seed is not None else self.args.seed,
+        )
+        logger.info_rank0(f"Formed {len(batch_sampler)} batches per process under the token budget.")
+        return self._get_batch_sampler_dataloader(batch_sampler)
+
+    def _get_prompt_grouped_dataloader(self) -> "DataLoader":
+        r"""
+        Forms the batches of `per_device_train_batch_size` pairs from the groups of pairs sharing a prompt.
+        """
+        if not hasattr(self.train_dataset, "__len__"):
+            raise ValueError("`sail_group_by_prompt` does not support streaming datasets.")
+
+        groups = get_prompt_groups(self.train_dataset, self.data_collator.label_pad_token_id)
+        batch_sampler = PromptGroupedBatchSampler(
+            groups,
+            batch_size=self._train_batch_size,
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+            seed=self.args.data_seed if self.args.data_seed is not None else self.args.seed,
+        )
+        logger.info_rank0(
+            f"Grouped {len(self.train_dataset)} pairs by {len(groups)} prompts into {len(batch_sampler)} batches "
+            "per process."
+        )
+        return self._get_batch_sampler_dataloader(batch_sampler)
+
+    def _get_resumable_dataloader(self) -> "DataLoader":
+        r"""
+        Forms the batches in a global order that can be resumed from the saved position without being replayed.
+
+        Like the token budget dataloader, it has been sharded across processes and is not prepared by accelerate.
+        """
+        if isinstance(self.train_dataset, IterableDataset):
+            if self.args.dataloader_num_workers != 0:
+                logger.warning_rank0("Resumable streaming datasets are read in the main process, ignore the workers.")
+
+            dataset = ResumableIterableDataset(
+                self.train_dataset, self._train_batch_size, self.args.world_size, self.args.process_index
+            )
+            dataloader = DataLoader(
+                dataset,
+                batch_size=self._train_batch_size,
+                collate_fn=self.data_collator,
+                pin_memory=self.args.dataloader_pin_memory,
+            )
+            self.resumable_data = dataset
+        else:
+            sampler = ResumableSampler(
+                len(self.train_dataset),
+                self._train_batch_size,
+                num_replicas=self.args.world_size,
+                rank=self.args.process_index,
+                seed=self.args.data_seed if self.args.data_seed is not None else self.args.seed,
+            )
+            dataloader = DataLoader(
+                self.train_dataset,
+                batch_size=self._train_batch_size,
+                sampler=sampler,
+                collate_fn=self.data_collator,
+                num_workers=self.args.dataloader_num_workers,
+                pin_memory=self.args.dataloader_pin_memory,
+                persistent_workers=self.args.dataloader_persistent_workers,
+            )
+            self.resumable_data = sampler
+
+        dataloader.set_epoch = self.resumable_data.set_epoch
+        return dataloader
+
+    def _get_sharded_stream_dataloader(self) -> "DataLoader":
+        r"""
+        Reads the shards of `sharded_streaming` in the workers, the dataset is not sharded again by accelerate.
+        """
+        if (
+            self.finetuning_args.pref_max_batch_tokens is not None
+            or self.finetuning_args.sail_group_by_prompt
+            or self.finetuning_args.sail_fast_resume
+        ):
+            raise ValueError(
+                "`sharded_streaming` is incompatible with `pref_max_batch_tokens`, `sail_group_by_prompt` "
+                "and `sail_fast_resume`."
+            )
+
+        num_readers = self.args.world_size * max(self.args.dataloader_num_workers, 1)
+        if len(self.train_dataset.shards) % num_readers != 0:
+            logger.warning_rank0(
+                f"The number of shards ({len(self.train_dataset.shards)}) is not divisible by the number of "
+                f"readers ({num_readers}), some dataloader workers may read more examples than the others."
+            )
+
+        dataloader = DataLoader(
+            self.train_dataset,
+            batch_size=self._train_batch_size,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            persistent_workers=self.args.dataloader_persistent_workers,
+        )
+        dataloader.set_epoch = self.train_dataset.set_epoch
+        return dataloader
+
+    @override
+    def get_train_dataloader(self) -> "DataLoader":
+        r"""
+        Reads the shards in each process if `sharded_streaming` is set.
+
+        Forms the batches under a token budget if `pref_max_batch_tokens` is set.
+
+        Forms the batches of the pairs sharing a prompt if `sail_group_by_prompt` is set.
+
+        Forms the batches in a resumable order if `sail_fast_resume` is set.
+
+        Computes the frozen log probabilities ahead in a background thread if `sail_prefetch_batches` is set.
+        """
+        if isinstance(self.train_dataset, ShardedJsonlDataset):
+            dataloader = self._get_sharded_stream_dataloader()
+        elif self.finetuning_args.pref_max_batch_tokens is not None:
+            dataloader = self._get_token_budget_dataloader()
+        elif self.finetuning_args.sail_group_by_prompt:
+            dataloader = self._get_prompt_grouped_dataloader()
+        elif self.finetuning_args.sail_fast_resume:
+            dataloader = self._get_resumable_dataloader()
+        else:
+            dataloader = super().get_train_dataloader()
+
+        if self.finetuning_args.sail_prefetch_batches > 0:
+            dataloader = FrozenLogpsPrefetcher(
+                dataloader,
+                self.compute_prefetched_log_probs,
+                self.finetuning_args.sail_prefetch_batches,
+                device=self.accelerator.device,
+            )
+            patch_skip_first_batches()  # keep prefetching after skipping the consumed batches on resume
+            logger.info_rank0(
+                f"Computing frozen log probabilities up to {self.finetuning_args.sail_prefetch_batches} batches ahead."
+            )
+
+        return dataloader
+
+    @override
+    def training_step(
+        self, model: "torch.nn.Module", inputs: Dict[str, "torch.Tensor"], *args, **kwargs
+    ) -> "torch.Tensor":
+        r"""
+        Runs the backward passes within the loss computation if `sail_adapters` or `sail_split_pair` is set.
+
+        Counts the consumed batches to save the data position.
+        """
+        if self.sail_adapters is not None or self.finetuning_args.sail_split_pair:
+            loss = self._staged_training_step(model, inputs)
+        else:
+            loss = super().training_step(model, inputs, *args, **kwargs)
+
+        if self.resumable_data is not None:
+            self.resumable_data.num_consumed_batches += 1
+
+        return loss
+
+    def _staged_training_step(self, model: "torch.nn.Module", inputs: Dict[str, "torch.Tensor"]) -> "torch.Tensor":
+        r"""
+        Follows `Trainer.training_step`, except that `get_batch_loss_metrics` runs the backward passes by stages
+        and returns the detached loss.
+        """
+        model.train()
+        if hasattr(self.optimizer, "train") and callable(self.optimizer.train):
+            self.optimizer.train()
+
+        inputs = self._prepare_inputs(inputs)
+        with self.compute_loss_context_manager():
+            loss, metrics = self.get_batch_loss_metrics(model, inputs, train_eval="train")
+
+        self.store_metrics(metrics, train_eval="train")
+        return loss / self.args.gradient_accumulation_steps
+
+    def _get_sync_context(self, model: "torch.nn.Module", sync: bool):
+        r"""
+        Skips the gradient synchronization of DDP and FSDP in the backward pass unless `sync` is True.
+        """
+        return nullcontext() if sync else self.accelerator.no_sync(model)
+
     @override
     def get_batch_samples(self, epoch_iterator, num_batches):
         r"""
@@ -360,36 +753,198 @@ class CustomDPOTrainer(DPOTrainer):
 
         return losses, chosen_rewards, rejected_rewards
 
+    def compute_frozen_prefix(
+        self,
+        model: "PreTrainedModel",
+        batch: Dict[str, "torch.Tensor"],
+        sample_index: Optional["torch.Tensor"] = None,
+        train_eval: Literal["train", "eval"] = "train",
+    ) -> Optional["torch.Tensor"]:
+        r"""
+        Computes the hidden states at the first focal layer, which are identical in the policy and reference models.
+
+        Reads them from the precomputed cache if possible.
+        """
+        if self.frozen_prefix_layers == 0 or "pixel_values" in batch:
+            return None
+
+        cache = self.prefix_cache.get(train_eval)
+        if cache is not None and sample_index is not None:
+            prefix_hidden_states = cache.read(sample_index, batch["attention_mask"])
+            if prefix_hidden_states is not None:
+                return prefix_hidden_states
+
+        return forward_frozen_prefix(
+            model,
+            self.accelerator.unwrap_model(model),
+            self.frozen_prefix_layers,
+            input_ids=batch["input_ids"],
+            attention_mask=batch["attention_mask"],
+        )
+
+    def get_shared_prompt_inputs(
+        self, model: "PreTrainedModel", batch: Dict[str, "torch.Tensor"]
+    ) -> Dict[str, Union["torch.Tensor", "DynamicCache"]]:
+        r"""
+        Runs the shared prompts once and returns the inputs to evaluate both responses against their KV cache.
+
+        Each prompt is run once however many responses share it, its KV cache is then gathered for the responses
+        by `prompt_index`. The KV cache keeps the autograd graph, so the gradients flow back to the prompt side of
+        the policy model.
+        """
+        prompt_mask, response_mask = batch["prompt_attention_mask"], batch["attention_mask"]
+        prompt_index = batch["prompt_index"]  # chosen and rejected
+        prompt_lengths = prompt_mask.sum(-1)[prompt_index]
+        position_ids = torch.arange(response_mask.size(1), device=response_mask.device)
+        model_inputs = {"input_ids": batch["input_ids"], "position_ids": prompt_lengths[:, None] + position_ids}
+        if prompt_mask.size(1) == 0:
+            model_inputs["attention_mask"] = response_mask
+            return model_inputs
+
+        with replace_output_layer(self.accelerator.unwrap_model(model), torch.nn.Identity()):
+            past_key_values = model(
+                input_ids=batch["prompt_input_ids"],
+                attention_mask=prompt_mask,
+                position_ids=(prompt_mask.cumsum(-1) - 1).clamp(min=0),
+                return_dict=True,
+                use_cache=True,
+            ).past_key_values
+
+        if isinstance(past_key_values, DynamicCache):
+            past_key_values = past_key_values.to_legacy_cache()
+
+        model_inputs["past_key_values"] = DynamicCache.from_legacy_cache(
+            tuple((key[prompt_index], value[prompt_index]) for key, value in past_key_values)
+        )
+        model_inputs["attention_mask"] = torch.cat((prompt_mask[prompt_index], response_mask), dim=-1)
+        return model_inputs
+
+    def compute_all_log_probs(
+        self,
+        model: "PreTrainedModel",
+        batch: Dict[str, "torch.Tensor"],
+        prefix_hidden_states: Optional["torch.Tensor"] = None,
+        **kwargs,
+    ) -> Tuple["torch.Tensor", "torch.Tensor", "torch.Tensor"]:
+        r"""
+        Computes the per-token log probabilities of all the rows in the batch.
+
+        If `prefix_hidden_states` is given, the forward pass starts from the first focal layer.
+        If the batch contains `prompt_input_ids`, the shared prompts are run once for both responses.
+        If the batch contains `segment_ids`, the rows are packed or flattened and the log probabilities are left as is.
+        Extra keyword arguments are passed to the model, e.g. `adapter_names`.
+        """
+        unwrapped_model = self.accelerator.unwrap_model(model)
+        if prefix_hidden_states is not None:
+            model_inputs = {"inputs_embeds": prefix_hidden_states, "attention_mask": batch["attention_mask"]}
+            forward_context = split_decoder_layers(unwrapped_model, self.frozen_prefix_layers)
+        elif "prompt_input_ids" in batch:
+            model_inputs, forward_context = self.get_shared_prompt_inputs(model, batch), nullcontext()
+        else:
+            model_inputs = {k: v for k, v in batch.items() if k != "segment_ids"}
+            forward_context = nullcontext()
+
+        model_inputs = {**model_inputs, **kwargs}
+        chunk_size = self.finetuning_args.pref_logps_chunk_size
+        use_label_logps = self.finetuning_args.pref_response_logits_only or chunk_size is not None
+        with forward_context:
+            if use_label_logps and is_label_logps_supported(unwrapped_model, chunk_size):
+                all_logps, valid_length, all_logits = get_label_batch_logps(
+                    model, unwrapped_model, model_inputs, batch["labels"], chunk_size
+                )
+            else:
+                all_logits: "torch.Tensor" = model(**model_inputs, return_dict=True, use_cache=False).logits.to(
+                    torch.float32
+                )
+                all_logps, valid_length = get_batch_logps(logits=all_logits, labels=batch["labels"])
+
+        return all_logps, valid_length, all_logits
+
+    def split_pairwise_log_probs(
+        self, all_logps: "torch.Tensor", valid_length: "torch.Tensor", batch: Dict[str, "torch.Tensor"]
+    ) -> Tuple["torch.Tensor", "torch.Tensor", "torch.Tensor", "torch.Tensor"]:
+        r"""
+        Splits the per-token log probabilities of all the rows into the chosen and rejected ones.
+
+        The packed rows are unpacked to the layout of the padded batch, i.e., one sequence per row.
+        Averages the log probabilities if loss_type is IPO, ORPO or SimPO.
+        """
+        if "segment_ids" in batch:
+            chosen_logps, rejected_logps, chosen_length, rejected_length = unpack_pairwise_logps(
+                all_logps, batch["labels"], batch["segment_ids"], batch["position_ids"], self.label_pad_token_id
+            )
+        else:
+            batch_size = all_logps.size(0) // 2
+            chosen_logps, rejected_logps = all_logps.split(batch_size, dim=0)
+            chosen_length, rejected_length = valid_length.split(batch_size, dim=0)
+
+        if self.loss_type in ["ipo", "orpo", "simpo"]:
+            chosen_logps = chosen_logps / chosen_length.unsqueeze(-1)
+            rejected_logps = rejected_logps / rejected_length.unsqueeze(-1)
+
+        return chosen_logps, rejected_logps, chosen_length, rejected_length
+
+    def get_policy_outputs(
+        self,
+        all_logps: "torch.Tensor",
+        valid_length: "torch.Tensor",
+        chosen_logits: "torch.Tensor",
+        rejected_logits: "torch.Tensor",
+        batch: Dict[str, "torch.Tensor"],
+    ) -> Tuple["torch.Tensor", ...]:
+        r"""
+        Packs the per-token log probabilities of all the rows into the outputs of `concatenated_forward`.
+        """
+        chosen_logps, rejected_logps, chosen_length, rejected_length = self.split_pairwise_log_probs(
+            all_logps, valid_length, batch
+        )
+        return (
+            chosen_logps,
+            rejected_logps,
+            chosen_logits,
+            rejected_logits,
+            chosen_logps / chosen_length,
+            chosen_length,
+            rejected_length,
+        )
+
     @override
     def concatenated_forward(
-        self, model: "PreTrainedModel", batch: Dict[str, "torch.Tensor"]
+        self,
+        model: "PreTrainedModel",
+        batch: Dict[str, "torch.Tensor"],
+        prefix_hidden_states: Optional["torch.Tensor"] = None,
     ) -> Tuple["torch.Tensor", "torch.Tensor", "torch.Tensor", "torch.Tensor", "torch.Tensor"]:
         r"""
         Computes the sum log probabilities of the labels under given logits if loss_type is not IPO, ORPO or SimPO.
 
         Otherwise the average log probabilities.
+
+        If only the response tokens go through the output layer, the logits are averaged per sequence.
+        The logits of packed rows are not split into chosen and rejected ones.
         """
         if self.finetuning_args.use_ref_model:
             batch = {k: v.detach().clone() for k, v in batch.items()}  # avoid error
 
-        all_logits: "torch.Tensor" = model(**batch, return_dict=True, use_cache=False).logits.to(torch.float32)
-        all_logps, valid_length = get_batch_logps(logits=all_logits, labels=batch["labels"])
-        if self.loss_type in ["ipo", "orpo", "simpo"]:
-            all_logps = all_logps / valid_length
-
-        batch_size = batch["input_ids"].size(0) // 2
-        chosen_logps, rejected_logps = all_logps.split(batch_size, dim=0)
-        chosen_logits, rejected_logits = all_logits.split(batch_size, dim=0)
-        chosen_length, rejected_length = valid_length.split(batch_size, dim=0)
+        all_logps, valid_length, all_logits = self.compute_all_log_probs(model, batch, prefix_hidden_states)
+        if "segment_ids" in batch:  # the packed rows mix chosen and rejected sequences
+            chosen_logits = rejected_logits = all_logits
+        else:
+            chosen_logits, rejected_logits = all_logits.split(batch["input_ids"].size(0) // 2, dim=0)
 
-        return chosen_logps, rejected_logps, chosen_logits, rejected_logits, chosen_logps/chosen_length, chosen_length, rejected_length
+        return self.get_policy_outputs(all_logps, valid_length, chosen_logits, rejected_logits, batch)
 
     @override
     def compute_reference_log_probs(
-        self, model: "PreTrainedModel", batch: Dict[str, "torch.Tensor"]
+        self,
+        model: "PreTrainedModel",
+        batch: Dict[str, "torch.Tensor"],
+        prefix_hidden_states: Optional["torch.Tensor"] = None,
     ) -> Tuple[Optional["torch.Tensor"], Optional["torch.Tensor"]]:
         r"""
         Computes log probabilities of the reference model.
+
+        The frozen prefix is only shared with the adapter-disabled policy model.
         """
         if not self.finetuning_args.use_ref_model:
             return None, None
@@ -400,21 +955,142 @@ class CustomDPOTrainer(DPOTrainer):
         else:
             ref_model = self.ref_model
             ref_context = nullcontext()
+            prefix_hidden_states = None
+            device = self.finetuning_args.sail_ref_model_device
+            if device not in ["auto", "offload"]:  # offloaded model moves the inputs by itself
+                batch = {k: v.to(device) for k, v in batch.items()}
 
         with torch.no_grad(), ref_context:
-            reference_chosen_logps, reference_rejected_logps, *_ = self.concatenated_forward(ref_model, batch)
+            reference_chosen_logps, reference_rejected_logps, *_ = self.concatenated_forward(
+                ref_model, batch, prefix_hidden_states
+            )
 
-        return reference_chosen_logps, reference_rejected_logps
+        return reference_chosen_logps.to(self.accelerator.device), reference_rejected_logps.to(self.accelerator.device)
 
-    @override
-    def get_batch_loss_metrics(
+    def compute_reward_log_probs(self, batch: Dict[str, "torch.Tensor"]) -> Tuple["torch.Tensor", "torch.Tensor"]:
+        r"""
+        Computes log probabilities of the reward model.
+        """
+        device = self.finetuning_args.sail_reward_model_device
+        if device not in ["auto", "offload"]:  # offloaded model moves the inputs by itself
+            batch = {k: v.to(device) for k, v in batch.items()}
+
+        with torch.no_grad():
+            reward_chosen_logps, reward_rejected_logps, *_ = self.concatenated_forward(self.reward_model, batch)
+
+        return reward_chosen_logps.to(self.accelerator.device), reward_rejected_logps.to(self.accelerator.device)
+
+    def compute_prefetched_log_probs(self, batch: Dict[str, "torch.Tensor"]) -> Dict[str, Tuple["torch.Tensor", ...]]:
+        r"""
+        Computes log probabilities of the standalone frozen models ahead of the training step of the batch.
+
+        Runs in the producer thread, thus the policy model must not be touched.
+        Returns a dict of (chosen_logps, rejected_logps) keyed by `ref` or `reward`.
+        """
+        batch = self._prepare_inputs({k: v for k, v in batch.items() if k != SAMPLE_INDEX_COLUMN})
+        frozen_logps = {"reward": self.compute_reward_log_probs(batch)}
+        if self.finetuning_args.use_ref_model:
+            frozen_logps["ref"] = self.compute_reference_log_probs(self.ref_model, batch)
+
+        return frozen_logps
+
+    def compute_frozen_log_probs(
+        self, model: "PreTrainedModel", batch: Dict[str, "torch.Tensor"], keys: List[str]
+    ) -> Dict[str, Tuple["torch.Tensor", "torch.Tensor"]]:
+        r"""
+        Computes log probabilities of the frozen adapters in one forward pass, with rows stacked per adapter.
+
+        Returns a dict of (chosen_logps, rejected_logps) keyed by `ref` or `reward`.
+        """
+        num_rows = batch["input_ids"].size(0)
+        stacked_batch = {k: v.repeat(len(keys), *([1] * (v.dim() - 1))) for k, v in batch.items()}
+        adapter_names = [self.frozen_adapters[key] for key in keys for _ in range(num_rows)]
+        training = model.training
+        model.eval()  # peft does not accept `adapter_names` in training mode
+        try:
+            with torch.no_grad():
+                all_logps, valid_length, _ = self.compute_all_log_probs(
+                    model, stacked_batch, adapter_names=adapter_names
+                )
+        finally:
+            model.train(training)
+
+        frozen_logps = {}
+        for key, logps, length in zip(keys, all_logps.split(num_rows, dim=0), valid_length.split(num_rows, dim=0)):
+            frozen_logps[key] = self.split_pairwise_log_probs(logps, length, batch)[:2]
+
+        return frozen_logps
+
+    def get_cached_log_probs(
+        self,
+        batch: Dict[str, "torch.Tensor"],
+        sample_index: Optional["torch.Tensor"],
+        train_eval: Literal["train", "eval"] = "train",
+    ) -> Dict[str, Tuple["torch.Tensor", "torch.Tensor"]]:
+        r"""
+        Reads log probabilities of the frozen models from the precomputed cache.
+
+        Returns a dict of (chosen_logps, rejected_logps) keyed by `ref` or `reward`, missed keys are omitted.
+        """
+        cache = self.logps_cache.get(train_eval)
+        cached_logps = {}
+        if cache is not None and sample_index is not None:
+            mask = batch["labels"][:, 1:] != self.label_pad_token_id
+            for key in ("ref", "reward"):
+                all_logps = cache.read(key, sample_index, mask)
+                if all_logps is not None:
+                    cached_logps[key] = all_logps.split(sample_index.size(0), dim=0)
+
+        if len(cached_logps) != 2 and self.reward_model is None and self.frozen_adapters is None:
+            raise ValueError("Frozen log probabilities are missing in the cache, please rerun `sail_precompute`.")
+
+        return cached_logps
+
+    def get_frozen_log_probs(
         self,
         model: "PreTrainedModel",
         batch: Dict[str, "torch.Tensor"],
+        sample_index: Optional["torch.Tensor"],
+        prefetched_logps: Optional[Dict[str, Tuple["torch.Tensor", "torch.Tensor"]]],
+        prefix_hidden_states: Optional["torch.Tensor"],
+        train_eval: Literal["train", "eval"] = "train",
+    ) -> Tuple[Optional["torch.Tensor"], Optional["torch.Tensor"], "torch.Tensor", "torch.Tensor"]:
+        r"""
+        Gets log probabilities of the reference and reward models from the cache, the prefetcher or the models.
+
+        Returns reference_chosen_logps, reference_rejected_logps, reward_chosen_logps and reward_rejected_logps.
+        """
+        cached_logps = self.get_cached_log_probs(batch, sample_index, train_eval)
+        if prefetched_logps is not None:
+            cached_logps.update(prefetched_logps)
+
+        missing_keys = [key for key in ("ref", "reward") if key not in cached_logps]
+        if self.frozen_adapters is not None and len(missing_keys) != 0:
+            cached_logps.update(self.compute_frozen_log_probs(model, batch, missing_keys))
+
+        if "ref" in cached_logps:
+            reference_chosen_logps, reference_rejected_logps = cached_logps["ref"]
+        else:
+            reference_chosen_logps, reference_rejected_logps = self.compute_reference_log_probs(
+                model, batch, prefix_hidden_states
+            )
+
+        if "reward" in cached_logps:
+            reward_chosen_logps, reward_rejected_logps = cached_logps["reward"]
+        else:
+            reward_chosen_logps, reward_rejected_logps = self.compute_reward_log_probs(batch)
+
+        return reference_chosen_logps, reference_rejected_logps, reward_chosen_logps, reward_rejected_logps
+
+    def compute_loss_metrics(
+        self,
+        policy_outputs: Tuple["torch.Tensor", ...],
+        frozen_logps: Tuple[Optional["torch.Tensor"], Optional["torch.Tensor"], "torch.Tensor", "torch.Tensor"],
+        batch: Dict[str, "torch.Tensor"],
         train_eval: Literal["train", "eval"] = "train",
     ) -> Tuple["torch.Tensor", Dict[str, "torch.Tensor"]]:
         r"""
-        Computes the DPO loss and other metrics for the given batch of inputs for train or test.
+        Computes the DPO loss and other metrics from the outputs of `concatenated_forward` and the frozen models.
         """
         metrics = {}
         (
@@ -425,21 +1101,8 @@ class CustomDPOTrainer(DPOTrainer):
             policy_chosen_logps_avg,
             chosen_length,
             rejected_length,
-        ) = self.concatenated_forward(model, batch)
-
-        reference_chosen_logps, reference_rejected_logps = self.compute_reference_log_probs(model, batch)
-
-        
-        ref_context = nullcontext()
-
-        with torch.no_grad(), ref_context:
-            (
-                reward_chosen_logps,
-                reward_rejected_logps,
-                *_ 
-            ) = self.concatenated_forward(self.reward_model, batch)
-        
-
+        ) = policy_outputs
+        reference_chosen_logps, reference_rejected_logps, reward_chosen_logps, reward_rejected_logps = frozen_logps
         losses, chosen_rewards, rejected_rewards = self.compute_preference_loss(
             policy_chosen_logps,
             policy_rejected_logps,
@@ -455,22 +1118,170 @@ class CustomDPOTrainer(DPOTrainer):
             losses += self.ftx_gamma * sft_loss
 
         prefix = "eval_" if train_eval == "eval" else ""
-        metrics[f"{prefix}rewards/chosen"] = chosen_rewards.sum(-1).mean().item()
-        metrics[f"{prefix}rewards/rejected"] = rejected_rewards.sum(-1).mean().item()
-        metrics[f"{prefix}rewards/accuracies"] = (chosen_rewards.sum(-1) > rejected_rewards.sum(-1)).float().mean().item()
-        metrics[f"{prefix}rewards/margins"] = (chosen_rewards.sum(-1) - rejected_rewards.sum(-1)).mean().item()
-        metrics[f"{prefix}logps/chosen"] = policy_chosen_logps.sum(-1).mean().item()
-        metrics[f"{prefix}logps/rejected"] = policy_rejected_logps.sum(-1).mean().item()
-        metrics[f"{prefix}logps/ref_chosen"] = reference_chosen_logps.sum(-1).mean().item()
-        metrics[f"{prefix}logps/ref_rejected"] = reference_rejected_logps.sum(-1).mean().item()
-        metrics[f"{prefix}logits/chosen"] = policy_chosen_logits.mean().item()
-        metrics[f"{prefix}logits/rejected"] = policy_rejected_logits.mean().item()
+        metrics[f"{prefix}rewards/chosen"] = chosen_rewards.sum(-1).mean().detach()
+        metrics[f"{prefix}rewards/rejected"] = rejected_rewards.sum(-1).mean().detach()
+        metrics[f"{prefix}rewards/accuracies"] = (chosen_rewards.sum(-1) > rejected_rewards.sum(-1)).float().mean().detach()
+        metrics[f"{prefix}rewards/margins"] = (chosen_rewards.sum(-1) - rejected_rewards.sum(-1)).mean().detach()
+        metrics[f"{prefix}logps/chosen"] = policy_chosen_logps.sum(-1).mean().detach()
+        metrics[f"{prefix}logps/rejected"] = policy_rejected_logps.sum(-1).mean().detach()
+        metrics[f"{prefix}logps/ref_chosen"] = reference_chosen_logps.sum(-1).mean().detach()
+        metrics[f"{prefix}logps/ref_rejected"] = reference_rejected_logps.sum(-1).mean().detach()
+        metrics[f"{prefix}logits/chosen"] = policy_chosen_logits.mean().detach()
+        metrics[f"{prefix}logits/rejected"] = policy_rejected_logits.mean().detach()
+        attention_mask = batch["segment_ids"] if "segment_ids" in batch else batch["attention_mask"]
+        metrics[f"{prefix}padding_efficiency"] = (attention_mask != 0).float().mean().detach()
         if self.loss_type == "orpo":
-            metrics[f"{prefix}sft_loss"] = sft_loss.mean().item()
-            metrics[f"{prefix}odds_ratio_loss"] = ((losses - sft_loss) / self.beta).mean().item()
+            metrics[f"{prefix}sft_loss"] = sft_loss.mean().detach()
+            metrics[f"{prefix}odds_ratio_loss"] = ((losses - sft_loss) / self.beta).mean().detach()
 
         return losses.mean(), metrics
 
+    def compute_adapters_loss_metrics(
+        self,
+        model: "PreTrainedModel",
+        batch: Dict[str, "torch.Tensor"],
+        frozen_logps: Tuple[Optional["torch.Tensor"], Optional["torch.Tensor"], "torch.Tensor", "torch.Tensor"],
+        prefix_hidden_states: Optional["torch.Tensor"] = None,
+        train_eval: Literal["train", "eval"] = "train",
+    ) -> Tuple["torch.Tensor", Dict[str, "torch.Tensor"]]:
+        r"""
+        Runs the policy model once per adapter, each with its own `sail_alpha` and `pref_beta`.
+
+        In training, the loss of each adapter is backpropagated right after its forward pass, so the graph of one
+        adapter is alive at a time, and the checkpointed layers are recomputed with the same active adapter.
+        The gradients are synchronized once per step: FSDP reduces them in the backward pass of the last adapter,
+        while DDP skips all the backward hooks and the adapter gradients are all-reduced afterwards, since each
+        backward pass leaves the parameters of the other adapters unused.
+        Returns the detached sum of the losses, the metrics are reported per adapter name.
+        """
+        prefix = "eval_" if train_eval == "eval" else ""
+        do_backward = train_eval == "train" and torch.is_grad_enabled()
+        is_ddp = self.args.parallel_mode == ParallelMode.DISTRIBUTED and not self.is_fsdp_enabled
+        use_all_reduce = do_backward and is_ddp
+        total_loss, metrics = 0.0, {}
+        for index, config in enumerate(self.sail_adapters):
+            sync = not do_backward or (index == len(self.sail_adapters) - 1 and not is_ddp)
+            with activate_adapter(model, config.adapter_name), self._get_sync_context(model, sync):
+                policy_outputs = self.concatenated_forward(model, batch, prefix_hidden_states)
+                self.beta, self.sail_alpha = config.pref_beta, config.sail_alpha
+                try:
+                    loss, adapter_metrics = self.compute_loss_metrics(policy_outputs, frozen_logps, batch, train_eval)
+                finally:
+                    self.beta, self.sail_alpha = self.finetuning_args.pref_beta, self.finetuning_args.sail_alpha
+
+                if do_backward:
+                    self.accelerator.backward(loss)
+
+            del policy_outputs
+
+            metrics[f"{prefix}padding_efficiency"] = adapter_metrics.pop(f"{prefix}padding_efficiency")
+            metrics[f"{prefix}{config.name}/loss"] = loss.detach()
+            for key, value in adapter_metrics.items():
+                metrics[f"{prefix}{config.name}/{key[len(prefix):]}"] = value
+
+            total_loss = total_loss + loss.detach()
+
+        if use_all_reduce and self.accelerator.sync_gradients:
+            all_reduce_adapter_gradients(self.optimizer)
+
+        return total_loss, metrics
+
+    def compute_split_pair_loss_metrics(
+        self,
+        model: "PreTrainedModel",
+        batch: Dict[str, "torch.Tensor"],
+        sample_index: Optional["torch.Tensor"],
+        prefetched_logps: Optional[Dict[str, Tuple["torch.Tensor", "torch.Tensor"]]],
+        prefix_hidden_states: Optional["torch.Tensor"] = None,
+    ) -> Tuple["torch.Tensor", Dict[str, "torch.Tensor"]]:
+        r"""
+        Runs the chosen and rejected halves of the policy model in two stages, so the activations of one half
+        are alive at a time.
+
+        The halves first run without gradients to get the per-token log probabilities. The loss is computed on
+        a leaf copy of them to get its gradients w.r.t. the log probabilities. Then each half runs again with the
+        same random states and backpropagates its part of these gradients, where the first half skips the gradient
+        synchronization. Gradient checkpointing still applies inside each half.
+        Returns the detached loss and the metrics.
+        """
+        batch_size = batch["input_ids"].size(0) // 2
+        if any(v.size(0) != 2 * batch_size for v in batch.values()):
+            raise ValueError("`sail_split_pair` requires the inputs to be split by rows, e.g. no multimodal inputs.")
+
+        half_inputs = []
+        for start in (0, batch_size):
+            half_batch = {k: v[start : start + batch_size] for k, v in batch.items()}
+            half_prefix = None if prefix_hidden_states is None else prefix_hidden_states[start : start + batch_size]
+            half_inputs.append((half_batch, half_prefix))
+
+        device = self.accelerator.device
+        rng_devices = [device] if device.type == "cuda" else []
+        rng_states, half_logps, half_length, half_logits = [], [], [], []
+        with torch.no_grad():
+            for half_batch, half_prefix in half_inputs:
+                rng_states.append(
+                    (torch.get_rng_state(), torch.cuda.get_rng_state(device) if device.type == "cuda" else None)
+                )
+                logps, valid_length, logits = self.compute_all_log_probs(model, half_batch, half_prefix)
+                half_logps.append(logps)
+                half_length.append(valid_length)
+                half_logits.append(logits.mean())
+
+        all_logps = torch.cat(half_logps, dim=0).requires_grad_()
+        valid_length = torch.cat(half_length, dim=0)
+        policy_outputs = self.get_policy_outputs(all_logps, valid_length, half_logits[0], half_logits[1], batch)
+        frozen_logps = self.get_frozen_log_probs(model, batch, sample_index, prefetched_logps, prefix_hidden_states)
+        loss, metrics = self.compute_loss_metrics(policy_outputs, frozen_logps, batch, train_eval="train")
+        (logps_grad,) = torch.autograd.grad(loss, all_logps)
+        del policy_outputs, all_logps, half_logps
+
+        for index, ((half_batch, half_prefix), (cpu_state, cuda_state), grad) in enumerate(
+            zip(half_inputs, rng_states, logps_grad.split(batch_size, dim=0))
+        ):
+            with self._get_sync_context(model, sync=index == 1), torch.random.fork_rng(devices=rng_devices):
+                torch.set_rng_state(cpu_state)
+                if cuda_state is not None:
+                    torch.cuda.set_rng_state(cuda_state, device)
+
+                logps, _, _ = self.compute_all_log_probs(model, half_batch, half_prefix)
+                self.accelerator.backward((logps * grad).sum())
+
+        return loss.detach(), metrics
+
+    @override
+    def get_batch_loss_metrics(
+        self,
+        model: "PreTrainedModel",
+        batch: Dict[str, "torch.Tensor"],
+        train_eval: Literal["train", "eval"] = "train",
+    ) -> Tuple["torch.Tensor", Dict[str, "torch.Tensor"]]:
+        r"""
+        Computes the DPO loss and other metrics for the given batch of inputs for train or test.
+
+        If `sail_adapters` is set, the frozen log probabilities are computed once for all the adapters.
+
+        If `sail_split_pair` is set, the backward pass of the training step runs here by halves.
+        """
+        sample_index = batch.pop(SAMPLE_INDEX_COLUMN, None)
+        prefetched_logps = batch.pop(FROZEN_LOGPS_KEY, None)
+        prefix_hidden_states = self.compute_frozen_prefix(model, batch, sample_index, train_eval)
+        if self.sail_adapters is not None:
+            frozen_logps = self.get_frozen_log_probs(
+                model, batch, sample_index, prefetched_logps, prefix_hidden_states, train_eval
+            )
+            return self.compute_adapters_loss_metrics(model, batch, frozen_logps, prefix_hidden_states, train_eval)
+
+        if self.finetuning_args.sail_split_pair and train_eval == "train" and torch.is_grad_enabled():
+            return self.compute_split_pair_loss_metrics(
+                model, batch, sample_index, prefetched_logps, prefix_hidden_states
+            )
+
+        policy_outputs = self.concatenated_forward(model, batch, prefix_hidden_states)
+        frozen_logps = self.get_frozen_log_probs(
+            model, batch, sample_index, prefetched_logps, prefix_hidden_states, train_eval
+        )
+        return self.compute_loss_metrics(policy_outputs, frozen_logps, batch, train_eval)
+
     @override
     def compute_loss(self, model, inputs, return_outputs=False, **kwargs):
         r"""
@@ -486,27 +1297,21 @@ class CustomDPOTrainer(DPOTrainer):
 
         return loss
 
+    @override
+    def store_metrics(
+        self, metrics: Dict[str, "torch.Tensor"], train_eval: Literal["train", "eval"] = "train"
+    ) -> None:
+        r"""
+        Accumulates the metrics on device instead of converting them to floats at each step.
+        """
+        self.metrics_accumulator.add(metrics, train_eval)
+
     @override
     def log(self, logs: Dict[str, float]) -> None:
         r"""
         Log `logs` on the various objects watching training, including stored metrics.
         """
+        # logs either has "loss" or "eval_loss"
         train_eval = "train" if "loss" in logs else "eval"
-        key_list, metric_list = [], []
-        for key, metrics in self._stored_metrics[train_eval].items():
-            key_list.append(key)
-            metric_list.append(torch.tensor(metrics, dtype=torch.float).to(self.accelerator.device).mean().item())
-
-        del self._stored_metrics[train_eval]
-        if len(metric_list) < 10:
-            for i in range(10 - len(metric_list)):
-                key_list.append(f"dummy_{i}")
-                metric_list.append(0.0)
-
-        metric_list = torch.tensor(metric_list, dtype=torch.float).to(self.accelerator.device)
-        metric_list = self.accelerator.reduce(metric_list, "mean").tolist()
-        for key, metric in zip(key_list, metric_list):
-            if not key.startswith("dummy_"):
-                logs[key] = metric
-
+        logs.update(self.metrics_accumulator.pop(train_eval, self.accelerator.device, self.accelerator.reduce))
         return Trainer.log(self, logs)
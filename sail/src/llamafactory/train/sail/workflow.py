@@ -15,22 +15,90 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import TYPE_CHECKING, List, Optional
+import os
+from dataclasses import replace
+from typing import TYPE_CHECKING, Dict, List, Optional
 
-from ...data import PairwiseDataCollatorWithPadding, get_dataset, get_template_and_fix_tokenizer
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from ...data import (
+    PairwiseDataCollatorWithFlattening,
+    PairwiseDataCollatorWithPacking,
+    PairwiseDataCollatorWithPadding,
+    get_dataset,
+    get_template_and_fix_tokenizer,
+)
+from ...extras import logging
 from ...extras.constants import IGNORE_INDEX
 from ...extras.misc import calculate_tps
 from ...extras.ploting import plot_loss
-from ...hparams import ModelArguments
+from ...hparams import FinetuningArguments, ModelArguments
 from ...model import load_model, load_tokenizer
-from ..trainer_utils import create_modelcard_and_push, create_ref_model
+from ..trainer_utils import (
+    create_modelcard_and_push,
+    create_ref_model,
+    create_sail_frozen_adapters,
+    create_sail_reward_model,
+    get_batch_logps,
+    get_sail_reward_model_args,
+    place_frozen_model,
+)
+from .adapters import create_sail_adapters, load_sail_adapter_configs
+from .logps_cache import (
+    SAMPLE_INDEX_COLUMN,
+    SailLogpsCache,
+    add_sample_index,
+    get_response_segment_lengths,
+    get_sail_cache_path,
+    load_sail_logps_cache,
+)
 from .trainer import CustomDPOTrainer
 
 
 if TYPE_CHECKING:
-    from transformers import Seq2SeqTrainingArguments, TrainerCallback
+    from datasets import Dataset
+    from transformers import PreTrainedModel, Seq2SeqTrainingArguments, TrainerCallback
+
+    from ...hparams import DataArguments
+    from .prefix_cache import FrozenPrefixCache
+
+
+logger = logging.get_logger(__name__)
+
+
+def _get_cacheable_splits(dataset_module: Dict[str, "Dataset"]) -> Dict[str, str]:
+    r"""
+    Returns the dataset keys whose log probabilities can be cached, the streaming and multiple eval sets are skipped.
+    """
+    splits = {}
+    for split, key in (("train", "train_dataset"), ("eval", "eval_dataset")):
+        dataset = dataset_module.get(key)
+        if dataset is None:
+            continue
+
+        if isinstance(dataset, dict) or not hasattr(dataset, "add_column"):
+            logger.warning_rank0(f"Frozen log probabilities of {key} cannot be cached, computing them on the fly.")
+            continue
+
+        splits[split] = key
 
-    from ...hparams import DataArguments, FinetuningArguments
+    return splits
+
+
+def _is_policy_base_model(model_args: "ModelArguments", finetuning_args: "FinetuningArguments") -> bool:
+    r"""
+    Returns whether `ref_model` resolves to the frozen base of the policy model, i.e., the adapter-disabled policy.
+    """
+    return (
+        finetuning_args.finetuning_type == "lora"
+        and model_args.adapter_name_or_path is None
+        and finetuning_args.ref_model_adapters is None
+        and finetuning_args.ref_model_quantization_bit == model_args.quantization_bit
+        and finetuning_args.sail_ref_model_device == "auto"
+        and os.path.normpath(finetuning_args.ref_model) == os.path.normpath(model_args.model_name_or_path)
+    )
 
 
 def run_sail(
@@ -39,49 +107,116 @@ def run_sail(
     training_args: "Seq2SeqTrainingArguments",
     finetuning_args: "FinetuningArguments",
     callbacks: Optional[List["TrainerCallback"]] = None,
+    dataset_module: Optional[Dict[str, "Dataset"]] = None,
+    prefix_cache: Optional[Dict[str, "FrozenPrefixCache"]] = None,
 ):
     tokenizer_module = load_tokenizer(model_args)
     tokenizer = tokenizer_module["tokenizer"]
     template = get_template_and_fix_tokenizer(tokenizer, data_args)
-    dataset_module = get_dataset(template, model_args, data_args, training_args, stage="rm", **tokenizer_module)
-    model = load_model(tokenizer, model_args, finetuning_args, training_args.do_train)
+    if dataset_module is None:
+        dataset_module = get_dataset(template, model_args, data_args, training_args, stage="rm", **tokenizer_module)
+    else:  # tokenized once, e.g. in a sweep
+        dataset_module = dict(dataset_module)
 
-    data_collator = PairwiseDataCollatorWithPadding(
-        template=template,
-        pad_to_multiple_of=8,
-        label_pad_token_id=IGNORE_INDEX if data_args.ignore_pad_token_for_loss else tokenizer.pad_token_id,
-        **tokenizer_module,
-    )
+    adapter_configs, model_finetuning_args = None, finetuning_args
+    if finetuning_args.sail_adapters is not None:
+        adapter_configs = load_sail_adapter_configs(finetuning_args, training_args)
+        model_finetuning_args = replace(  # the first adapter is created by `load_model`
+            finetuning_args, lora_rank=adapter_configs[0].lora_rank, lora_alpha=adapter_configs[0].lora_alpha
+        )
+
+    model = load_model(tokenizer, model_args, model_finetuning_args, training_args.do_train)
+    if adapter_configs is not None:
+        create_sail_adapters(model, adapter_configs)
+
+    if data_args.packing:
+        data_collator = PairwiseDataCollatorWithPacking(
+            template=template,
+            label_pad_token_id=IGNORE_INDEX if data_args.ignore_pad_token_for_loss else tokenizer.pad_token_id,
+            block_diag_attn=model_args.block_diag_attn,
+            attn_implementation=getattr(model.config, "_attn_implementation", None),
+            compute_dtype=model_args.compute_dtype,
+            **tokenizer_module,
+        )
+    elif finetuning_args.sail_padding_free:
+        data_collator = PairwiseDataCollatorWithFlattening(
+            template=template,
+            label_pad_token_id=IGNORE_INDEX if data_args.ignore_pad_token_for_loss else tokenizer.pad_token_id,
+            attn_implementation=getattr(model.config, "_attn_implementation", None),
+            compute_dtype=model_args.compute_dtype,
+            **tokenizer_module,
+        )
+    else:
+        data_collator = PairwiseDataCollatorWithPadding(
+            template=template,
+            pad_to_multiple_of=8,
+            label_pad_token_id=IGNORE_INDEX if data_args.ignore_pad_token_for_loss else tokenizer.pad_token_id,
+            shared_prompt=finetuning_args.sail_shared_prompt,
+            **tokenizer_module,
+        )
     
-    if finetuning_args.ref_model is not None:
-        finetuning_args.use_ref_model = True
+    if (
+        finetuning_args.ref_model is not None
+        or finetuning_args.sail_share_frozen_prefix
+        or finetuning_args.sail_reward_model_type == "lora"
+    ):
+        finetuning_args.use_ref_model = True  # use the adapter-disabled policy model if `ref_model` is None
     else:
         finetuning_args.use_ref_model = False
-    
 
+    logps_cache: Dict[str, "SailLogpsCache"] = {}
+    if finetuning_args.sail_logps_cache_dir is not None:
+        for split, key in _get_cacheable_splits(dataset_module).items():
+            cache = load_sail_logps_cache(dataset_module[key], model_args, data_args, finetuning_args)
+            if cache is not None:
+                dataset_module[key] = add_sample_index(dataset_module[key])
+                logps_cache[split] = cache
 
-    tokenizer_module = load_tokenizer(model_args)
-    tokenizer = tokenizer_module["tokenizer"]
+    if prefix_cache is not None:
+        for split, key in _get_cacheable_splits(dataset_module).items():
+            if split in prefix_cache and SAMPLE_INDEX_COLUMN not in dataset_module[key].column_names:
+                dataset_module[key] = add_sample_index(dataset_module[key])
 
-    model_args.model_name_or_path = finetuning_args.sail_reward_model
-
-    reward_model = load_model(tokenizer, model_args, finetuning_args, False)
-    
-
-    if finetuning_args.use_ref_model:
-        if finetuning_args.ref_model is None and (not training_args.do_train):
-            ref_model = model
-        else:
-            ref_model = create_ref_model(model_args, finetuning_args)
+    use_cache_only = (
+        training_args.do_train
+        and "train" in logps_cache
+        and (dataset_module.get("eval_dataset") is None or "eval" in logps_cache)
+        and all(cache.filled.all() for cache in logps_cache.values())
+    )
+    frozen_adapters = None
+    if use_cache_only:
+        logger.info_rank0("All frozen log probabilities are cached, skip loading the reference and reward models.")
+        reward_model, ref_model = None, None
+    elif finetuning_args.sail_reward_model_type == "lora":
+        frozen_adapters = create_sail_frozen_adapters(model, finetuning_args)
+        reward_model, ref_model = None, None
     else:
-        ref_model = None
+        reward_model = create_sail_reward_model(tokenizer, model_args, finetuning_args)
+        if finetuning_args.use_ref_model:
+            if finetuning_args.ref_model is None and (not training_args.do_train):
+                ref_model = model
+            elif finetuning_args.sail_share_frozen_prefix and _is_policy_base_model(model_args, finetuning_args):
+                logger.info_rank0("Use the adapter-disabled policy as `ref_model` to share the frozen prefix.")
+                ref_model = None
+            else:
+                ref_model = create_ref_model(model_args, finetuning_args)
+                if ref_model is not None:
+                    place_frozen_model(ref_model, finetuning_args.sail_ref_model_device)
+        else:
+            ref_model = None
 
     training_args.remove_unused_columns = False
+    if finetuning_args.sail_fast_resume:
+        training_args.ignore_data_skip = True  # skipped by the resumable sampler
 
     trainer = CustomDPOTrainer(
         model=model,
         ref_model=ref_model,
         reward_model=reward_model,
+        logps_cache=logps_cache,
+        frozen_adapters=frozen_adapters,
+        prefix_cache=prefix_cache,
+        sail_adapters=adapter_configs,
         args=training_args,
         finetuning_args=finetuning_args,
         data_collator=data_collator,
@@ -114,3 +249,99 @@ def run_sail(
         trainer.save_metrics("eval", metrics)
 
     create_modelcard_and_push(trainer, model_args, data_args, training_args, finetuning_args)
+
+
+def _load_frozen_model(model_args: "ModelArguments", device: "torch.device") -> "PreTrainedModel":
+    tokenizer = load_tokenizer(model_args)["tokenizer"]
+    model = load_model(tokenizer, model_args, FinetuningArguments(), is_trainable=False)
+    if getattr(model, "quantization_method", None) is None:
+        model.to(device)
+
+    return model
+
+
+def run_sail_precompute(
+    model_args: "ModelArguments",
+    data_args: "DataArguments",
+    training_args: "Seq2SeqTrainingArguments",
+    finetuning_args: "FinetuningArguments",
+    dataset_module: Optional[Dict[str, "Dataset"]] = None,
+):
+    r"""
+    Computes the per-token log probabilities of the reference and reward models once and stores them on disk.
+
+    Each process handles a strided shard of the examples, already cached examples are skipped. The processes write
+    to the same memory-mapped files, thus they must run on one node.
+    """
+    if int(os.environ.get("LOCAL_WORLD_SIZE", training_args.world_size)) != training_args.world_size:
+        raise ValueError("`sail_precompute` writes a shared cache, please run it on a single node.")
+
+    tokenizer_module = load_tokenizer(model_args)
+    tokenizer = tokenizer_module["tokenizer"]
+    template = get_template_and_fix_tokenizer(tokenizer, data_args)
+    if dataset_module is None:
+        dataset_module = get_dataset(template, model_args, data_args, training_args, stage="rm", **tokenizer_module)
+
+    data_collator = PairwiseDataCollatorWithPadding(
+        template=template,
+        pad_to_multiple_of=8,
+        label_pad_token_id=IGNORE_INDEX if data_args.ignore_pad_token_for_loss else tokenizer.pad_token_id,
+        **tokenizer_module,
+    )
+
+    if finetuning_args.ref_model is not None:
+        ref_model_args = ModelArguments.copyfrom(
+            model_args,
+            model_name_or_path=finetuning_args.ref_model,
+            adapter_name_or_path=finetuning_args.ref_model_adapters,
+            quantization_bit=finetuning_args.ref_model_quantization_bit,
+        )
+    else:  # the adapter-disabled policy model or the reference adapter
+        ref_model_args = ModelArguments.copyfrom(model_args, adapter_name_or_path=finetuning_args.ref_model_adapters)
+
+    frozen_models = {
+        "ref": _load_frozen_model(ref_model_args, training_args.device),
+        "reward": _load_frozen_model(get_sail_reward_model_args(model_args, finetuning_args), training_args.device),
+    }
+
+    for split, key in _get_cacheable_splits(dataset_module).items():
+        cache_dir = get_sail_cache_path(dataset_module[key], model_args, data_args, finetuning_args)
+        with training_args.main_process_first(desc="allocate cache"):
+            if training_args.local_process_index == 0 and not SailLogpsCache.exists(cache_dir):
+                segment_lengths = get_response_segment_lengths(dataset_module[key])
+                SailLogpsCache.create(cache_dir, segment_lengths, {"dataset": data_args.dataset, "split": split})
+
+        cache = SailLogpsCache(cache_dir, mode="r+")
+        indices = np.arange(training_args.process_index, len(cache), training_args.world_size)
+        indices = indices[~cache.filled[indices]].tolist()
+        logger.info_rank0(f"Precomputing frozen log probabilities of {len(indices)} {split} examples to {cache_dir}.")
+        dataset = add_sample_index(dataset_module[key]).select(indices)
+        dataloader = DataLoader(
+            dataset,
+            batch_size=training_args.per_device_eval_batch_size,
+            collate_fn=data_collator,
+            num_workers=training_args.dataloader_num_workers,
+            pin_memory=training_args.dataloader_pin_memory,
+        )
+        for step, batch in enumerate(dataloader):
+            batch = {k: v.to(training_args.device) if torch.is_tensor(v) else v for k, v in batch.items()}
+            sample_index = batch.pop(SAMPLE_INDEX_COLUMN)
+            labels = batch.pop("labels")
+            mask = labels[:, 1:] != IGNORE_INDEX
+            for name, model in frozen_models.items():
+                with torch.no_grad():
+                    logits = model(**batch, return_dict=True, use_cache=False).logits.to(torch.float32)
+                    per_token_logps, _ = get_batch_logps(logits=logits, labels=labels)
+
+                cache.write(name, sample_index, per_token_logps, mask)
+
+            cache.mark_filled(sample_index)
+            if (step + 1) % training_args.logging_steps == 0:
+                cache.flush()
+                logger.info_rank0(f"Precomputed {step + 1}/{len(dataloader)} batches of {split} examples.")
+
+        cache.flush()
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.barrier()
+
+    logger.info_rank0(f"Frozen log probabilities are saved to {finetuning_args.sail_logps_cache_dir}.")
@@ -17,9 +17,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import partial
+from typing import TYPE_CHECKING, Any, Callable, Dict, Generator, List, Literal, Optional, Tuple, Union
 
 import torch
+import torch.nn.functional as F
 from transformers import Trainer
 from transformers.integrations import is_deepspeed_zero3_enabled
 from transformers.modeling_utils import is_fsdp_enabled
@@ -30,6 +34,7 @@ from typing_extensions import override
 
 from ..extras import logging
 from ..extras.constants import IGNORE_INDEX
+from ..extras.misc import get_current_device
 from ..extras.packages import is_galore_available
 from ..hparams import FinetuningArguments, ModelArguments
 from ..model import find_all_linear_modules, load_model, load_tokenizer, load_valuehead_params
@@ -40,7 +45,8 @@ if is_galore_available():
 
 
 if TYPE_CHECKING:
-    from transformers import PreTrainedModel, Seq2SeqTrainingArguments
+    from peft import PeftModel
+    from transformers import PreTrainedModel, PreTrainedTokenizer, Seq2SeqTrainingArguments
     from trl import AutoModelForCausalLMWithValueHead
 
     from ..hparams import DataArguments
@@ -70,6 +76,42 @@ class DummyOptimizer(torch.optim.Optimizer):
         pass
 
 
+class MetricsAccumulator:
+    r"""
+    Accumulates the metrics on device between logging steps to avoid synchronizing at every step.
+
+    The metrics are reduced across processes in a single collective call when popped.
+    """
+
+    def __init__(self, min_num_metrics: int = 10) -> None:
+        self.min_num_metrics = min_num_metrics
+        self._sums: Dict[str, Dict[str, "torch.Tensor"]] = defaultdict(dict)
+        self._counts: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def add(self, metrics: Dict[str, Union["torch.Tensor", float]], train_eval: Literal["train", "eval"]) -> None:
+        sums, counts = self._sums[train_eval], self._counts[train_eval]
+        for key, value in metrics.items():
+            value = value.detach().float() if torch.is_tensor(value) else torch.tensor(value, dtype=torch.float)
+            sums[key] = sums[key] + value if key in sums else value
+            counts[key] += 1
+
+    def pop(
+        self, train_eval: Literal["train", "eval"], device: "torch.device", reduce_fn: Callable
+    ) -> Dict[str, float]:
+        r"""
+        Returns the averaged metrics over steps and processes, and resets the states.
+        """
+        sums, counts = self._sums.pop(train_eval, {}), self._counts.pop(train_eval, {})
+        keys = list(sums.keys())
+        buffer = torch.zeros(2, max(len(keys), self.min_num_metrics), device=device)  # pad for all reduce
+        if len(keys) != 0:
+            buffer[0, : len(keys)] = torch.stack([sums[key].to(device) for key in keys])
+            buffer[1, : len(keys)] = torch.tensor([counts[key] for key in keys], dtype=torch.float, device=device)
+
+        totals, counts = reduce_fn(buffer, "sum").tolist()
+        return {key: total / max(count, 1.0) for key, total, count in zip(keys, totals, counts)}
+
+
 def create_modelcard_and_push(
     trainer: "Trainer",
     model_args: "ModelArguments",
@@ -176,6 +218,78 @@ def create_reward_model(
         return reward_model
 
 
+def get_sail_reward_model_args(
+    model_args: "ModelArguments", finetuning_args: "FinetuningArguments"
+) -> "ModelArguments":
+    r"""
+    Returns the model arguments of the reward model for SAIL training.
+    """
+    if finetuning_args.sail_reward_model_type == "lora":
+        reward_model_args = ModelArguments.copyfrom(model_args, adapter_name_or_path=finetuning_args.sail_reward_model)
+    else:
+        reward_model_args = ModelArguments.copyfrom(
+            model_args,
+            model_name_or_path=finetuning_args.sail_reward_model,
+            adapter_name_or_path=finetuning_args.sail_reward_model_adapters,
+            quantization_bit=finetuning_args.sail_reward_model_quantization_bit,
+        )
+
+    if finetuning_args.sail_reward_model_dtype != "auto":
+        reward_model_args.compute_dtype = getattr(torch, finetuning_args.sail_reward_model_dtype)
+
+    return reward_model_args
+
+
+def place_frozen_model(model: "PreTrainedModel", device: str) -> None:
+    r"""
+    Places the frozen model on CPU, offloads it or moves it to the given device unless the placement is `auto`.
+    """
+    if device == "offload":
+        from accelerate import cpu_offload
+
+        cpu_offload(model, execution_device=get_current_device())
+    elif device != "auto":
+        model.to(device)
+
+
+def create_sail_reward_model(
+    tokenizer: "PreTrainedTokenizer", model_args: "ModelArguments", finetuning_args: "FinetuningArguments"
+) -> "PreTrainedModel":
+    r"""
+    Creates reward model for SAIL training, which should share the same tokenizer with the policy model.
+
+    The reward model is placed on CPU, offloaded or moved to the given device unless the placement is `auto`.
+    """
+    reward_model_args = get_sail_reward_model_args(model_args, finetuning_args)
+    reward_model = load_model(tokenizer, reward_model_args, FinetuningArguments(), is_trainable=False)
+    device = finetuning_args.sail_reward_model_device
+    place_frozen_model(reward_model, device)
+    logger.info_rank0(f"Loaded reward model from {finetuning_args.sail_reward_model} on device `{device}`.")
+    return reward_model
+
+
+def create_sail_frozen_adapters(model: "PeftModel", finetuning_args: "FinetuningArguments") -> Dict[str, str]:
+    r"""
+    Loads the reference and reward models of SAIL as frozen adapters of the policy model.
+
+    Returns the adapter name of each frozen model, where `__base__` denotes the adapter-disabled model.
+    """
+    frozen_adapters = {"ref": "__base__", "reward": "reward"}
+    if finetuning_args.ref_model_adapters is not None:
+        frozen_adapters["ref"] = "ref"
+        model.load_adapter(finetuning_args.ref_model_adapters, "ref", is_trainable=False)
+        logger.info_rank0(f"Loaded adapter weights of reference model from {finetuning_args.ref_model_adapters}")
+
+    model.load_adapter(finetuning_args.sail_reward_model, "reward", is_trainable=False)
+    logger.info_rank0(f"Loaded adapter weights of reward model from {finetuning_args.sail_reward_model}")
+    for name, param in model.named_parameters():
+        if any(f".{adapter_name}." in name for adapter_name in frozen_adapters.values()):
+            param.requires_grad_(False)
+
+    model.save_pretrained = partial(model.save_pretrained, selected_adapters=["default"])  # skip frozen adapters
+    return frozen_adapters
+
+
 def _get_decay_parameter_names(model: "PreTrainedModel") -> List[str]:
     r"""
     Returns a list of names of parameters with weight decay. (weights in non-layernorm layers)
@@ -480,3 +594,216 @@ def get_batch_logps(
     return per_token_logps * loss_mask, loss_mask.sum(-1)
 
 
+def unpack_pairwise_logps(
+    per_token_logps: "torch.Tensor",
+    labels: "torch.Tensor",
+    segment_ids: "torch.Tensor",
+    position_ids: "torch.Tensor",
+    label_pad_token_id: int = IGNORE_INDEX,
+) -> Tuple["torch.Tensor", "torch.Tensor", "torch.Tensor", "torch.Tensor"]:
+    r"""
+    Recovers the per-token log probabilities of each pair from the packed rows.
+
+    The chosen and rejected sequences of the j-th pair in a row are the segments 2j+1 and 2j+2,
+    and the positions restart from zero in each segment.
+
+    Returns:
+        chosen_logps: A tensor of shape (num_pairs, max_seqlen - 1) aligned as in the unpacked batch.
+        rejected_logps: A tensor of shape (num_pairs, max_seqlen - 1) aligned as in the unpacked batch.
+        chosen_length: A tensor of shape (num_pairs,) containing the number of non-masked tokens.
+        rejected_length: A tensor of shape (num_pairs,) containing the number of non-masked tokens.
+    """
+    loss_mask = labels[:, 1:] != label_pad_token_id
+    segment_ids, position_ids = segment_ids[:, 1:], position_ids[:, 1:]
+    num_pairs = (segment_ids.max(dim=-1).values + 1) // 2
+    pair_offsets = num_pairs.cumsum(dim=0) - num_pairs
+    total_pairs, max_length = int(num_pairs.sum()), int((position_ids * loss_mask).max())
+
+    rows, cols = loss_mask.nonzero(as_tuple=True)
+    segments = segment_ids[rows, cols].long() - 1
+    sequence_ids = (segments % 2) * total_pairs + pair_offsets[rows] + segments // 2  # chosen first, then rejected
+    flat_index = sequence_ids * max_length + position_ids[rows, cols] - 1  # the first token is never predicted
+    logps = per_token_logps.new_zeros(2 * total_pairs * max_length).scatter(0, flat_index, per_token_logps[rows, cols])
+    valid_length = loss_mask.new_zeros(2 * total_pairs, dtype=torch.long).scatter_add(
+        0, sequence_ids, torch.ones_like(sequence_ids)
+    )
+    chosen_logps, rejected_logps = logps.view(2, total_pairs, max_length).unbind(dim=0)
+    chosen_length, rejected_length = valid_length.view(2, total_pairs).unbind(dim=0)
+    return chosen_logps, rejected_logps, chosen_length, rejected_length
+
+
+class FusedLinearLogps(torch.autograd.Function):
+    r"""
+    Computes the log probabilities of the labels through the output layer in chunks of tokens.
+
+    Only a (chunk_size, vocab_size) block of logits is alive at a time, both in the forward and backward passes.
+    """
+
+    @staticmethod
+    def forward(
+        ctx: "torch.autograd.function.FunctionCtx",
+        hidden_states: "torch.Tensor",
+        weight: "torch.Tensor",
+        bias: Optional["torch.Tensor"],
+        labels: "torch.Tensor",
+        chunk_size: int,
+    ) -> Tuple["torch.Tensor", "torch.Tensor"]:
+        num_tokens = hidden_states.size(0)
+        logps = hidden_states.new_empty(num_tokens, dtype=torch.float32)
+        logsumexp = torch.empty_like(logps)
+        logits_sum = torch.empty_like(logps)
+        for start in range(0, num_tokens, chunk_size):
+            end = min(start + chunk_size, num_tokens)
+            logits = F.linear(hidden_states[start:end], weight, bias).float()
+            logsumexp[start:end] = logits.logsumexp(dim=-1)
+            logps[start:end] = logits.gather(-1, labels[start:end, None]).squeeze(-1) - logsumexp[start:end]
+            logits_sum[start:end] = logits.sum(dim=-1)
+
+        ctx.save_for_backward(hidden_states, weight, bias, labels, logsumexp)
+        ctx.chunk_size = chunk_size
+        ctx.mark_non_differentiable(logits_sum)
+        return logps, logits_sum
+
+    @staticmethod
+    def backward(
+        ctx: "torch.autograd.function.FunctionCtx", grad_logps: "torch.Tensor", grad_logits_sum: "torch.Tensor"
+    ) -> Tuple[Optional["torch.Tensor"], ...]:
+        hidden_states, weight, bias, labels, logsumexp = ctx.saved_tensors
+        grad_hidden_states = torch.zeros_like(hidden_states) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight, dtype=torch.float32) if ctx.needs_input_grad[1] else None
+        grad_bias = torch.zeros_like(bias, dtype=torch.float32) if ctx.needs_input_grad[2] else None
+        num_tokens = hidden_states.size(0)
+        for start in range(0, num_tokens, ctx.chunk_size):
+            end = min(start + ctx.chunk_size, num_tokens)
+            chunk_hidden_states, chunk_grad = hidden_states[start:end], grad_logps[start:end, None].float()
+            logits = F.linear(chunk_hidden_states, weight, bias).float()
+            grad_logits = (logits - logsumexp[start:end, None]).exp_().mul_(-chunk_grad)  # d(log p_y) / dz = 1_y - p
+            grad_logits.scatter_add_(-1, labels[start:end, None], chunk_grad)
+            if grad_hidden_states is not None:
+                grad_hidden_states[start:end] = grad_logits.to(weight.dtype) @ weight
+
+            if grad_weight is not None:
+                grad_weight += grad_logits.t() @ chunk_hidden_states.float()
+
+            if grad_bias is not None:
+                grad_bias += grad_logits.sum(dim=0)
+
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+
+        if grad_bias is not None:
+            grad_bias = grad_bias.to(bias.dtype)
+
+        return grad_hidden_states, grad_weight, grad_bias, None, None
+
+
+class LabelLogpsHead(torch.nn.Module):
+    r"""
+    Replaces the output layer to return the per-token log probabilities of the labels instead of the logits.
+
+    Only the hidden states at the response positions are projected to the vocabulary, optionally in chunks.
+    The outputs equal to the first return value of `get_batch_logps`, i.e., shape (batch_size, seq_len - 1).
+    """
+
+    def __init__(
+        self,
+        output_layer: "torch.nn.Module",
+        labels: "torch.Tensor",
+        chunk_size: Optional[int],
+        label_pad_token_id: int,
+    ) -> None:
+        super().__init__()
+        self.output_layer = output_layer
+        self.labels = labels
+        self.chunk_size = chunk_size
+        self.label_pad_token_id = label_pad_token_id
+        self.logits_mean: Optional["torch.Tensor"] = None
+
+    def forward(self, hidden_states: "torch.Tensor") -> "torch.Tensor":
+        labels = self.labels[:, 1:]
+        loss_mask = labels != self.label_pad_token_id
+        response_states = hidden_states[:, :-1, :][loss_mask]  # (num_response_tokens, hidden_size)
+        response_labels = labels[loss_mask]
+        if self.chunk_size is not None:
+            logps, logits_sum = FusedLinearLogps.apply(
+                response_states,
+                self.output_layer.weight,
+                self.output_layer.bias,
+                response_labels,
+                self.chunk_size,
+            )
+            vocab_size = self.output_layer.weight.size(0)
+        else:
+            logits = self.output_layer(response_states).float()
+            logps = logits.log_softmax(-1).gather(-1, response_labels[:, None]).squeeze(-1)
+            logits_sum, vocab_size = logits.detach().sum(-1), logits.size(-1)
+
+        valid_length = loss_mask.sum(-1)
+        token_logits_sum = torch.zeros(labels.size(), dtype=torch.float32, device=labels.device)
+        token_logits_sum[loss_mask] = logits_sum
+        self.logits_mean = token_logits_sum.sum(-1) / (valid_length.clamp(min=1) * vocab_size)
+        per_token_logps = torch.zeros(labels.size(), dtype=logps.dtype, device=labels.device)
+        return per_token_logps.masked_scatter(loss_mask, logps)
+
+
+@contextmanager
+def replace_output_layer(model: "torch.nn.Module", output_layer: "torch.nn.Module") -> Generator[None, None, None]:
+    r"""
+    Temporarily replaces the output layer (lm_head) of the (unwrapped) model.
+    """
+    base_model = model.get_base_model() if hasattr(model, "get_base_model") else model
+    original_output_layer = base_model.get_output_embeddings()
+    base_model.set_output_embeddings(output_layer)
+    try:
+        yield
+    finally:
+        base_model.set_output_embeddings(original_output_layer)
+
+
+def is_label_logps_supported(model: "torch.nn.Module", chunk_size: Optional[int] = None) -> bool:
+    r"""
+    Checks if the output layer of the (unwrapped) model can be replaced by `LabelLogpsHead`.
+
+    Models post-processing the logits in the forward pass, e.g. logit soft-capping, are not supported.
+    """
+    output_layer = model.get_output_embeddings()
+    if output_layer is None or getattr(model.config, "final_logit_softcapping", None) is not None:
+        return False
+
+    if chunk_size is None:
+        return True
+
+    if is_deepspeed_zero3_enabled():  # the weight is a partitioned placeholder outside the forward hooks
+        return False
+
+    return isinstance(output_layer, torch.nn.Linear) and output_layer.weight.device.type != "meta"  # not offloaded
+
+
+def get_label_batch_logps(
+    model: "torch.nn.Module",
+    unwrapped_model: "torch.nn.Module",
+    inputs: Dict[str, Any],
+    labels: "torch.Tensor",
+    chunk_size: Optional[int] = None,
+    label_pad_token_id: int = IGNORE_INDEX,
+) -> Tuple["torch.Tensor", "torch.Tensor", "torch.Tensor"]:
+    r"""
+    Computes the log probabilities of the given labels, where only the response tokens go through the output layer.
+
+    If `chunk_size` is given, the output layer and the log-softmax are fused to avoid materializing the logits.
+
+    Returns:
+        logps: A tensor of shape (batch_size, seq_len - 1) containing the per-token log probabilities.
+        valid_length: A tensor of shape (batch_size,) containing the number of non-masked tokens.
+        logits_mean: A tensor of shape (batch_size,) containing the mean logits of the response tokens.
+    """
+    if not is_label_logps_supported(unwrapped_model, chunk_size):
+        raise ValueError("Current model does not support computing log probabilities in the output layer.")
+
+    inputs = {k: v for k, v in inputs.items() if k != "labels"}  # the model should not compute the loss
+    logps_head = LabelLogpsHead(unwrapped_model.get_output_embeddings(), labels, chunk_size, label_pad_token_id)
+    with replace_output_layer(unwrapped_model, logps_head):
+        per_token_logps = model(**inputs, return_dict=True, use_cache=False).logits.to(torch.float32)
+
+    valid_length = (labels[:, 1:] != label_pad_token_id).sum(-1)
+    return per_token_logps, valid_length, logps_head.logits_mean
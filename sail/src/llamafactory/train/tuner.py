@@ -25,7 +25,9 @@ from ..extras.constants import V_HEAD_SAFE_WEIGHTS_NAME, V_HEAD_WEIGHTS_NAME
 from ..hparams import get_infer_args, get_train_args
 from ..model import load_model, load_tokenizer
 from .callbacks import LogCallback
-from .sail import run_sail
+from .sail import run_sail, run_sail_precompute, run_sail_sweep
+
+
 if TYPE_CHECKING:
     from transformers import TrainerCallback
 
@@ -37,8 +39,12 @@ def run_exp(args: Optional[Dict[str, Any]] = None, callbacks: List["TrainerCallb
     callbacks.append(LogCallback())
     model_args, data_args, training_args, finetuning_args, generating_args = get_train_args(args)
 
-    if finetuning_args.stage == "sail":
+    if finetuning_args.stage == "sail" and finetuning_args.sail_sweep_grid is not None:
+        run_sail_sweep(model_args, data_args, training_args, finetuning_args, callbacks)
+    elif finetuning_args.stage == "sail":
         run_sail(model_args, data_args, training_args, finetuning_args, callbacks)
+    elif finetuning_args.stage == "sail_precompute":
+        run_sail_precompute(model_args, data_args, training_args, finetuning_args)
     else:
         raise ValueError(f"Unknown task: {finetuning_args.stage}.")
 
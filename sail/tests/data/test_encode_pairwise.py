@@ -0,0 +1,71 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+from typing import Dict, List, Optional
+
+import pytest
+from transformers import AutoTokenizer
+
+from llamafactory.data import get_template_and_fix_tokenizer
+from llamafactory.hparams import DataArguments
+
+
+TINY_LLAMA = os.getenv("TINY_LLAMA", "llamafactory/tiny-random-Llama-3")
+
+SINGLE_TURN_PROMPT = [{"role": "user", "content": "How are you"}]
+
+MULTI_TURN_PROMPT = [
+    {"role": "user", "content": "How are you"},
+    {"role": "assistant", "content": "I am fine!"},
+    {"role": "user", "content": "What's the weather like today?"},
+]
+
+RESPONSES = [
+    {"role": "assistant", "content": "It is sunny."},
+    {"role": "assistant", "content": "你好"},
+]
+
+SYSTEM = "You are a helpful assistant."
+
+TOOLS = json.dumps(
+    [
+        {
+            "name": "get_weather",
+            "description": "Gets the weather of a city.",
+            "parameters": {"type": "object", "properties": {"city": {"type": "string"}}, "required": ["city"]},
+        }
+    ]
+)
+
+
+@pytest.mark.parametrize("template_name", ["default", "llama2", "llama3", "qwen", "mistral"])
+@pytest.mark.parametrize("prompt", [SINGLE_TURN_PROMPT, MULTI_TURN_PROMPT])
+@pytest.mark.parametrize("system, tools", [(None, None), (SYSTEM, None), (SYSTEM, TOOLS)])
+@pytest.mark.parametrize("single_pass", [False, True])
+def test_encode_pairwise(
+    template_name: str, prompt: List[Dict[str, str]], system: Optional[str], tools: Optional[str], single_pass: bool
+):
+    tokenizer = AutoTokenizer.from_pretrained(TINY_LLAMA)
+    data_args = DataArguments(template=template_name, single_pass_tokenization=single_pass)
+    template = get_template_and_fix_tokenizer(tokenizer, data_args)
+    prompt_ids, response_ids = template.encode_pairwise(tokenizer, prompt, RESPONSES, system, tools)
+    assert len(response_ids) == len(RESPONSES)
+    for response, ids in zip(RESPONSES, response_ids):
+        expected_prompt_ids, expected_response_ids = template.encode_oneturn(
+            tokenizer, prompt + [response], system, tools
+        )
+        assert prompt_ids == expected_prompt_ids
+        assert ids == expected_response_ids
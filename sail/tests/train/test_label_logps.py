@@ -0,0 +1,108 @@
+# Copyright 2024 the LlamaFactory team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from types import SimpleNamespace
+from typing import Optional
+
+import pytest
+import torch
+
+from llamafactory.extras.constants import IGNORE_INDEX
+from llamafactory.train.trainer_utils import FusedLinearLogps, get_batch_logps, get_label_batch_logps
+
+
+BATCH_SIZE = 3
+
+SEQ_LEN = 11
+
+HIDDEN_SIZE = 16
+
+VOCAB_SIZE = 37
+
+
+class TinyCausalLM(torch.nn.Module):
+    def __init__(self, bias: bool) -> None:
+        super().__init__()
+        self.config = SimpleNamespace(final_logit_softcapping=None)
+        self.embed_tokens = torch.nn.Embedding(VOCAB_SIZE, HIDDEN_SIZE)
+        self.lm_head = torch.nn.Linear(HIDDEN_SIZE, VOCAB_SIZE, bias=bias)
+
+    def get_output_embeddings(self) -> "torch.nn.Module":
+        return self.lm_head
+
+    def set_output_embeddings(self, output_layer: "torch.nn.Module") -> None:
+        self.lm_head = output_layer
+
+    def forward(self, input_ids: "torch.Tensor", **kwargs) -> SimpleNamespace:
+        return SimpleNamespace(logits=self.lm_head(torch.tanh(self.embed_tokens(input_ids))))
+
+
+def _get_labels(input_ids: "torch.Tensor") -> "torch.Tensor":
+    labels = input_ids.clone()
+    labels[:, :4] = IGNORE_INDEX  # prompt
+    labels[1, -3:] = IGNORE_INDEX  # padding
+    labels[2, 4:] = IGNORE_INDEX  # no response token
+    return labels
+
+
+@pytest.mark.parametrize("chunk_size", [1, 4, 64])
+@pytest.mark.parametrize("use_bias", [False, True])
+def test_fused_linear_logps(chunk_size: int, use_bias: bool):
+    torch.manual_seed(42)
+    hidden_states = torch.randn(20, HIDDEN_SIZE, requires_grad=True)
+    weight = torch.randn(VOCAB_SIZE, HIDDEN_SIZE, requires_grad=True)
+    bias = torch.randn(VOCAB_SIZE, requires_grad=True) if use_bias else None
+    labels = torch.randint(0, VOCAB_SIZE, (20,))
+    grad_output = torch.randn(20)
+    inputs = [hidden_states, weight] + ([bias] if bias is not None else [])
+
+    logps, logits_sum = FusedLinearLogps.apply(hidden_states, weight, bias, labels, chunk_size)
+    grads = torch.autograd.grad((logps * grad_output).sum(), inputs)
+
+    logits = torch.nn.functional.linear(hidden_states, weight, bias)
+    ref_logps = logits.log_softmax(-1).gather(-1, labels[:, None]).squeeze(-1)
+    ref_grads = torch.autograd.grad((ref_logps * grad_output).sum(), inputs)
+    torch.testing.assert_close(logps, ref_logps, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(logits_sum, logits.detach().sum(-1), rtol=1e-5, atol=1e-4)
+    for grad, ref_grad in zip(grads, ref_grads):
+        torch.testing.assert_close(grad, ref_grad, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 5, 64])
+def test_get_label_batch_logps(chunk_size: Optional[int]):
+    torch.manual_seed(42)
+    model = TinyCausalLM(bias=False)
+    params = list(model.parameters())
+    input_ids = torch.randint(0, VOCAB_SIZE, (BATCH_SIZE, SEQ_LEN))
+    labels = _get_labels(input_ids)
+    grad_output = torch.randn(BATCH_SIZE, SEQ_LEN - 1)
+
+    logps, valid_length, logits_mean = get_label_batch_logps(
+        model, model, {"input_ids": input_ids, "labels": labels}, labels, chunk_size
+    )
+    grads = torch.autograd.grad((logps * grad_output).sum(), params)
+    assert isinstance(model.get_output_embeddings(), torch.nn.Linear)  # restored
+
+    logits = model(input_ids).logits
+    ref_logps, ref_valid_length = get_batch_logps(logits, labels)
+    ref_grads = torch.autograd.grad((ref_logps * grad_output).sum(), params)
+    loss_mask = (labels[:, 1:] != IGNORE_INDEX).unsqueeze(-1)
+    ref_logits_mean = (logits.detach()[:, :-1] * loss_mask).sum((1, 2)) / (
+        ref_valid_length.clamp(min=1) * VOCAB_SIZE
+    )
+    torch.testing.assert_close(logps, ref_logps, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(valid_length, ref_valid_length)
+    torch.testing.assert_close(logits_mean, ref_logits_mean, rtol=1e-5, atol=1e-5)
+    for grad, ref_grad in zip(grads, ref_grads):
+        torch.testing.assert_close(grad, ref_grad, rtol=1e-5, atol=1e-5)